@@ -1,138 +1,614 @@
-from ..MCPClient.MCPClient import MCPClient
-from ..LLM.LLM import LLM
+from ..MCPClient.ConnectionManager import connection_manager
+from ..MCPClient.MCPClient import guess_transport
+from ..MCPClient.ToolCache import ToolCache
+from ..LLM.LLM import AsyncLLM
+from ..LLM.Router import LLMRouter
+from .ToolIndex import ToolIndex
+from .ContextManager import ContextManager
+from .ToolResults import ToolResultStore, ToolOutput, READ_TOOL_RESULT, READ_TOOL_RESULT_SCHEMA
+from .Catalog import Catalog, tool_entry
+from .Cascade import invalid_tool_calls
 from urllib.parse import urlparse
+from types import SimpleNamespace
+import asyncio
+import ipaddress
+import json
+import logging
+import os
+import re
+import shlex
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of tool calls running at the same time on one MCP server
+TOOL_CONCURRENCY_PER_SERVER = 4
+# Seconds a single tool call may take before it is reported as failed
+TOOL_CALL_TIMEOUT = 60
+# Number of most relevant active tools sent with each request, None sends all of them
+TOOL_TOP_K = 20
+# Tools sent when nothing in the conversation matches any active tool: "all" or "none"
+TOOL_FALLBACK = "all"
+# Number of recent user/assistant messages used to rank tools
+TOOL_QUERY_MESSAGES = 4
+# Start tool calls while the response is still streaming, as soon as their arguments are complete
+PIPELINE_TOOL_CALLS = True
+# Words after a stdio launcher that name what it does rather than the server it starts, e.g. "uv run"
+LAUNCHER_SUBCOMMANDS = {"run", "exec", "x", "dlx", "tool"}
 
 class Agent:
-    def __init__(self):
+    def __init__(self, system_prompt:str=None):
         self.mcp = {}
+        self.connections = connection_manager  # Process-wide MCP connection pools
         self.LLM = None
+        self.response_cache = None  # Optional ResponseCache handed to every LLM this agent connects
         self.connected_status = False
+        self.tool_concurrency = TOOL_CONCURRENCY_PER_SERVER
+        self.tool_timeout = TOOL_CALL_TIMEOUT
+        self._tool_semaphores = {}
+        self.tool_index = ToolIndex()
+        self.tool_top_k = TOOL_TOP_K
+        self.tool_fallback = TOOL_FALLBACK
+        self.context = ContextManager()
+        self.tool_results = ToolResultStore()
+        self.tool_cache = ToolCache()  # Opt-in, turned on with configure_tool_cache
+        self.catalog = Catalog()  # Last known tools and models, shown while they are fetched again
+        # Model cascade: tool_model drafts the tool calls of each round, answer_model (default LLM.model) writes the reply
+        self.pipeline_tools = PIPELINE_TOOL_CALLS
+        self.tool_model = None
+        self.answer_model = None
+        self.cascade_stats = {"tool_rounds": 0, "handoffs": 0, "escalations": 0}
         self.history = []
-        self.history.append({"role": "system", "content": self.load_system_prompt()})   
+        self.history.append({"role": "system", "content": system_prompt or self.load_system_prompt()})
+        # Optional ConversationStore every history message is written to as it is produced
+        self.store = None
+        self.conversation_id = None
+        self._stored = False  # Whether conversation_id has been created in the store
+        self._next_seq = 1  # seq of the next message written to the store
+        self._history_seq = 1  # seq of history[1], advanced when older messages are folded into the summary
+        self.context.on_fold = self._on_fold
+
+    def new_session(self):
+        """
+        Returns an Agent with its own history that shares this agent's LLM, MCP connections, tool index and caches.
+        """
+        session = Agent(system_prompt=self.history[0]["content"])
+        session.LLM = self.LLM
+        session.connected_status = self.connected_status
+        session.mcp = self.mcp
+        session.connections = self.connections
+        session.response_cache = self.response_cache
+        session.tool_concurrency = self.tool_concurrency
+        session.tool_timeout = self.tool_timeout
+        session._tool_semaphores = self._tool_semaphores
+        session.tool_index = self.tool_index
+        session.tool_top_k = self.tool_top_k
+        session.tool_fallback = self.tool_fallback
+        session.tool_cache = self.tool_cache
+        session.catalog = self.catalog
+        session.pipeline_tools = self.pipeline_tools
+        session.tool_model = self.tool_model
+        session.answer_model = self.answer_model
+        session.cascade_stats = self.cascade_stats
+        session.store = self.store
+        return session
 
     async def get_response(self, user_input:str, temperature=0, max_tokens=2000):
-        print(self.history)
         if not self.LLM:
             raise RuntimeError("LLM client is not connected. Please connect to an LLM first.")
+        if self.pipeline_tools:
+            # Streamed so tool calls start before the response is complete, cached rounds are replayed as streams
+            return "".join([chunk async for chunk in self.stream_response(user_input, temperature, max_tokens)])
     # Prepend the tool prompt to the messages
-        self.history.append({"role": "user", "content": user_input})
+        self.record({"role": "user", "content": user_input})
         try:
-            self.LLM.tools= self.active_tools()
-            response = self.LLM.chat_completion(
-                messages=self.history,
-                temperature=temperature,
-                max_tokens=max_tokens
-            )
-            while response.choices[0].message.tool_calls:
-                for tool_call in response.choices[0].message.tool_calls:
-                    self.history.append({"role":"assistant","tool_calls":[tool_call]})
-                    tool_result= await self.handle_tool_call(tool_call.function)
-                    print(tool_result)
-                    self.history.append({                               # append result message
-                    "role": "tool",
-                    "tool_call_id": tool_call.id,
-                    "name":tool_call.function.name,
-                    "content": str(tool_result),
-                    "isError": getattr(tool_result, "isError", False)
-                    })
-                response = self.LLM.chat_completion(
-                    messages=self.history,
-                    temperature=temperature,
-                    max_tokens=max_tokens
-                )
-            for msg in self.history:
-                if msg.get("role") == "tool" and not msg.get("isError", False):
-                    msg["content"] = "Tool Call successful, contents where forgotten for memory efficiency."
-            reply = response.choices[0].message.content
-            self.history.append({"role": "assistant", "content": reply})
+            # Tools are passed per request so agents sharing one LLM do not overwrite each other's
+            tools = self.active_tools(self.tool_query())
+            while True:
+                message = await self.complete_round(tools, temperature, max_tokens)
+                if not message.tool_calls:
+                    break
+                await self.run_tool_calls([tool_call.model_dump(exclude_none=True) for tool_call in message.tool_calls], message.content)
+                tools = self.with_builtin_tools(tools)
+            reply = message.content
+            self.finish_turn(reply)
             return reply
         except Exception as e:
             raise RuntimeError(f"An error occurred during chat completion: {str(e)}")
 
+    async def complete_round(self, tools:list, temperature=0, max_tokens=2000):
+        """
+        Requests one round of the tool loop and returns the message. With a tool_model, the tool model answers first;
+        its tool calls are used if they are valid, otherwise the round is escalated to the answer model,
+        which also writes the reply when the tool model calls no tools.
+        """
+        messages = self.context.messages_for_request(self.history, tools)
+        if self.tool_model and tools:
+            response = await self.LLM.chat_completion(messages=messages, tools=tools, temperature=temperature,
+                                                      max_tokens=max_tokens, session=id(self), model=self.tool_model)
+            message = response.choices[0].message
+            if self.accept_tool_calls([tool_call.model_dump(exclude_none=True) for tool_call in message.tool_calls or []], tools):
+                self.context.record_usage(response.usage)
+                return message
+        response = await self.LLM.chat_completion(
+            messages=messages,
+            tools=tools,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            session=id(self),
+            model=self.answer_model
+        )
+        self.context.record_usage(response.usage)
+        return response.choices[0].message
+
+    async def stream_response(self, user_input:str, temperature=0, max_tokens=2000):
+        """Async generator yielding the reply in chunks as the LLM streams it, running tool rounds in between."""
+        if not self.LLM:
+            raise RuntimeError("LLM client is not connected. Please connect to an LLM first.")
+        self.record({"role": "user", "content": user_input})
+        try:
+            # Tools are passed per request so agents sharing one LLM do not overwrite each other's
+            tools = self.active_tools(self.tool_query())
+            escalated = False
+            while True:
+                content = []
+                drafted = None
+                if self.tool_model and tools and not escalated:
+                    drafted = await self.draft_tool_calls(tools, temperature, max_tokens)
+                if drafted is not None:
+                    tool_calls, running, escalated = drafted
+                else:
+                    escalated = False
+                    pipeline = ToolCallPipeline(self.run_tool_call, eager=self.pipeline_tools)
+                    try:
+                        async for delta in self.LLM.stream_chat_completion(
+                            messages=self.context.messages_for_request(self.history, tools),
+                            tools=tools,
+                            temperature=temperature,
+                            max_tokens=max_tokens,
+                            session=id(self),
+                            model=self.answer_model,
+                            on_usage=self.context.record_usage
+                        ):
+                            if delta.content:
+                                content.append(delta.content)
+                                yield delta.content
+                            pipeline.add(delta)
+                    except BaseException:
+                        pipeline.cancel()
+                        raise
+                    tool_calls, running = pipeline.finish()
+                if not tool_calls:
+                    break
+                await self.run_tool_calls(tool_calls, "".join(content), running)
+                tools = self.with_builtin_tools(tools)
+            self.finish_turn("".join(content))
+        except Exception as e:
+            raise RuntimeError(f"An error occurred during chat completion: {str(e)}")
+
+    async def draft_tool_calls(self, tools:list, temperature=0, max_tokens=2000):
+        """
+        Streams a round from the tool model, starting each valid tool call as soon as it is complete.
+        Returns (tool calls, their tasks, escalated), where escalated means some calls were invalid and
+        the next round goes to the answer model. Returns None to hand this round to the answer model,
+        as soon as the tool model starts writing text instead of calling tools, or if none of its calls were valid.
+        """
+        pipeline = ToolCallPipeline(self.run_tool_call, accept=lambda tool_call: not invalid_tool_calls([tool_call], tools),
+                                    eager=self.pipeline_tools)
+        stream = self.LLM.stream_chat_completion(
+            messages=self.context.messages_for_request(self.history, tools),
+            tools=tools,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            session=id(self),
+            model=self.tool_model,
+            on_usage=self.context.record_usage
+        )
+        try:
+            async for delta in stream:
+                if delta.content and delta.content.strip() and not pipeline.partial and not pipeline.running:
+                    break  # Answering, not calling tools
+                pipeline.add(delta)
+            tool_calls, running = pipeline.finish()
+        except BaseException:
+            pipeline.cancel()
+            raise
+        finally:
+            await stream.aclose()
+        if not tool_calls and not pipeline.rejected:
+            self.cascade_stats["handoffs"] += 1
+            return None
+        if pipeline.rejected:
+            self.cascade_stats["escalations"] += 1
+            errors = invalid_tool_calls(pipeline.rejected, tools)
+            logger.info(f"Escalating to the answer model, tool model made invalid tool calls: {'; '.join(errors)}")
+            # Valid calls may already be running, they are recorded and the answer model takes the next round
+            return (tool_calls, running, True) if tool_calls else None
+        self.cascade_stats["tool_rounds"] += 1
+        return tool_calls, running, False
+
+    def accept_tool_calls(self, tool_calls:list[dict], tools:list) -> bool:
+        """Whether tool calls of the tool model can be run, counting handoffs and escalations to the answer model."""
+        if not tool_calls:
+            self.cascade_stats["handoffs"] += 1
+            return False
+        errors = invalid_tool_calls(tool_calls, tools)
+        if errors:
+            self.cascade_stats["escalations"] += 1
+            logger.info(f"Escalating to the answer model, tool model made invalid tool calls: {'; '.join(errors)}")
+            return False
+        self.cascade_stats["tool_rounds"] += 1
+        return True
+
+    async def run_tool_calls(self, tool_calls:list[dict], content:str=None, running:list=None):
+        """
+        Executes one round of tool calls concurrently and records them in history as a single
+        assistant message followed by the results, in the order the model issued the calls.
+        running are the tasks of calls already started while the response streamed, in the same order.
+        """
+        self.record({"role":"assistant","content":content or None,"tool_calls":tool_calls})
+        results = await asyncio.gather(*(running or [self.run_tool_call(tool_call) for tool_call in tool_calls]))
+        for tool_call, (tool_result, is_error) in zip(tool_calls, results):
+            logger.debug(f"Tool call {tool_call['function']['name']} returned {len(tool_result)} characters")
+            self.record({                               # append result message
+            "role": "tool",
+            "tool_call_id": tool_call["id"],
+            "name":tool_call["function"]["name"],
+            "content": str(tool_result),
+            "isError": is_error
+            })
+
+    async def run_tool_call(self, tool_call:dict):
+        """Runs one tool call within its server's concurrency limit and the per-call timeout. Returns (result, is_error)."""
+        name = tool_call["function"]["name"]
+        server, _ = split_tool_name(name)
+        semaphore = self._tool_semaphores.get(server)
+        if semaphore is None:
+            semaphore = self._tool_semaphores[server] = asyncio.Semaphore(self.tool_concurrency)
+        try:
+            async with semaphore:
+                result = await asyncio.wait_for(self.handle_tool_call(SimpleNamespace(**tool_call["function"])), self.tool_timeout)
+            return result, getattr(result, "isError", False)
+        except asyncio.TimeoutError:
+            return f"Tool '{name}' timed out after {self.tool_timeout} seconds", True
+        except Exception as e:
+            return f"Error calling tool '{name}': {e}", True
+
+    def finish_turn(self, reply:str):
+        forget_tool_results(self.history)
+        # Forgotten results no longer show their handles, so they cannot be read any more
+        self.tool_results.retain(msg["content"] for msg in self.history
+                                 if msg.get("role") == "tool" and isinstance(msg.get("content"), str))
+        self.record({"role": "assistant", "content": reply})
+        # Fold older turns into the summary in the background, the next turn does not wait for it
+        self.context.schedule_summary(self.history, self.LLM)
+
+    def record(self, message:dict):
+        """Appends a message to the history and, with a store, to the stored conversation."""
+        self.history.append(message)
+        if self.store is None:
+            return
+        if not self._stored:
+            # First message of the conversation, it is stored with the history before it
+            self.ensure_conversation()
+            return
+        # Stored as produced; forget_tool_results later replaces tool results in memory only
+        self.store.append_message(self.conversation_id, self._next_seq, message)
+        self._next_seq += 1
+
+    def ensure_conversation(self) -> str:
+        """
+        Returns the id of the current conversation, creating it in the store with the history so far
+        if it is not stored yet. New conversations are only created by their first message or transcript entry.
+        """
+        if self.conversation_id is None:
+            self.conversation_id = uuid.uuid4().hex
+        if self.store is not None and not self._stored:
+            self._stored = True
+            self.store.create(self.conversation_id, self.history[0]["content"])
+            self._next_seq = self._history_seq = 1
+            for message in self.history[1:]:
+                self.store.append_message(self.conversation_id, self._next_seq, message)
+                self._next_seq += 1
+        return self.conversation_id
+
+    def start_conversation(self, conversation_id:str=None):
+        """
+        Starts a new, empty conversation. With a conversation_id it is stored under that id right away,
+        otherwise it gets an id and is stored once it has its first message.
+        """
+        self.context.reset()
+        self.tool_results.clear()
+        del self.history[1:]
+        self.conversation_id = conversation_id
+        self._stored = False
+        self._next_seq = self._history_seq = 1
+        if conversation_id is not None:
+            self.ensure_conversation()
+        return self.conversation_id
+
+    async def open_conversation(self, conversation_id:str) -> bool:
+        """
+        Continues a stored conversation, loading only its summary and the newest messages that fit
+        the context window. Returns False if the store has no such conversation.
+        """
+        data = await self.load_conversation(conversation_id)
+        if data is None:
+            return False
+        self.continue_conversation(conversation_id, data)
+        return True
+
+    async def load_conversation(self, conversation_id:str):
+        """Reads what open_conversation needs of a stored conversation without switching to it, None if there is none."""
+        return await self.store.load_tail(conversation_id, self.context.token_budget)
+
+    def continue_conversation(self, conversation_id:str, data:dict):
+        """Switches to a stored conversation read with load_conversation."""
+        self.context.reset()
+        self.tool_results.clear()
+        self.history[1:] = forget_tool_results(data["messages"])
+        if data["system_prompt"]:
+            self.history[0] = {"role": "system", "content": data["system_prompt"]}
+        self.context.summary = data["summary"]
+        self.conversation_id = conversation_id
+        self._stored = True
+        self._history_seq = data["start_seq"]
+        self._next_seq = data["next_seq"]
+
+    def _on_fold(self, count:int):
+        self._history_seq += count
+        if self.store is not None and self._stored:
+            self.store.set_summary(self.conversation_id, self.context.summary, self._history_seq - 1)
 
-    def active_tools(self):
-        """Returns all tools labeled as active, with names as server.toolname."""
-        active_tools = []
+    def active_tools(self, query:str=None):
+        """
+        Returns the tools labeled as active, with names as server_toolname.
+        With a query and tool_top_k set, only the tool_top_k tools most relevant to the query are returned;
+        if none of them match, tool_fallback decides whether all or no active tools are returned.
+        """
+        active_tools = {}
         for server, entry in self.mcp.items():
             for tool in entry.get("tools", []):
                 if tool.get("active"):
-                    active_tools.append({
+                    name = f"{server}_{tool['name']}"
+                    active_tools[name] = {
                         "type": "function",
                         "function": {
-                            "name": f"{server}_{tool['name']}",
+                            "name": name,
                             "description": tool["description"],
                             "parameters": tool["input_schema"]
                         }
-                    })
-        return active_tools
+                    }
+        if query is None or not self.tool_top_k or len(active_tools) <= self.tool_top_k:
+            return self.with_builtin_tools(list(active_tools.values()))
+        ranked = self.tool_index.search(query, candidates=active_tools, k=self.tool_top_k)
+        if not ranked:
+            return self.with_builtin_tools(list(active_tools.values()) if self.tool_fallback == "all" else [])
+        return self.with_builtin_tools([active_tools[name] for name, _ in ranked])
+
+    def with_builtin_tools(self, tools:list) -> list:
+        """
+        Adds read_tool_result to tools while a large text result the model can still see is stored, so it can page
+        through it. Called again after every tool round, as the round may have spilled the first result of the session.
+        """
+        if self.tool_results.readable() and READ_TOOL_RESULT_SCHEMA not in tools:
+            return tools + [READ_TOOL_RESULT_SCHEMA]
+        return tools
+
+    def tool_query(self):
+        """Text of the most recent user and assistant messages, used to rank tools for the next request."""
+        recent = [msg["content"] for msg in self.history
+                  if msg.get("role") in ("user", "assistant") and isinstance(msg.get("content"), str)]
+        return " ".join(recent[-TOOL_QUERY_MESSAGES:])
+
+    def configure_tool_cache(self, enabled:bool=True, default_ttl:float=None, ttls:dict=None):
+        """
+        Turns reusing results of read-only and idempotent tools on or off. Call it before connecting MCP servers,
+        default_ttl applies to the tools registered afterwards. ttls maps server_toolname to seconds,
+        overriding the annotations of those tools; 0 never caches a tool.
+        """
+        self.tool_cache.enabled = enabled
+        if default_ttl is not None:
+            self.tool_cache.default_ttl = default_ttl
+        for name, ttl in (ttls or {}).items():
+            server, tool_name = split_tool_name(name)
+            self.tool_cache.set_cacheable(server, tool_name, ttl > 0, ttl)
+
+    async def connect_LLM(self, base_url:str=None, model_name:str=None, api_key:str=None, verify:bool=True):
+        """
+        Connects the LLM and returns its model names. With verify=False the model list is not fetched,
+        so a known model can be used right away, and [] is returned.
+        """
+        self.LLM = AsyncLLM(base_url=base_url, model_name=model_name, api_key=api_key, cache=self.response_cache)
+        if not verify:
+            self.connected_status = True
+            return []
+        return await self.list_models()
+
+    async def add_LLM_backend(self, base_url:str=None, model_name:str=None, api_key:str=None, weight:float=1.0,
+                              verify:bool=True):
+        """
+        Adds a provider requests are routed and failed over to, next to the connected LLM,
+        which becomes the first backend of an LLMRouter. Configure routing on self.LLM.
+        """
+        if not self.LLM:
+            raise RuntimeError("LLM client is not connected. Please connect to an LLM first.")
+        backend = AsyncLLM(base_url=base_url, model_name=model_name, api_key=api_key, cache=self.response_cache)
+        if verify:
+            try:
+                await backend.list_models()
+            except Exception as e:
+                raise RuntimeError(f"Error connecting to LLM: {e}")
+        if not isinstance(self.LLM, LLMRouter):
+            self.LLM = LLMRouter([self.LLM])
+        self.LLM.add(backend, weight)
+        return self.LLM
 
-    async def connect_LLM(self, base_url:str=None, model_name:str=None, api_key:str=None):
-        self.LLM = LLM(base_url=base_url, model_name=model_name, api_key=api_key)
+    async def list_models(self):
         try:
-            models=self.LLM.list_models()  # Test the connection by listing models
+            models=await self.LLM.list_models()  # Test the connection by listing models
             self.connected_status = True
             model_names = [m.id for m in models if hasattr(m, "id")]
+            await self.catalog.put_models(self.LLM.base_url, model_names)
             return model_names
         except Exception as e:
             self.connected_status = False
             raise RuntimeError(f"Error connecting to LLM: {e}")
 
-    async def connect_MCP(self, server_url: str, auth_method: str = "none", token: str = None, oauth_server_url: str = None):
-        client = MCPClient()
+    async def connect_MCP(self, server_url: str, auth_method: str = "none", token: str = None, oauth_server_url: str = None,
+                          transport: str = None):
+        """Connects an MCP server over sse, streamable-http or stdio, guessing the transport from server_url if not given."""
         name= url_to_name(server_url)
-        self.mcp[name] = {"client": client, "connected": False, "tools": []}
+        transport = transport or guess_transport(server_url)
+        # Tools already known, from the catalog or an earlier connection, keep their active flags
+        entry = self.mcp.setdefault(name, {"tools": []})
+        previous = entry.get("client")
+        entry.update(client=None, connected=False, transport=transport)
+        if previous is not None:
+            self._forget_listener(entry, previous)
         try:
-            tools = await client.connect_to_sse_server(server_url, auth_method, token, oauth_server_url)
-            mcp_tools = []
-            mcp_tools.extend(
-                {
-                    "name": tool.name,
-                    "description": tool.description,
-                    "input_schema": tool.inputSchema,
-                    "active": False
-                }
-                for tool in tools
-            )
-            self.mcp[name]["tools"] = mcp_tools
-            self.mcp[name]["connected"] = True
-            return self.mcp[name]
+            # Shares the connection pool with every other agent using this server and these credentials
+            client = await self.connections.acquire(server_url, auth_method, token, oauth_server_url, transport)
+            entry["client"] = client
+            self.update_tools(name, client.tools)
+            self.tool_cache.register_tools(name, client.tools)
+            entry["listener"] = lambda tools: self.on_tools_changed(name, server_url, client, tools)
+            client.listeners.append(entry["listener"])
+            entry["connected"] = True
+            entry.pop("cached", None)
+            await self.catalog.put_tools(server_url, entry["tools"])
+            return entry
         except Exception as e:
-            self.mcp[name]["connected"] = False
+            entry["connected"] = False
+            if not entry["tools"]:
+                self.mcp.pop(name, None)  # No tools left to show, drop the entry instead of keeping a dead one
             raise RuntimeError(f"Error connecting to MCP: {e}")
+        finally:
+            # Released after acquiring, so reconnecting with the same credentials reuses the pool
+            if previous is not None:
+                await self.connections.release(previous)
+
+    def load_cached_MCP(self, server_url: str, transport: str = None):
+        """
+        Adds a server with its tools from the catalog, before it is connected, so they can be shown and
+        activated right away. Returns the entry, or None if the server's tools are not cached.
+        """
+        name = url_to_name(server_url)
+        tools = self.catalog.tools(server_url)
+        if tools is None or name in self.mcp:
+            return self.mcp.get(name)
+        for tool in tools:
+            tool["active"] = False
+        self.mcp[name] = {"client": None, "connected": False, "cached": True, "tools": tools,
+                          "transport": transport or guess_transport(server_url)}
+        self.tool_index.add_server(name, tools)
+        return self.mcp[name]
+
+    def update_tools(self, name: str, tools):
+        """
+        Applies a server's current tool list to its entry, touching only tools that were added, changed or removed.
+        Known tools keep their dicts and active flags. Returns the names of the changed and of the removed tools.
+        """
+        entry = self.mcp[name]
+        known = {tool["name"]: tool for tool in entry.get("tools", [])}
+        updated, changed = [], []
+        for tool in tools:
+            fresh = tool_entry(tool)
+            current = known.pop(fresh["name"], None)
+            if current is None:
+                current = dict(fresh, active=False)
+                changed.append(current)
+            elif any(current.get(key) != value for key, value in fresh.items()):
+                current.update(fresh)
+                changed.append(current)
+            updated.append(current)
+        removed = list(known)
+        entry["tools"] = updated
+        if changed or removed:
+            self.tool_index.update_tools(name, changed, removed)
+        return [tool["name"] for tool in changed], removed
+
+    async def on_tools_changed(self, name: str, server_url: str, client, tools):
+        """Called by a connection pool when its server reported tools/list_changed and was listed again."""
+        entry = self.mcp.get(name)
+        if entry is None or entry.get("client") is not client:
+            return
+        changed, removed = self.update_tools(name, tools)
+        self.tool_cache.update_tools(name, [tool for tool in tools if tool.name in changed], removed)
+        logger.info(f"Tools of {name} changed: {len(changed)} added or updated, {len(removed)} removed")
+        await self.catalog.put_tools(server_url, entry["tools"])
+
+    def _forget_listener(self, entry: dict, client):
+        listener = entry.pop("listener", None)
+        if listener in client.listeners:
+            client.listeners.remove(listener)
+
+    # Snapshots and setters for a UI on another thread, which must not touch self.mcp or self.LLM directly.
+    # They are meant to run on the event loop thread, between the coroutines that use that state.
+
+    def mcp_status(self) -> dict:
+        """Connection status and connect parameters of every MCP server, by server name."""
+        keys = ("connected", "url", "auth", "token", "oauth_url", "transport")
+        return {name: {key: entry.get(key) for key in keys if key in entry} for name, entry in self.mcp.items()}
+
+    def tool_snapshot(self, name: str):
+        """Copies of a server's tool dicts, or None if the server is unknown."""
+        entry = self.mcp.get(name)
+        return None if entry is None else [dict(tool) for tool in entry.get("tools", [])]
+
+    def set_active_tools(self, name: str, active: list[str]):
+        """Activates exactly the tools of a server named in active."""
+        active = set(active)
+        for tool in self.mcp.get(name, {}).get("tools", []):
+            tool["active"] = tool.get("name") in active
+
+    def select_model(self, model: str):
+        self.selected_model = model
+        if self.LLM:
+            self.LLM.model = model
+
+    async def disconnect_MCP(self, name: str):
+        """Forgets an MCP server and releases this agent's reference to its connection pool."""
+        entry = self.mcp.pop(name, None)
+        self.tool_index.remove_server(name)
+        if entry and entry.get("client") is not None:
+            self._forget_listener(entry, entry["client"])
+            await self.connections.release(entry["client"])
 
     async def handle_tool_call(self, tool_call):
         # Extract tool name and arguments from the tool_call
-        if "_" in tool_call.name:
-            server, tool_name = tool_call.name.split("_", 1)
-        else:
-            server, tool_name = None, tool_call.name
+        server, tool_name = split_tool_name(tool_call.name)
         tool_args = tool_call.arguments
 
         if isinstance(tool_args, str):
-                try:
-                    tool_args = eval(tool_args)  # Convert string to dictionary
-                except Exception as e:
-                    return f"Invalid arguments format: {tool_args}. Error: {e}"
+            try:
+                tool_args = json.loads(tool_args or "{}")  # Arguments are a JSON object, never evaluated as Python
+            except ValueError as e:
+                return ToolOutput(f"Invalid arguments format: {tool_args}. Error: {e}", True)
+        if not isinstance(tool_args, dict):
+            return ToolOutput(f"Invalid arguments format: {tool_args}. Error: arguments must be a JSON object", True)
 
+        if tool_call.name == READ_TOOL_RESULT:
+            return self.tool_results.read(**tool_args)
 
         if not tool_name:
-            return "Tool name is missing in the tool call"
+            return ToolOutput("Tool name is missing in the tool call", True)
         
         if not self.mcp:
             raise RuntimeError("MCP client is not connected")
         # Check if 'server' is specified and exists in self.mcp (assuming self.mcp is a dict or has a dict attribute)
         if server:
             if server in self.mcp:
-                result = await self.mcp[server]["client"].session.call_tool(tool_name, tool_args)
+                client = self.mcp[server]["client"]
+                if client is None:
+                    return ToolOutput(f"Server '{server}' is not connected", True)
+                result = await self.tool_cache.call(server, tool_name, tool_args, lambda: client.call_tool(tool_name, tool_args))
             else:
-                return f"Server '{server}' not found in MCP client"
+                return ToolOutput(f"Server '{server}' not found in MCP client", True)
 
 
-        # Handle the result (if needed)
-        if result:
-            return (f"Tool '{tool_name}' executed successfully with result: {result}")
-        else:
-            return (f"Tool '{tool_name}' execution returned no result")
+        # Forward a size-bounded version of the result, large or binary content goes to the spill store
+        return self.tool_results.process(tool_name, result)
         
     def load_system_prompt(self):
         try:
@@ -146,8 +622,115 @@ class Agent:
 def url_to_name(url: str) -> str:
     """
     Converts a URL to a name by extracting the hostname and port.
+    Commands of stdio servers are named after the script or package they run.
+    Hosts that are IP addresses or a single label like localhost are named after the whole host.
     """
     parsed = urlparse(url)
-    host = parsed.hostname.split(".")[-2] or ""
+    if not parsed.hostname:
+        # Skip environment assignments, flags and the subcommands of launchers like "uv run" or "docker run"
+        parts = [part for part in shlex.split(url) if "=" not in part] or [url]
+        target = next((part for part in parts[1:] if not part.startswith("-") and part not in LAUNCHER_SUBCOMMANDS), parts[0])
+        return re.sub(r"[^A-Za-z0-9]", "", os.path.splitext(os.path.basename(target.rstrip("/")))[0]) or "stdio"
     port = f"{parsed.port}" if parsed.port else ""
-    return f"{host}{port}"
\ No newline at end of file
+    labels = parsed.hostname.split(".")
+    if len(labels) < 2 or is_ip_address(parsed.hostname):
+        # Names must not contain "_", it separates the server from the tool name
+        host = re.sub(r"[^A-Za-z0-9]+", "-", parsed.hostname).strip("-")
+        return f"{host}-{port}" if port else host
+    return f"{labels[-2]}{port}"
+
+
+def is_ip_address(host: str) -> bool:
+    try:
+        ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return True
+
+
+def split_tool_name(name: str):
+    """
+    Splits a tool name of the form server_toolname into (server, toolname).
+    """
+    if "_" in name:
+        server, tool_name = name.split("_", 1)
+        return server, tool_name
+    return None, name
+
+
+def forget_tool_results(history: list[dict]) -> list[dict]:
+    """Replaces the content of successful tool results of finished turns, which the model no longer needs."""
+    for msg in history:
+        if msg.get("role") == "tool" and not msg.get("isError", False):
+            msg["content"] = "Tool Call successful, contents where forgotten for memory efficiency."
+    return history
+
+
+def merge_tool_call_delta(tool_calls: dict, delta) -> None:
+    """
+    Folds a streamed tool call delta into the partial tool calls, keyed by their index.
+    """
+    call = tool_calls.setdefault(delta.index, {"id": None, "type": "function", "function": {"name": "", "arguments": ""}})
+    if delta.id:
+        call["id"] = delta.id
+    if delta.function:
+        if delta.function.name:
+            call["function"]["name"] += delta.function.name
+        if delta.function.arguments:
+            call["function"]["arguments"] += delta.function.arguments
+
+
+def arguments_complete(arguments: str) -> bool:
+    """Whether streamed tool call arguments already form a complete JSON object."""
+    try:
+        return isinstance(json.loads(arguments), dict)
+    except ValueError:
+        return False
+
+
+class ToolCallPipeline:
+    """
+    Assembles streamed tool call deltas and starts each call with run(tool_call) as soon as its name is known
+    and its arguments are complete JSON, so tools run while the model is still generating the rest of the response.
+    accept(tool_call), if given, decides whether a complete call may run; calls it refuses are kept in rejected.
+    With eager=False calls are only started by finish(), once the response is complete.
+    """
+    def __init__(self, run, accept=None, eager: bool = True):
+        self.run = run
+        self.accept = accept
+        self.eager = eager
+        self.partial = {}  # index -> tool call being assembled
+        self.running = {}  # index -> task of a started call
+        self.rejected = []
+        self.finished = set()  # Indices started or rejected, later deltas for them are ignored
+
+    def add(self, delta):
+        for tool_call_delta in delta.tool_calls or []:
+            if tool_call_delta.index not in self.finished:  # Started or rejected calls are complete
+                merge_tool_call_delta(self.partial, tool_call_delta)
+        if self.eager:
+            for index, tool_call in list(self.partial.items()):
+                if tool_call["function"]["name"] and arguments_complete(tool_call["function"]["arguments"]):
+                    self._start(index)
+
+    def _start(self, index):
+        tool_call = self.partial.pop(index)
+        self.finished.add(index)
+        if self.accept is not None and not self.accept(tool_call):
+            self.rejected.append(tool_call)
+            return
+        self.running[index] = (tool_call, asyncio.ensure_future(self.run(tool_call)))
+
+    def finish(self):
+        """
+        Starts the calls that are still incomplete, so their errors are reported to the model,
+        and returns the started tool calls and their tasks in the order the model issued them.
+        """
+        for index in list(self.partial):
+            self._start(index)
+        ordered = [self.running[index] for index in sorted(self.running)]
+        return [tool_call for tool_call, _ in ordered], [task for _, task in ordered]
+
+    def cancel(self):
+        for _, task in self.running.values():
+            task.cancel()
@@ -0,0 +1,62 @@
+import json
+
+# JSON schema types checked in tool arguments; other types and constraints are left to the tool
+JSON_TYPES = {
+    "string": str,
+    "integer": int,
+    "number": (int, float),
+    "boolean": bool,
+    "array": list,
+    "object": dict,
+    "null": type(None),
+}
+
+
+def type_matches(value, expected) -> bool:
+    expected = expected if isinstance(expected, list) else [expected]
+    for name in expected:
+        python_type = JSON_TYPES.get(name)
+        if python_type is None:
+            return True  # Unknown type, do not reject
+        if isinstance(value, bool) and name in ("integer", "number"):
+            continue  # bool is an int in Python but not in JSON
+        if isinstance(value, python_type):
+            return True
+    return False
+
+
+def argument_errors(arguments: str, schema: dict) -> list[str]:
+    """Problems with a tool call's JSON arguments against the top level of the tool's input schema."""
+    try:
+        values = json.loads(arguments or "{}")
+    except ValueError as e:
+        return [f"arguments are not valid JSON ({e})"]
+    if not isinstance(values, dict):
+        return ["arguments are not a JSON object"]
+    schema = schema or {}
+    properties = schema.get("properties") or {}
+    errors = [f"missing required argument '{key}'" for key in schema.get("required") or [] if key not in values]
+    for key, value in values.items():
+        spec = properties.get(key)
+        if spec is None:
+            if schema.get("additionalProperties") is False:
+                errors.append(f"unknown argument '{key}'")
+        elif "type" in spec and not type_matches(value, spec["type"]):
+            errors.append(f"argument '{key}' should be of type {spec['type']}")
+    return errors
+
+
+def invalid_tool_calls(tool_calls: list[dict], tools: list[dict]) -> list[str]:
+    """
+    Checks tool calls drafted by the tool model against the tools sent with the request.
+    Returns a description of every problem, an empty list if all calls can be run as they are.
+    """
+    schemas = {tool["function"]["name"]: tool["function"].get("parameters") for tool in tools}
+    errors = []
+    for tool_call in tool_calls:
+        name = tool_call["function"]["name"]
+        if name not in schemas:
+            errors.append(f"{name}: no such tool")
+            continue
+        errors.extend(f"{name}: {error}" for error in argument_errors(tool_call["function"]["arguments"], schemas[name]))
+    return errors
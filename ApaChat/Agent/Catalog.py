@@ -0,0 +1,82 @@
+import asyncio
+import json
+import os
+import threading
+import time
+
+CATALOG_PATH = os.path.join(os.path.expanduser("~"), ".cache", "ApaChat", "catalog.json")
+
+
+def tool_entry(tool) -> dict:
+    """Serializable description of an MCP tool, as kept in Agent.mcp and in the catalog."""
+    annotations = getattr(tool, "annotations", None)
+    if annotations is not None and hasattr(annotations, "model_dump"):
+        annotations = annotations.model_dump(exclude_none=True)
+    return {
+        "name": tool.name,
+        "description": tool.description,
+        # mcp 2 renamed the field to snake_case
+        "input_schema": getattr(tool, "inputSchema", None) or getattr(tool, "input_schema", None),
+        "annotations": annotations or None,
+    }
+
+
+class Catalog:
+    """
+    Local cache of MCP tool lists keyed by server URL and of model lists keyed by provider base URL,
+    so the last known tools and models can be shown at startup while they are fetched again.
+    Written to a JSON file in a worker thread, replacing it atomically.
+    """
+    def __init__(self, path: str = CATALOG_PATH):
+        self.path = path
+        self.data = None
+        self._lock = threading.Lock()
+
+    def _load(self) -> dict:
+        if self.data is None:
+            self.data = {}
+            if self.path:
+                try:
+                    with open(self.path, "r", encoding="utf-8") as f:
+                        self.data = json.load(f)
+                except (OSError, ValueError):
+                    pass
+            self.data.setdefault("tools", {})
+            self.data.setdefault("models", {})
+        return self.data
+
+    def tools(self, server_url: str):
+        """Cached tool entries of a server, without active flags, or None if it was never listed."""
+        entry = self._load()["tools"].get(server_url)
+        return None if entry is None else [dict(tool) for tool in entry["tools"]]
+
+    def models(self, base_url: str):
+        """Cached model names of a provider, or None."""
+        entry = self._load()["models"].get(base_url or "")
+        return None if entry is None else list(entry["models"])
+
+    async def put_tools(self, server_url: str, tools: list[dict]):
+        tools = [{key: value for key, value in tool.items() if key != "active"} for tool in tools]
+        if self.tools(server_url) != tools:
+            self.data["tools"][server_url] = {"fetched": time.time(), "tools": tools}
+            await self.save()
+
+    async def put_models(self, base_url: str, models: list[str]):
+        if self.models(base_url) != list(models):
+            self._load()["models"][base_url or ""] = {"fetched": time.time(), "models": list(models)}
+            await self.save()
+
+    async def save(self):
+        if self.path:
+            await asyncio.to_thread(self._write, json.dumps(self._load()))
+
+    def _write(self, text: str):
+        with self._lock:
+            try:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                temp = f"{self.path}.{os.getpid()}.tmp"
+                with open(temp, "w", encoding="utf-8") as f:
+                    f.write(text)
+                os.replace(temp, self.path)
+            except OSError as e:
+                print(f"Could not write the tool and model catalog: {e}")
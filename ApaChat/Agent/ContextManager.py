@@ -0,0 +1,183 @@
+import asyncio
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Tokens of conversation history (excluding the system prompt) sent with each request
+CONTEXT_TOKEN_BUDGET = 12000
+# Older turns are summarized once the history grows past this fraction of the budget
+SUMMARIZE_AT = 0.8
+# Fraction of the budget left as verbatim recent turns after summarizing
+KEEP_AFTER_SUMMARY = 0.5
+SUMMARY_MAX_TOKENS = 500
+# Approximate per-message overhead of the chat format
+MESSAGE_OVERHEAD = 4
+
+SUMMARY_PROMPT = (
+    "You maintain a running summary of a conversation between a user and an assistant that can call tools. "
+    "Update the existing summary with the new messages. Keep facts, decisions, open questions and tool results "
+    "that may matter later. Answer with the summary only."
+)
+
+
+def count_tokens(text: str) -> int:
+    """
+    Number of tokens in text, using tiktoken if it is installed and ~4 characters per token otherwise.
+    """
+    if not text:
+        return 0
+    encoding = get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return len(text) // 4 + 1
+
+
+_encoding = None
+
+
+def get_encoding():
+    """The tiktoken encoding, loaded on first use since loading it is slow. None if tiktoken is unavailable."""
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            _encoding = False
+    return _encoding or None
+
+
+def estimate_tokens(message: dict) -> int:
+    """Estimated prompt tokens of a chat message, including tool calls."""
+    tokens = MESSAGE_OVERHEAD
+    content = message.get("content")
+    if isinstance(content, str):
+        tokens += count_tokens(content)
+    elif content:
+        tokens += count_tokens(json.dumps(content, default=str))
+    if message.get("tool_calls"):
+        tokens += count_tokens(json.dumps(message["tool_calls"], default=str))
+    return tokens
+
+
+class ContextManager:
+    """
+    Keeps the messages sent to the LLM within a token budget.
+    Recent turns are sent verbatim, older ones are folded into a rolling summary by a background task
+    so summarizing never delays the current turn.
+    """
+    def __init__(self, token_budget: int = CONTEXT_TOKEN_BUDGET):
+        self.token_budget = token_budget
+        self.summary = ""
+        self.last_request_tokens = 0  # Prompt tokens of the last request, from the provider when it reports them
+        self.request_tokens = []  # Prompt tokens of every request, in order
+        self.on_fold = None  # Called with the number of messages dropped from the front of the history
+        self._summary_task = None
+
+    def messages_for_request(self, history: list[dict], tools: list = None) -> list[dict]:
+        """
+        Builds the messages for the next request: the system prompt, the summary of folded turns and
+        as many recent messages as fit into the budget. Records the estimated size of the request.
+        """
+        system, rest = history[:1], history[1:]
+        used = 0
+        start = len(rest)
+        while start > 0:
+            cost = estimate_tokens(rest[start - 1])
+            if used + cost > self.token_budget and start < len(rest):
+                break
+            used += cost
+            start -= 1
+        # Never start with tool results whose assistant message was cut off
+        while start < len(rest) - 1 and rest[start].get("role") == "tool":
+            start += 1
+        messages = system + self._summary_messages() + rest[start:]
+        self.record_request(sum(estimate_tokens(msg) for msg in messages) + (count_tokens(json.dumps(tools)) if tools else 0))
+        return messages
+
+    def record_request(self, tokens: int):
+        self.last_request_tokens = tokens
+        self.request_tokens.append(tokens)
+        logger.info(f"Request sent ~{tokens} prompt tokens")
+
+    def record_usage(self, usage):
+        """Replaces the estimate of the last request with the prompt tokens reported by the provider."""
+        prompt_tokens = getattr(usage, "prompt_tokens", None)
+        if prompt_tokens and self.request_tokens:
+            self.last_request_tokens = prompt_tokens
+            self.request_tokens[-1] = prompt_tokens
+
+    def history_tokens(self, history: list[dict]) -> int:
+        return sum(estimate_tokens(msg) for msg in history[1:])
+
+    def schedule_summary(self, history: list[dict], llm):
+        """
+        Starts folding the oldest turns into the summary in the background once the history
+        is over SUMMARIZE_AT of the budget. Does nothing if a summary is already being produced.
+        """
+        if llm is None or (self._summary_task and not self._summary_task.done()):
+            return None
+        if self.history_tokens(history) <= self.token_budget * SUMMARIZE_AT:
+            return None
+        folded = self._turns_to_fold(history)
+        if not folded:
+            return None
+        self._summary_task = asyncio.get_running_loop().create_task(self._summarize(history, folded, llm))
+        return self._summary_task
+
+    def _turns_to_fold(self, history: list[dict]) -> list[dict]:
+        # Fold whole turns from the front until the rest fits KEEP_AFTER_SUMMARY, always keeping the latest turn
+        rest = history[1:]
+        turn_starts = [index for index, msg in enumerate(rest) if msg.get("role") == "user"]
+        remaining = self.history_tokens(history)
+        cut = 0
+        for start in turn_starts[1:]:
+            remaining -= sum(estimate_tokens(msg) for msg in rest[cut:start])
+            cut = start
+            if remaining <= self.token_budget * KEEP_AFTER_SUMMARY:
+                break
+        return rest[:cut]
+
+    async def _summarize(self, history: list[dict], folded: list[dict], llm):
+        transcript = "\n".join(f"{msg.get('role')}: {summary_text(msg)}" for msg in folded)
+        prompt = f"Existing summary:\n{self.summary or '(none)'}\n\nNew messages:\n{transcript}"
+        try:
+            response = await llm.chat_completion(
+                messages=[{"role": "system", "content": SUMMARY_PROMPT}, {"role": "user", "content": prompt}],
+                temperature=0,
+                max_tokens=SUMMARY_MAX_TOKENS,
+                tools=[]
+            )
+            summary = response.choices[0].message.content
+        except Exception as e:
+            logger.error(f"Summarizing the conversation failed: {e}")
+            return
+        if not summary:
+            return
+        # Drop the folded messages if they are still at the front of the history
+        if all(a is b for a, b in zip(history[1:1 + len(folded)], folded)) and len(history) > len(folded):
+            del history[1:1 + len(folded)]
+            self.summary = summary.strip()
+            logger.info(f"Folded {len(folded)} messages into the conversation summary")
+            if self.on_fold is not None:
+                self.on_fold(len(folded))
+
+    def _summary_messages(self) -> list[dict]:
+        if not self.summary:
+            return []
+        return [{"role": "system", "content": f"Summary of the earlier conversation:\n{self.summary}"}]
+
+    def reset(self):
+        if self._summary_task and not self._summary_task.done():
+            self._summary_task.cancel()
+        self.summary = ""
+
+
+def summary_text(message: dict, limit: int = 2000) -> str:
+    """Text of a message for the summarizer, with tool calls spelled out and long content cut."""
+    text = message.get("content") if isinstance(message.get("content"), str) else ""
+    for call in message.get("tool_calls") or []:
+        function = call.get("function", {}) if isinstance(call, dict) else {}
+        text += f" [calls {function.get('name')}({function.get('arguments')})]"
+    return text if len(text) <= limit else text[:limit] + " ..."
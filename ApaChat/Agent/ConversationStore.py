@@ -0,0 +1,320 @@
+import asyncio
+import json
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+
+from .ContextManager import estimate_tokens
+
+CONVERSATIONS_PATH = os.path.join(os.path.expanduser("~"), ".local", "share", "ApaChat", "conversations.db")
+# Characters of the first user message used as the title of a conversation
+TITLE_CHARS = 80
+# Messages added to the search index per transaction, and characters of a message that are indexed
+SEARCH_INDEX_BATCH = 500
+SEARCH_MAX_CHARS = 20000
+SNIPPET_TOKENS = 16
+# Only the newest this many matches are ranked, so queries matching most messages stay fast
+SEARCH_RANK_WINDOW = 2000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    id TEXT PRIMARY KEY,
+    title TEXT,
+    system_prompt TEXT,
+    summary TEXT,
+    folded INTEGER NOT NULL DEFAULT 0,
+    created REAL,
+    updated REAL
+);
+CREATE INDEX IF NOT EXISTS conversations_updated ON conversations (updated);
+CREATE TABLE IF NOT EXISTS messages (
+    conversation_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    role TEXT,
+    data TEXT NOT NULL,
+    created REAL,
+    UNIQUE (conversation_id, seq)
+);
+CREATE TABLE IF NOT EXISTS transcript (
+    conversation_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    sender TEXT,
+    text TEXT,
+    created REAL,
+    UNIQUE (conversation_id, position)
+);
+"""
+
+# Full-text index of the messages, by their rowid, filled in the background up to search_state.indexed
+SEARCH_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS message_search USING fts5(text, tokenize = 'porter unicode61');
+CREATE TABLE IF NOT EXISTS search_state (id INTEGER PRIMARY KEY CHECK (id = 1), indexed INTEGER NOT NULL);
+"""
+
+
+def connect(path: str) -> sqlite3.Connection:
+    if path != ":memory:":
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")  # Durable at checkpoints, WAL keeps the database consistent
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def enable_search(conn) -> bool:
+    """Creates the search index, returns False if this SQLite build has no FTS5."""
+    try:
+        conn.executescript(SEARCH_SCHEMA)
+        return True
+    except sqlite3.OperationalError as e:
+        print(f"Conversation search disabled: {e}")
+        return False
+
+
+def search_text(message: dict) -> str:
+    """Text of a message as indexed: its content and the names and arguments of its tool calls."""
+    content = message.get("content")
+    text = content if isinstance(content, str) else json.dumps(content, default=str) if content else ""
+    for call in message.get("tool_calls") or []:
+        function = call.get("function", {}) if isinstance(call, dict) else {}
+        text += f" {function.get('name', '')} {function.get('arguments', '')}"
+    return text[:SEARCH_MAX_CHARS]
+
+
+def fts_query(text: str) -> str:
+    """FTS5 query matching messages that contain every word of text, the last one as a prefix as it may be unfinished."""
+    words = re.findall(r"\w+", text.lower())
+    if not words:
+        return ""
+    return " ".join(f'"{word}"' for word in words) + "*"
+
+
+class ConversationStore:
+    """
+    Append-only SQLite (WAL) store of conversations: every history message of the Agent, the rolling summary
+    that replaced folded turns, and the transcript shown in the chat window.
+    Writes never block the caller, they are queued and committed in batches by a writer thread.
+    Whenever it has nothing to write, the same thread adds new messages to a full-text index, so search()
+    covers every stored conversation, including those stored before the index existed.
+    Reads go through their own connection in a worker thread and only load what is asked for: the tail of the
+    history that fits the context window, or one page of the transcript.
+    """
+    def __init__(self, path: str = CONVERSATIONS_PATH):
+        self.path = path
+        self.stats = {"writes": 0, "commits": 0, "indexed": 0}
+        self._queue = queue.Queue()
+        self._writer = None
+        self._reader = None
+        self._searchable = False
+        self._lock = threading.Lock()  # Guards the reader connection and starting the writer
+
+    # Writes, callable from any thread
+
+    def start(self):
+        """Starts the writer thread, which also catches up on indexing. Done by the first write or search."""
+        with self._lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_forever, name="ConversationStore", daemon=True)
+                self._writer.start()
+
+    def _put(self, sql: str, params: tuple):
+        self.start()
+        self._queue.put((sql, params))
+
+    def create(self, conversation_id: str, system_prompt: str = None):
+        now = time.time()
+        self._put("INSERT OR IGNORE INTO conversations (id, system_prompt, created, updated) VALUES (?, ?, ?, ?)",
+                  (conversation_id, system_prompt, now, now))
+
+    def append_message(self, conversation_id: str, seq: int, message: dict):
+        now = time.time()
+        self._put("INSERT OR REPLACE INTO messages (conversation_id, seq, role, data, created) VALUES (?, ?, ?, ?, ?)",
+                  (conversation_id, seq, message.get("role"), json.dumps(message, default=str), now))
+        title = message["content"][:TITLE_CHARS] if message.get("role") == "user" and isinstance(message.get("content"), str) else None
+        self._put("UPDATE conversations SET updated = ?, title = COALESCE(title, ?) WHERE id = ?", (now, title, conversation_id))
+
+    def set_summary(self, conversation_id: str, summary: str, folded: int):
+        """Records the summary that replaced the history messages up to seq folded."""
+        self._put("UPDATE conversations SET summary = ?, folded = ? WHERE id = ?", (summary, folded, conversation_id))
+
+    def append_transcript(self, conversation_id: str, position: int, sender: str, text: str):
+        self._put("INSERT OR REPLACE INTO transcript (conversation_id, position, sender, text, created) VALUES (?, ?, ?, ?, ?)",
+                  (conversation_id, position, sender, text, time.time()))
+
+    def _write_forever(self):
+        conn = connect(self.path)
+        searchable = backlog = enable_search(conn)
+        while True:
+            try:
+                # Index only while there is nothing to write, writes never wait for more than one index batch
+                batch = [self._queue.get(block=not backlog)]
+            except queue.Empty:
+                try:
+                    backlog = self._index(conn)
+                except sqlite3.Error as e:
+                    print(f"Could not index conversations: {e}")
+                    if conn.in_transaction:
+                        conn.execute("ROLLBACK")
+                    backlog = False
+                continue
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            done = []
+            try:
+                conn.execute("BEGIN")
+                for item in batch:
+                    if isinstance(item, threading.Event):
+                        done.append(item)
+                    elif item is not None:
+                        conn.execute(*item)
+                        self.stats["writes"] += 1
+                conn.execute("COMMIT")
+                self.stats["commits"] += 1
+            except sqlite3.Error as e:
+                print(f"Could not save conversation: {e}")
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+            for event in done:
+                event.set()
+            if None in batch:
+                conn.close()
+                return
+            backlog = searchable
+
+    def _index(self, conn) -> bool:
+        """Adds the next batch of messages to the search index. Returns whether more are waiting."""
+        row = conn.execute("SELECT indexed FROM search_state WHERE id = 1").fetchone()
+        rows = conn.execute("SELECT rowid, data FROM messages WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                            (row[0] if row else 0, SEARCH_INDEX_BATCH)).fetchall()
+        if not rows:
+            return False
+        conn.execute("BEGIN")
+        conn.executemany("INSERT OR REPLACE INTO message_search (rowid, text) VALUES (?, ?)",
+                         [(rowid, search_text(json.loads(data))) for rowid, data in rows])
+        conn.execute("INSERT OR REPLACE INTO search_state (id, indexed) VALUES (1, ?)", (rows[-1][0],))
+        conn.execute("COMMIT")
+        self.stats["indexed"] += len(rows)
+        return len(rows) == SEARCH_INDEX_BATCH
+
+    async def flush(self):
+        """Waits until everything written so far is committed."""
+        if self._writer is None:
+            return
+        event = threading.Event()
+        self._queue.put(event)
+        await asyncio.to_thread(event.wait)
+
+    async def close(self):
+        await self.flush()
+        if self._writer is not None:
+            self._queue.put(None)
+            await asyncio.to_thread(self._writer.join)
+            self._writer = None
+        with self._lock:
+            if self._reader is not None:
+                self._reader.close()
+                self._reader = None
+
+    # Reads, run in a worker thread
+
+    async def _read(self, query, *args):
+        await self.flush()  # Read our own writes
+        return await asyncio.to_thread(self._run_read, query, *args)
+
+    def _run_read(self, query, *args):
+        with self._lock:
+            if self._reader is None:
+                self._reader = connect(self.path)
+                self._searchable = enable_search(self._reader)
+            return query(self._reader, *args)
+
+    async def conversations(self, limit: int = 50) -> list[dict]:
+        """Most recently updated conversations, newest first."""
+        return await self._read(_conversations, limit)
+
+    async def load_tail(self, conversation_id: str, token_budget: int):
+        """
+        The system prompt, summary and the newest messages after the summary that fit into token_budget,
+        with the seq of the first loaded message and the next seq. None if the conversation does not exist.
+        """
+        return await self._read(_load_tail, conversation_id, token_budget)
+
+    async def search(self, text: str, limit: int = 20, conversation_id: str = None) -> list[dict]:
+        """
+        Messages of all conversations (or of one) containing every word of text, best match first, with a
+        snippet around the matches. Messages appended in the last moments may not be indexed yet.
+        """
+        self.start()
+        return await asyncio.to_thread(self._run_read, self._search, text, limit, conversation_id)
+
+    def _search(self, conn, text, limit, conversation_id):
+        query = fts_query(text)
+        if not query or not self._searchable:
+            return []
+        # Rank inside the index first, then look up only the messages that made the cut
+        where, params = "message_search MATCH ?", [query]
+        if conversation_id is not None:
+            where += " AND rowid IN (SELECT rowid FROM messages WHERE conversation_id = ?)"
+            params.append(conversation_id)
+        else:
+            cutoff = conn.execute("SELECT rowid FROM message_search WHERE message_search MATCH ? ORDER BY rowid DESC "
+                                  "LIMIT 1 OFFSET ?", (query, SEARCH_RANK_WINDOW - 1)).fetchone()
+            if cutoff is not None:
+                where += " AND rowid >= ?"
+                params.append(cutoff[0])
+        sql = ("SELECT m.conversation_id, m.seq, m.role, c.title, m.created, s.snippet FROM ("
+               f"SELECT rowid, snippet(message_search, 0, '[', ']', ' ... ', {SNIPPET_TOKENS}) AS snippet, rank "
+               f"FROM message_search WHERE {where} ORDER BY rank LIMIT ?) AS s "
+               "JOIN messages m ON m.rowid = s.rowid LEFT JOIN conversations c ON c.id = m.conversation_id ORDER BY s.rank")
+        params.append(limit)
+        return [{"conversation_id": conversation_id, "seq": seq, "role": role, "title": title or "(empty)",
+                 "created": created, "snippet": snippet}
+                for conversation_id, seq, role, title, created, snippet in conn.execute(sql, params)]
+
+    async def transcript_page(self, conversation_id: str, before: int = None, count: int = 25) -> list[tuple]:
+        """Up to count transcript entries (position, sender, text) before position before, oldest first."""
+        return await self._read(_transcript_page, conversation_id, before, count)
+
+
+def _conversations(conn, limit):
+    rows = conn.execute("SELECT id, title, updated FROM conversations ORDER BY updated DESC LIMIT ?", (limit,))
+    return [{"id": id, "title": title or "(empty)", "updated": updated} for id, title, updated in rows]
+
+
+def _load_tail(conn, conversation_id, token_budget):
+    row = conn.execute("SELECT system_prompt, summary, folded FROM conversations WHERE id = ?", (conversation_id,)).fetchone()
+    if row is None:
+        return None
+    system_prompt, summary, folded = row
+    last = conn.execute("SELECT MAX(seq) FROM messages WHERE conversation_id = ?", (conversation_id,)).fetchone()[0] or 0
+    messages = []
+    used = 0
+    start = last + 1
+    rows = conn.execute("SELECT seq, data FROM messages WHERE conversation_id = ? AND seq > ? ORDER BY seq DESC",
+                        (conversation_id, folded))
+    for seq, data in rows:
+        message = json.loads(data)
+        used += estimate_tokens(message)
+        if used > token_budget and messages:
+            break
+        messages.append(message)
+        start = seq
+    messages.reverse()
+    return {"system_prompt": system_prompt, "summary": summary or "", "messages": messages,
+            "start_seq": start, "next_seq": last + 1}
+
+
+def _transcript_page(conn, conversation_id, before, count):
+    if before is None:
+        before = conn.execute("SELECT COALESCE(MAX(position), -1) + 1 FROM transcript WHERE conversation_id = ?",
+                              (conversation_id,)).fetchone()[0]
+    rows = conn.execute("SELECT position, sender, text FROM transcript WHERE conversation_id = ? AND position < ? "
+                        "ORDER BY position DESC LIMIT ?", (conversation_id, before, count)).fetchall()
+    return rows[::-1]
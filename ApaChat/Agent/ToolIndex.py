@@ -0,0 +1,117 @@
+import math
+import re
+from collections import Counter
+
+_WORD = re.compile(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|\d+")
+# Common words that would otherwise match almost every tool description
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "can", "do", "for", "from", "how", "i", "in", "is", "it",
+    "me", "my", "of", "on", "or", "please", "the", "this", "to", "what", "with", "you", "your",
+}
+
+
+def tokenize(text: str, stopwords=STOPWORDS) -> list[str]:
+    """
+    Splits text into lowercase terms, breaking on punctuation, underscores and camelCase, without stopwords.
+    """
+    if not text:
+        return []
+    return [term for term in (word.lower() for word in _WORD.findall(text)) if term not in stopwords]
+
+
+def tool_terms(tool: dict) -> list[str]:
+    """
+    Terms indexed for a tool: its name, description and parameter names.
+    """
+    terms = tokenize(tool.get("name", "")) * 2  # Name matches count double
+    terms += tokenize(tool.get("description") or "")
+    schema = tool.get("input_schema") or {}
+    for param, spec in (schema.get("properties") or {}).items():
+        terms += tokenize(param)
+        if isinstance(spec, dict):
+            terms += tokenize(spec.get("description") or "")
+    return terms
+
+
+class ToolIndex:
+    """
+    In-process BM25 index over the tools of all connected MCP servers.
+    Tools are keyed by the name sent to the LLM (server_toolname).
+    """
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.docs = {}  # key -> Counter of terms
+        self.servers = {}  # server -> keys of its tools
+        self.df = Counter()
+        self.total_length = 0
+
+    def __len__(self):
+        return len(self.docs)
+
+    def add_server(self, server: str, tools: list[dict]):
+        """(Re)indexes all tools of a server, replacing whatever was indexed for it before."""
+        self.remove_server(server)
+        keys = []
+        for tool in tools:
+            key = f"{server}_{tool['name']}"
+            self._add(key, tool)
+            keys.append(key)
+        self.servers[server] = keys
+
+    def update_tools(self, server: str, tools: list[dict], removed: list[str] = ()):
+        """Re-indexes only the given tools of a server and drops the removed ones."""
+        keys = self.servers.setdefault(server, [])
+        for name in [tool["name"] for tool in tools] + list(removed):
+            key = f"{server}_{name}"
+            self._remove(key)
+            if key in keys:
+                keys.remove(key)
+        for tool in tools:
+            key = f"{server}_{tool['name']}"
+            self._add(key, tool)
+            keys.append(key)
+        self.df += Counter()
+
+    def _add(self, key: str, tool: dict):
+        terms = Counter(tool_terms(tool))
+        self.docs[key] = terms
+        self.df.update(terms.keys())
+        self.total_length += sum(terms.values())
+
+    def _remove(self, key: str):
+        terms = self.docs.pop(key, None)
+        if terms is not None:
+            self.df.subtract(terms.keys())
+            self.total_length -= sum(terms.values())
+
+    def remove_server(self, server: str):
+        for key in self.servers.pop(server, []):
+            self._remove(key)
+        self.df += Counter()  # Drop terms that no longer occur
+
+    def search(self, query: str, candidates=None, k: int = None) -> list[tuple[str, float]]:
+        """
+        Returns (key, score) pairs for tools matching the query, best first.
+        Only keys in candidates are considered if given, tools without any matching term are left out.
+        """
+        terms = set(tokenize(query))
+        if not terms or not self.docs:
+            return []
+        keys = self.docs.keys() if candidates is None else [key for key in candidates if key in self.docs]
+        n = len(self.docs)
+        avg_length = self.total_length / n or 1
+        idf = {term: math.log(1 + (n - self.df[term] + 0.5) / (self.df[term] + 0.5)) for term in terms if self.df[term]}
+        scores = []
+        for key in keys:
+            doc = self.docs[key]
+            length = sum(doc.values())
+            score = 0.0
+            for term, weight in idf.items():
+                freq = doc.get(term, 0)
+                if freq:
+                    score += weight * freq * (self.k1 + 1) / (freq + self.k1 * (1 - self.b + self.b * length / avg_length))
+            if score > 0:
+                scores.append((key, score))
+        scores.sort(key=lambda item: item[1], reverse=True)
+        return scores[:k] if k else scores
@@ -0,0 +1,161 @@
+import base64
+import mimetypes
+import os
+import shutil
+import tempfile
+import uuid
+
+# Characters of a tool result forwarded to the LLM, the rest is kept in the spill store
+TOOL_RESULT_MAX_CHARS = 8000
+SPILL_DIR = os.path.join(tempfile.gettempdir(), "ApaChat", "tool_results")
+
+READ_TOOL_RESULT = "read_tool_result"
+READ_TOOL_RESULT_SCHEMA = {
+    "type": "function",
+    "function": {
+        "name": READ_TOOL_RESULT,
+        "description": "Reads more of a tool result that was too large to show in full. "
+                       "Pass the handle from the truncated result and the character offset to continue from.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "handle": {"type": "string", "description": "Handle of the stored tool result"},
+                "offset": {"type": "integer", "description": "Character offset to start reading at"},
+                "length": {"type": "integer", "description": "Number of characters to read"}
+            },
+            "required": ["handle"]
+        }
+    }
+}
+
+
+def mime_type(part):
+    """MIME type of a content part, spelled mimeType before mcp 2 and mime_type since."""
+    return getattr(part, "mimeType", None) or getattr(part, "mime_type", None)
+
+
+class ToolOutput(str):
+    """Tool result text as sent to the LLM, remembering whether the tool reported an error."""
+    isError = False
+
+    def __new__(cls, text: str, is_error: bool = False):
+        output = super().__new__(cls, text)
+        output.isError = is_error
+        return output
+
+
+class ToolResultStore:
+    """
+    Turns MCP CallToolResults into size-bounded text for the LLM.
+    Text beyond max_chars and all binary content are written to a local spill directory
+    and can be paged through with the read_tool_result tool.
+    """
+    def __init__(self, directory: str = SPILL_DIR, max_chars: int = TOOL_RESULT_MAX_CHARS):
+        self.directory = os.path.join(directory, uuid.uuid4().hex[:8])
+        self.max_chars = max_chars
+        self.handles = {}  # handle -> {"path", "chars", "mime_type", "bytes"}
+
+    def process(self, tool_name: str, result) -> ToolOutput:
+        """Builds the LLM-facing output of a tool call without materializing the result's repr."""
+        if not result:
+            return ToolOutput(f"Tool '{tool_name}' execution returned no result")
+        texts, notes = [], []
+        for part in getattr(result, "content", None) or []:
+            kind = getattr(part, "type", None)
+            if kind == "text":
+                texts.append(part.text)
+            elif kind in ("image", "audio"):
+                notes.append(self._spill_binary(part.data, mime_type(part)))
+            elif kind == "resource":
+                resource = part.resource
+                if getattr(resource, "text", None) is not None:
+                    texts.append(resource.text)
+                elif getattr(resource, "blob", None) is not None:
+                    notes.append(self._spill_binary(resource.blob, mime_type(resource), str(resource.uri)))
+            elif kind == "resource_link":
+                texts.append(f"[Resource link: {part.uri}]")
+        structured = getattr(result, "structuredContent", getattr(result, "structured_content", None))
+        if not texts and structured is not None:
+            texts.append(str(structured))
+
+        total = sum(len(text) for text in texts) + max(len(texts) - 1, 0)
+        if total <= self.max_chars:
+            body = "\n".join(texts)
+        else:
+            handle = self._spill_text(texts, total)
+            body = self._read(handle, 0, self.max_chars)
+            notes.append(f"[Result truncated: showing {self.max_chars} of {total} characters. "
+                         f"Call {READ_TOOL_RESULT} with handle '{handle}' and offset {self.max_chars} to read more.]")
+        if notes:
+            body = "\n".join([body] + notes) if body else "\n".join(notes)
+        is_error = bool(getattr(result, "isError", False) or getattr(result, "is_error", False))
+        status = "failed" if is_error else "executed successfully"
+        return ToolOutput(f"Tool '{tool_name}' {status} with result: {body}", is_error)
+
+    def read(self, handle: str, offset: int = 0, length: int = None) -> ToolOutput:
+        """Returns a page of a stored result, for the read_tool_result tool."""
+        entry = self.handles.get(handle)
+        if entry is None:
+            return ToolOutput(f"No stored tool result with handle '{handle}'", True)
+        if entry["mime_type"]:
+            return ToolOutput(f"Handle '{handle}' is binary content ({entry['mime_type']}, {entry['bytes']} bytes) "
+                              f"and cannot be read as text", True)
+        offset = max(int(offset or 0), 0)
+        length = min(int(length or self.max_chars), self.max_chars)
+        page = self._read(handle, offset, length)
+        end = offset + len(page)
+        return ToolOutput(f"{page}\n[Characters {offset}-{end} of {entry['chars']}, {max(entry['chars'] - end, 0)} remaining.]")
+
+    def _read(self, handle: str, offset: int, length: int) -> str:
+        with open(self.handles[handle]["path"], "r", encoding="utf-8", newline="") as f:
+            while offset > 0:  # Skip in chunks so large results are never read whole
+                skipped = len(f.read(min(offset, 1 << 20)))
+                if not skipped:
+                    break
+                offset -= skipped
+            return f.read(length)
+
+    def readable(self) -> bool:
+        """Whether a text result can be paged through with read_tool_result."""
+        return any(entry["mime_type"] is None for entry in self.handles.values())
+
+    def retain(self, texts):
+        """Deletes the stored results whose handle appears in none of texts, the model can no longer ask for them."""
+        texts = list(texts)
+        for handle in [handle for handle in self.handles if not any(handle in text for text in texts)]:
+            entry = self.handles.pop(handle)
+            try:
+                os.remove(entry["path"])
+            except OSError:
+                pass
+
+    def clear(self):
+        """Deletes every stored result, for when the conversation they belong to is closed or replaced."""
+        self.handles = {}
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _new_handle(self) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        return uuid.uuid4().hex[:12]
+
+    def _spill_text(self, texts: list[str], chars: int) -> str:
+        handle = self._new_handle()
+        path = os.path.join(self.directory, f"{handle}.txt")
+        with open(path, "w", encoding="utf-8", newline="") as f:
+            for index, text in enumerate(texts):
+                if index:
+                    f.write("\n")
+                f.write(text)
+        self.handles[handle] = {"path": path, "chars": chars, "mime_type": None, "bytes": None}
+        return handle
+
+    def _spill_binary(self, data, mime_type: str = None, name: str = None) -> str:
+        handle = self._new_handle()
+        extension = mimetypes.guess_extension(mime_type or "") or ".bin"
+        path = os.path.join(self.directory, f"{handle}{extension}")
+        raw = base64.b64decode(data) if isinstance(data, str) else data
+        with open(path, "wb") as f:
+            f.write(raw)
+        self.handles[handle] = {"path": path, "chars": 0, "mime_type": mime_type or "application/octet-stream", "bytes": len(raw)}
+        label = f" {name}" if name else ""
+        return f"[Binary content{label} ({mime_type or 'unknown type'}, {len(raw)} bytes) stored with handle '{handle}', not shown]"
@@ -2,12 +2,18 @@ import tkinter as tk
 from tkinter import messagebox
 import tkinter.ttk as ttk
 import asyncio
+import datetime
+import time
 from ..Agent.Agent import Agent
 from ..Agent.Agent import url_to_name
+from ..Agent.ConversationStore import ConversationStore
 from ..LLM.LLM import available_LLM_providers
+from .ChatRenderer import ChatRenderer, CHAT_PAGE_SIZE
+from .LoopHost import LoopHost
+from .CredentialStore import CredentialStore, load_keyring
+from .ToolPicker import ToolPicker, ToolSearch
 
 from tkhtmlview import HTMLScrolledText
-from markdown import markdown
 import getpass
 
 
@@ -15,17 +21,18 @@ import getpass
 
 
 
-try:
-    import keyring
-except ImportError:
-    keyring = None
-    print("Keyring module not available, credentials saving disabled")
-import json
+
+# Minimum seconds between re-renders of a streaming reply (~30 fps)
+STREAM_FRAME_BUDGET = 1 / 30
+# Transport choices of the MCP dialog, stdio servers are given as the command that starts them
+MCP_TRANSPORTS = {"SSE": "sse", "Streamable HTTP": "streamable-http", "stdio": "stdio"}
+# Pause in typing after which the conversation search runs
+SEARCH_DELAY_MS = 200
 
 class AsyncTk(tk.Tk):
-    def __init__(self, agent):
+    def __init__(self, agent, started: float = None):
         super().__init__()
-        self._credential_cache = {}
+        self.started = started if started is not None else time.perf_counter()
         self.user=getpass.getuser()
 
         self.agent = agent
@@ -41,7 +48,7 @@ class AsyncTk(tk.Tk):
 
         self.chat_display.config(state="disabled")  # Make chat display read-only
 
-        self.chat_history_html = ""
+        self.chat_renderer = ChatRenderer(self.chat_display, load_page=self.load_transcript_page)
 
 
         self.entry = tk.Entry(self)
@@ -54,50 +61,43 @@ class AsyncTk(tk.Tk):
         self.conn_menu.add_command(label="Connect to LLM", command=self.open_llm_dialog)
         self.conn_menu.add_command(label="Configure MCP", command=self.open_mcp_dialog)
         self.menu.add_cascade(label="Connections", menu=self.conn_menu)
+        self.chat_menu = tk.Menu(self.menu, tearoff=0)
+        self.chat_menu.add_command(label="New conversation", command=lambda: self.host.submit(self.new_conversation()))
+        self.chat_menu.add_command(label="Open conversation...", command=self.open_conversation_dialog)
+        self.chat_menu.add_command(label="Search conversations...", command=self.open_search_dialog)
+        self.menu.add_cascade(label="Conversations", menu=self.chat_menu)
 
         self.protocol("WM_DELETE_WINDOW", self.on_close)
-        self.loop = asyncio.get_event_loop()
-        self.after(100, self.poll_loop)
+        self.host = LoopHost(self)
+        # Keyring and settings I/O runs on the loop's worker threads, never on the Tk thread
+        self.store = CredentialStore(self.user, self.host.loop)
+        # Every message is saved as it is produced, the last conversation is reopened at startup
+        self.conversations = ConversationStore()
+        self.agent.store = self.conversations
+        self.conversations.start()  # Indexes conversations stored before search existed in the background
+        self._tool_search = {}  # server name -> ToolSearch over the last shown snapshot of its tools
+        # Set once the saved LLM is connected (or failed to), queued messages wait for it
+        self.llm_ready = asyncio.Event()
+        # Replies are generated one at a time, in the order the messages were sent
+        self.turn_lock = asyncio.Lock()
 
         self.disable_ui()
-        self.after(0, lambda: asyncio.ensure_future(self.initialize_connections()))
+        self.host.submit(self.initialize_connections())
+        self.after_idle(self.report_interactive)
 
-    def get_cached_password(self, key):
-        # Check in-memory cache first
-        if self._credential_cache and key in self._credential_cache:
-            return self._credential_cache[key]
-        if keyring:
-            try:
-                data = keyring.get_password("ApaChat", self.user)
-                if data is None:
-                    return None
-                # Try to load JSON from keyring
-                self._credential_cache = json.loads(data)
+    def report_interactive(self):
+        print(f"Time to interactive: {time.perf_counter() - self.started:.2f}s")
 
-                return self._credential_cache.get(key)
-            except Exception as e:
-                print(f"Keyring error for {key}: {e}")
-                return None
-        return None
+    def get_cached_password(self, key):
+        # Served from memory, the keyring is read once at startup
+        return self.store.get(key)
 
     def set_cached_password(self, key, value):
-        if not keyring:
-            return
-        try:
-            # Load existing cache from keyring if not present
-            if not self._credential_cache:
-                data = keyring.get_password("ApaChat", self.user)
-                if data:
-                    self._credential_cache = json.loads(data)
-                else:
-                    self._credential_cache = {}
-            self._credential_cache[key] = value
-            keyring.set_password("ApaChat", self.user, json.dumps(self._credential_cache))
-        except Exception as e:
-            print(f"Failed to save {key} to keyring: {e}")
+        # Written to the keyring in the background, together with other changes made right after
+        self.store.set(key, value)
 
     def disable_ui(self):
-        self.entry.config(state='disabled')
+        # The entry stays usable, messages sent while connecting are queued
         self.conn_menu.entryconfig("Connect to LLM", state="disabled")
         self.conn_menu.entryconfig("Configure MCP", state="disabled")
 
@@ -109,11 +109,145 @@ class AsyncTk(tk.Tk):
 
     async def initialize_connections(self):
         try:
-            await self.auto_connect_saved()
+            await self.store.load()
+            # Opt-in in the settings file: "tool_cache": {"enabled": true, "ttl": 300, "tools": {"server_toolname": 60}}
+            tool_cache = self.store.get_setting("tool_cache", {})
+            if tool_cache.get("enabled"):
+                self.agent.configure_tool_cache(default_ttl=tool_cache.get("ttl"), ttls=tool_cache.get("tools"))
+            # The last conversation is read from disk while the saved connections are made
+            await asyncio.gather(self.resume_conversation(), self.auto_connect_saved())
         finally:
-            self.enable_ui()
+            self.llm_ready.set()
+            self.host.call_ui(self.enable_ui)
+            print(f"Saved connections ready after {time.perf_counter() - self.started:.2f}s")
+
+    async def resume_conversation(self, conversation_id=None):
+        """
+        Reopens a stored conversation, by default the most recent one, loading only the messages the
+        context window needs and the last page of the transcript. Starts a new conversation if there is none.
+        The most recent one is not reopened once a message was typed, that message started a new conversation.
+        """
+        async with self.turn_lock:
+            latest = conversation_id is None
+            if latest:
+                if await self.host.ui(len, self.chat_renderer):
+                    return
+                recent = await self.conversations.conversations(limit=1)
+                if not recent:
+                    self.agent.start_conversation()
+                    return
+                conversation_id = recent[0]["id"]
+            data = await self.agent.load_conversation(conversation_id)
+            if data is None:
+                self.agent.start_conversation()
+                return
+            page = await self.conversations.transcript_page(conversation_id, count=CHAT_PAGE_SIZE)
+            first = page[0][0] if page else 0
+            messages = [(sender, text) for _, sender, text in page]
+
+            def restore():
+                # Checked again on the Tk thread, a message may have been typed while reading
+                if latest and len(self.chat_renderer):
+                    return False
+                self.chat_renderer.restore(first, messages)
+                return True
+            # Input typed after restore() is handled on the loop after this, so it goes to the reopened conversation
+            if await self.host.ui(restore):
+                self.agent.continue_conversation(conversation_id, data)
+
+    async def new_conversation(self):
+        async with self.turn_lock:
+            self.agent.start_conversation()
+            await self.host.ui(self.chat_renderer.clear)
+
+    def load_transcript_page(self, before, count):
+        """Reads older transcript messages for the chat renderer, which is handed them on the Tk thread."""
+        conversation_id = self.agent.conversation_id
+
+        async def load():
+            page = await self.conversations.transcript_page(conversation_id, before, count)
+            self.host.call_ui(self.chat_renderer.prepend, [(sender, text) for _, sender, text in page])
+        self.host.submit(load())
+
+    def save_transcript(self, index, sender, text):
+        # On the loop thread, in order with the turns, so the conversation is created by its first message
+        self.host.call_loop(self.append_transcript, index, sender, text)
+
+    def append_transcript(self, index, sender, text):
+        self.conversations.append_transcript(self.agent.ensure_conversation(), index, sender, text)
+
+    def open_conversation_dialog(self):
+        win = tk.Toplevel(self)
+        win.title("Open conversation")
+        listbox = tk.Listbox(win, width=70, height=15)
+        listbox.pack(fill='both', expand=True, padx=5, pady=5)
+        found = []
+
+        def show(conversations):
+            found[:] = conversations
+            for conversation in conversations:
+                updated = datetime.datetime.fromtimestamp(conversation["updated"] or 0).strftime("%Y-%m-%d %H:%M")
+                listbox.insert(tk.END, f"{updated}  {conversation['title']}")
+
+        def on_open(event=None):
+            selection = listbox.curselection()
+            if selection:
+                self.host.submit(self.resume_conversation(found[selection[0]]["id"]))
+                win.destroy()
+
+        listbox.bind("<Double-Button-1>", on_open)
+        tk.Button(win, text="Open", command=on_open).pack(pady=5)
+        self.host.submit(self.conversations.conversations(), on_result=show)
+
+    def open_search_dialog(self):
+        win = tk.Toplevel(self)
+        win.title("Search conversations")
+        query = tk.StringVar()
+        entry = tk.Entry(win, textvariable=query, width=70)
+        entry.pack(fill='x', padx=5, pady=5)
+        entry.focus_set()
+        listbox = tk.Listbox(win, width=100, height=20)
+        listbox.pack(fill='both', expand=True, padx=5, pady=5)
+        found = []
+        pending = {"after": None, "serial": 0}
+
+        def show(serial, results):
+            if serial != pending["serial"] or not win.winfo_exists():
+                return  # Superseded by a newer search
+            found[:] = results
+            listbox.delete(0, tk.END)
+            for result in results:
+                snippet = " ".join(result["snippet"].split())
+                listbox.insert(tk.END, f"{result['title'][:30]}  [{result['role']}]  {snippet}")
+
+        def search():
+            pending["after"] = None
+            pending["serial"] += 1
+            serial = pending["serial"]
+            self.host.submit(self.conversations.search(query.get(), limit=50),
+                             on_result=lambda results: show(serial, results))
+
+        def on_change(*_):
+            # Search once typing pauses rather than on every key
+            if pending["after"] is not None:
+                win.after_cancel(pending["after"])
+            pending["after"] = win.after(SEARCH_DELAY_MS, search)
+
+        def on_open(event=None):
+            selection = listbox.curselection()
+            if selection:
+                self.host.submit(self.resume_conversation(found[selection[0]]["conversation_id"]))
+                win.destroy()
+
+        query.trace_add("write", on_change)
+        listbox.bind("<Double-Button-1>", on_open)
+        tk.Button(win, text="Open", command=on_open).pack(pady=5)
 
     async def auto_connect_saved(self):
+        """Connects the saved LLM and all saved MCP servers in parallel."""
+        await asyncio.gather(self.auto_connect_LLM(), self.auto_connect_MCP())
+
+    async def auto_connect_LLM(self):
         llm_data = None
         try:
             llm_data = self.get_cached_password("LLM")
@@ -123,15 +257,22 @@ class AsyncTk(tk.Tk):
             try:
                 base = llm_data.get("base_url")
                 api_key = llm_data.get("api_key")
-                model = llm_data.get("model")
-                models = await self.agent.connect_LLM(base_url=base, api_key=api_key)
+                # Without a saved model, the first cached model of the provider is used until the list is fetched
+                model = llm_data.get("model") or (self.agent.catalog.models(base) or [None])[0]
+                # With a known model, chatting can start before the model list has been fetched
+                models = await self.agent.connect_LLM(base_url=base, model_name=model, api_key=api_key, verify=not model)
+                self.llm_ready.set()
+                if model:
+                    models = await self.agent.list_models()
                 if models:
                     chosen_model = model if model in models else models[0]
                     self.agent.LLM.model = chosen_model
                     self.agent.selected_model = chosen_model
             except Exception as e:
                 print(f"Auto-connect to LLM failed: {e}")
+        self.llm_ready.set()
 
+    async def auto_connect_MCP(self):
         mcp_list_json = None
         try:
             mcp_list_json = self.get_cached_password("MCP_list")
@@ -156,15 +297,21 @@ class AsyncTk(tk.Tk):
                 auth = data.get("auth")
                 token = data.get("token")
                 oauth_url = data.get("oauth_url")
+                # Configs saved before other transports were supported are all SSE
+                transport = data.get("transport", "sse")
                 server_name = url_to_name(url)
                 server_data_map[server_name] = (url, data)
+                # Show the server's cached tools right away, the connection below fetches them again
+                if self.agent.load_cached_MCP(url, transport):
+                    self.apply_active_tools(server_name, data)
                 # Prepare the coroutine for this MCP connection
                 connect_tasks.append(
                     self.agent.connect_MCP(
                         url,
                         auth,
                         token if token not in [None, ""] else None,
-                        oauth_url if oauth_url not in [None, ""] else None
+                        oauth_url if oauth_url not in [None, ""] else None,
+                        transport
                     )
                 )
 
@@ -177,44 +324,45 @@ class AsyncTk(tk.Tk):
                 result = results[idx]
                 if isinstance(result, Exception):
                     print(f"Auto-connect to MCP {url} failed: {result}")
-                    self.agent.mcp[server_name] = {
+                    # Cached tools stay listed so they can still be managed while the server is down
+                    self.agent.mcp.setdefault(server_name, {"tools": []}).update({
                         "connected": False,
                         "url": url,
                         "auth": data.get("auth"),
                         "token": data.get("token"),
                         "oauth_url": data.get("oauth_url"),
-                        "tools": []
-                    }
+                        "transport": data.get("transport", "sse"),
+                    })
                 else:
                     self.agent.mcp[server_name]["connected"] = True
-                # Set active tools if available
-                try:
-                    active_tools = data.get("active_tools", [])
-                    for tool in self.agent.mcp[server_name].get("tools", []):
-                        try:
-                            tool["active"] = tool["name"] in active_tools
-                        except KeyError:
-                            print(f"Tool {tool} missing 'name' key, skipping activation update")
-                except Exception as e:
-                    print(f"Error updating active tools for MCP {url}: {e}")
+                self.apply_active_tools(server_name, data)
 
-    def save_active_tools_for_server(self, server_name):
-        if not keyring:
-            return
-        key_name = f"MCP_{server_name}"
-        cred_json = self.get_cached_password(key_name)
-        if cred_json:
-            data = cred_json
-            tools = self.agent.mcp[server_name]["tools"]
-            data["active_tools"] = [tool["name"] for tool in tools if tool.get("active")]
-            self.set_cached_password(key_name, data)    
-
-    def poll_loop(self):
+    def apply_active_tools(self, server_name, data):
+        # Set active tools if available, configs saved before the settings file kept them with the credentials
         try:
-            self.loop.call_soon(self.loop.stop)
-            self.loop.run_forever()
-        finally:
-            self.after(100, self.poll_loop)
+            active_tools = self.store.get_setting("active_tools", {}).get(server_name, data.get("active_tools", []))
+            for tool in self.agent.mcp[server_name].get("tools", []):
+                try:
+                    tool["active"] = tool["name"] in active_tools
+                except KeyError:
+                    print(f"Tool {tool} missing 'name' key, skipping activation update")
+        except Exception as e:
+            print(f"Error updating active tools for MCP {server_name}: {e}")
+
+    def save_active_tools_for_server(self, server_name, tools=None):
+        """
+        Applies and saves the active tools of a server. tools is the tool dialog's snapshot of them,
+        without it the agent's current tools are fetched from the loop thread first.
+        """
+        if tools is None:
+            self.host.call_loop(self.agent.tool_snapshot, server_name,
+                                on_result=lambda snapshot: self.save_active_tools_for_server(server_name, snapshot or []))
+            return
+        self.host.call_loop(self.agent.set_active_tools, server_name, [tool["name"] for tool in tools if tool.get("active")])
+        # Active tools are not secret, they go to the settings file and toggles in quick succession are written once
+        active_tools = dict(self.store.get_setting("active_tools", {}))
+        active_tools[server_name] = [tool["name"] for tool in tools if tool.get("active")]
+        self.store.set_setting("active_tools", active_tools)
 
     def send_message(self):
         msg = self.entry.get()
@@ -222,39 +370,55 @@ class AsyncTk(tk.Tk):
             return
         self.entry.delete(0, tk.END)
         self.append_chat("User", msg)
-        asyncio.ensure_future(self.handle_response(msg))
+        if not self.llm_ready.is_set():
+            self.status_label.config(text="Connecting... your message will be sent once the LLM is ready", fg="blue")
+        self.host.submit(self.handle_response(msg))
 
     async def handle_response(self, msg):
-        try:
-            response = await self.agent.get_response(msg)
-        except Exception as e:
-            response = f"[Error: {e}]"
-        self.append_chat("Agent", response)
-
+        # Runs on the loop thread, every widget update is handed back to Tk
+        await self.llm_ready.wait()
+        async with self.turn_lock:
+            await self.host.ui(self.begin_stream, "Agent")
+            try:
+                async for chunk in self.agent.stream_response(msg):
+                    self.host.call_ui(self.update_stream, chunk)
+            except Exception as e:
+                self.host.call_ui(self.update_stream, f"\n\n[Error: {e}]")
+            await self.host.ui(self.end_stream)
 
     def append_chat(self, sender, msg):
-        # Ensure chat history exists
-        if not hasattr(self, "chat_history_html"):
-            self.chat_history_html = ""
-
-        # Inline style applied to each message wrapper
-        style = 'style="color:#dddddd; font-family:Arial, sans-serif;"'
-        label_style = 'style="color:#ffffff;"'
-
-        if sender == "User":
-            safe_text = msg.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
-            new_html = f'<p {style}><b {label_style}>{sender}:</b> {safe_text}</p>'
+        index = self.chat_renderer.append(sender, msg)
+        self.save_transcript(index, sender, msg)
+        return index
+
+    def begin_stream(self, sender):
+        self._stream_text = ""
+        self._stream_last_render = 0.0
+        self._stream_render_job = None
+        self._stream_index = self.append_chat(sender, "")
+
+    def update_stream(self, chunk):
+        """Adds a streamed chunk and re-renders, at most once per STREAM_FRAME_BUDGET seconds."""
+        self._stream_text += chunk
+        if self._stream_render_job is not None:
+            return  # A render is already scheduled and will pick up this chunk
+        wait = STREAM_FRAME_BUDGET - (time.monotonic() - self._stream_last_render)
+        if wait <= 0:
+            self.render_stream()
         else:
-            html_content = markdown(msg)
-            # Inject style into all <p> tags in the markdown result
-            html_content = html_content.replace("<p>", f"<p {style}>")
-            html_content = html_content.replace("<li>", f"<li {style}>")
-            new_html = f'<p {style}><b {label_style}>{sender}:</b></p>{html_content}'
+            self._stream_render_job = self.after(int(wait * 1000), self.render_stream)
 
-        self.chat_history_html += new_html
-        self.chat_display.set_html(self.chat_history_html)
-        self.chat_display.yview(tk.END)
+    def render_stream(self):
+        self._stream_render_job = None
+        self._stream_last_render = time.monotonic()
+        self.chat_renderer.update(self._stream_index, self._stream_text)
 
+    def end_stream(self):
+        if self._stream_render_job is not None:
+            self.after_cancel(self._stream_render_job)
+            self._stream_render_job = None
+        self.chat_renderer.update(self._stream_index, self._stream_text)
+        self.save_transcript(self._stream_index, "Agent", self._stream_text)
 
 
     def open_llm_dialog(self):
@@ -315,50 +479,51 @@ class AsyncTk(tk.Tk):
         connect_btn = tk.Button(win, text="Connect")
         connect_btn.pack(pady=5)
 
-        async def do_connect():
+        def do_connect():
             connect_btn.config(state='disabled')
             url_entry.config(state='disabled')
             key_entry.config(state='disabled')
             save_cb.config(state='disabled')
-            try:
-                # Use the URL if a name was selected, else use the text as entered
-                url = url_entry.get()
-                if url in name_to_url:
-                    url = name_to_url[url]
-                models = await self.agent.connect_LLM(base_url=url, api_key=key_entry.get())
-                for widget in models_frame.winfo_children():
-                    widget.destroy()
-                var = tk.StringVar()
-                for model in models:
-                    tk.Radiobutton(models_frame, text=model, variable=var, value=model, background="#222", foreground="#fff", selectcolor="#444").pack(anchor='w')
-                if models:
-                    var.set(models[0])
-                    self.agent.LLM.model = models[0]
-                    self.agent.selected_model = models[0]
-                def save_selection():
-                    self.agent.selected_model = var.get()
-                    self.agent.LLM.model = var.get()
-                    if keyring and save_var.get():
-                        creds = {
-                            "base_url": url,
-                            "api_key": key_entry.get(),
-                            "model": var.get()
-                        }
-                        try:
-                            self.set_cached_password("LLM", creds)
-                        except Exception as e:
-                            print(f"Failed to save LLM credentials: {e}")
-                    win.destroy()
-                win.protocol("WM_DELETE_WINDOW", save_selection)
-                tk.Button(win, text="OK", command=save_selection).pack(pady=5)
-            except Exception as e:
-                messagebox.showerror("Error", str(e))
-                connect_btn.config(state='normal')
-                url_entry.config(state='normal')
-                key_entry.config(state='normal')
-                save_cb.config(state='normal')
+            # Use the URL if a name was selected, else use the text as entered
+            url = url_entry.get()
+            if url in name_to_url:
+                url = name_to_url[url]
+            self.host.submit(self.agent.connect_LLM(base_url=url, api_key=key_entry.get()),
+                             on_result=lambda models: on_connected(url, models), on_error=on_connect_error)
+
+        def on_connected(url, models):
+            for widget in models_frame.winfo_children():
+                widget.destroy()
+            var = tk.StringVar()
+            for model in models:
+                tk.Radiobutton(models_frame, text=model, variable=var, value=model, background="#222", foreground="#fff", selectcolor="#444").pack(anchor='w')
+            if models:
+                var.set(models[0])
+                self.host.call_loop(self.agent.select_model, models[0])
+            def save_selection():
+                self.host.call_loop(self.agent.select_model, var.get())
+                if load_keyring() and save_var.get():
+                    creds = {
+                        "base_url": url,
+                        "api_key": key_entry.get(),
+                        "model": var.get()
+                    }
+                    try:
+                        self.set_cached_password("LLM", creds)
+                    except Exception as e:
+                        print(f"Failed to save LLM credentials: {e}")
+                win.destroy()
+            win.protocol("WM_DELETE_WINDOW", save_selection)
+            tk.Button(win, text="OK", command=save_selection).pack(pady=5)
 
-        connect_btn.config(command=lambda: asyncio.ensure_future(do_connect()))
+        def on_connect_error(e):
+            messagebox.showerror("Error", str(e))
+            connect_btn.config(state='normal')
+            url_entry.config(state='normal')
+            key_entry.config(state='normal')
+            save_cb.config(state='normal')
+
+        connect_btn.config(command=do_connect)
 
     def open_mcp_dialog(self):
         win = tk.Toplevel(self)
@@ -368,9 +533,12 @@ class AsyncTk(tk.Tk):
         # Section: Add new MCP server
         add_frame = tk.Frame(win)
         add_frame.pack(fill='x')
-        tk.Label(add_frame, text="MCP URL").grid(row=0, column=0, sticky='w')
+        tk.Label(add_frame, text="MCP URL / command").grid(row=0, column=0, sticky='w')
         url_entry = tk.Entry(add_frame, width=40)
         url_entry.grid(row=0, column=1, padx=5, pady=2)
+        transport_var = tk.StringVar(value="SSE")
+        transport_menu = tk.OptionMenu(add_frame, transport_var, *MCP_TRANSPORTS)
+        transport_menu.grid(row=0, column=2, sticky='w', pady=2)
         auth_var = tk.StringVar(value="None")
         tk.Label(add_frame, text="Auth").grid(row=1, column=0, sticky='w')
         auth_menu = tk.OptionMenu(add_frame, auth_var, "None", "Bearer", "OAuth")
@@ -426,10 +594,10 @@ class AsyncTk(tk.Tk):
             item_text = server_listbox.get(index)
             server_url = item_text.split(" - ")[0]
             if messagebox.askyesno("Delete Server", f"Are you sure you want to delete {server_url}?"):
-                # Remove from agent.mcp
-                self.agent.mcp.pop(server_url, None)
+                # Remove from agent.mcp and release its connection pool
+                self.host.submit(self.agent.disconnect_MCP(server_url), on_result=lambda _: refresh_server_list())
                 # Remove credentials and list entry from keyring
-                if keyring:
+                if load_keyring():
                     try:                        # Load, update and save MCP_list using set_cached_password
                         list_obj = self.get_cached_password("MCP_list")
                         current_list = list_obj if list_obj else []
@@ -446,10 +614,19 @@ class AsyncTk(tk.Tk):
         delete_btn.pack(pady=5)
 
 
-        # Populate the listbox with current servers from agent.mcp
+        # Populate the listbox with current servers from agent.mcp, read on the loop thread
+        servers = {}  # Status snapshot of the listed servers
+
         def refresh_server_list():
+            self.host.call_loop(self.agent.mcp_status, on_result=show_server_list)
+
+        def show_server_list(status):
+            if not server_listbox.winfo_exists():
+                return
+            servers.clear()
+            servers.update(status)
             server_listbox.delete(0, tk.END)
-            for url, server in self.agent.mcp.items():
+            for url, server in status.items():
                 status_text = "Connected" if server.get("connected") else "Not connected"
                 display_text = f"{url} - {status_text}"
                 server_listbox.insert(tk.END, display_text)
@@ -457,10 +634,13 @@ class AsyncTk(tk.Tk):
 
         # Define function to open tool dialog for a specific server
         def open_tool_dialog(server_url):
-            server_data = self.agent.mcp.get(server_url)
-            if not server_data:
+            # The dialog works on copies of the tools, changes are applied on the loop thread
+            self.host.call_loop(self.agent.tool_snapshot, server_url,
+                                on_result=lambda tools: show_tool_dialog(server_url, tools))
+
+        def show_tool_dialog(server_url, tools):
+            if tools is None or not win.winfo_exists():
                 return
-            tools = server_data.get("tools", [])
             tool_win = tk.Toplevel(win)
             tool_win.title(f"Tools - {server_url}")
             tool_win.geometry("500x400")
@@ -479,43 +659,29 @@ class AsyncTk(tk.Tk):
 
             def on_focus_out(event):
                 if not filter_entry.get():
-                    filter_entry.insert(0, "Search")
                     filter_entry.config(fg='grey')
+                    filter_entry.insert(0, "Search")
 
             filter_entry.bind("<FocusIn>", on_focus_in)
             filter_entry.bind("<FocusOut>", on_focus_out)
-            canvas = tk.Canvas(tool_win)
-            scrollbar = tk.Scrollbar(tool_win, orient="vertical", command=canvas.yview)
-            scroll_frame = tk.Frame(canvas)
-            scroll_frame.bind("<Configure>", lambda e: canvas.configure(scrollregion=canvas.bbox("all")))
-            canvas.create_window((0, 0), window=scroll_frame, anchor="nw")
-            canvas.configure(yscrollcommand=scrollbar.set)
-            canvas.pack(side="left", fill="both", expand=True)
-            scrollbar.pack(side="right", fill="y")
-            tool_checkboxes = []
-            for tool in tools:
-                var = tk.BooleanVar(value=tool.get("active", False))
-                cb = tk.Checkbutton(scroll_frame, text=tool.get("name", "Unknown"), variable=var)
-                cb.var = var
-                cb.tool = tool
-                def on_toggle(b=cb):
-                    b.tool.update({'active': b.var.get()})
-                    self.save_active_tools_for_server(server_url)
-                cb.config(command=on_toggle)
-                cb.pack(anchor='w')
-                tool_checkboxes.append(cb)
+
+            # Only the rows in view are widgets, the search index is reused until the server's tools change
+            picker = ToolPicker(tool_win, tools, on_change=lambda: self.save_active_tools_for_server(server_url, tools),
+                                search=self._tool_search.get(server_url))
+            self._tool_search[server_url] = picker.search
+            bulk_frame = tk.Frame(tool_win)
+            bulk_frame.pack(fill='x', padx=5)
+            tk.Button(bulk_frame, text="Select all", command=lambda: picker.set_all(True)).pack(side='left')
+            tk.Button(bulk_frame, text="Deselect all", command=lambda: picker.set_all(False)).pack(side='left', padx=5)
+            picker.pack(fill='both', expand=True)
+
             # Filter functionality for tools list
             def update_tool_filter(*args):
-                keyword = filter_var.get().lower()
-                for cb in tool_checkboxes:
-                    name = cb.tool.get("name", "").lower() if isinstance(cb.tool, dict) else str(cb.tool).lower()
-                    visible = (keyword in name)
-                    cb.pack_forget()
-                    if visible:
-                        cb.pack(anchor='w')
+                keyword = filter_var.get()
+                picker.filter("" if keyword == "Search" and filter_entry.cget("fg") == "grey" else keyword)
             filter_var.trace_add("write", update_tool_filter)
             def on_close():
-                self.save_active_tools_for_server(server_url)
+                self.save_active_tools_for_server(server_url, tools)
                 tool_win.destroy()
 
             tool_win.protocol("WM_DELETE_WINDOW", on_close)
@@ -527,7 +693,7 @@ class AsyncTk(tk.Tk):
                 # Extract server URL from the selected list item text (split at " - ")
                 item_text = server_listbox.get(index)
                 server_url = item_text.split(" - ")[0]
-                server_info = self.agent.mcp.get(server_url)
+                server_info = servers.get(server_url)
                 if not server_info:
                     return
                 if server_info.get("connected"):
@@ -537,62 +703,74 @@ class AsyncTk(tk.Tk):
                     # Not connected: attempt to reconnect using stored credentials
                     # Disable listbox to prevent multiple triggers
                     server_listbox.config(state='disabled')
-                    async def reconnect_and_open():
+                    # Retrieve credentials from keyring if available
+                    cred_json = None
+                    if load_keyring():
                         try:
-                            # Retrieve credentials from keyring if available
-                            cred_json = None
-                            if keyring:
-                                try:
-                                    cred_json = self.get_cached_password( f"MCP_{server_url}")
-                                except Exception as kr_err:
-                                    print(f"Keyring lookup failed for {server_url}: {kr_err}")
-                            # Use credentials from stored data or agent.mcp (set during auto_connect_saved if any)
-                            auth = server_info.get("auth")
-                            token = server_info.get("token")
-                            oauth_url = server_info.get("oauth_url")
-                            if cred_json:
-                                data = json.loads(cred_json)
-                                auth = data.get("auth", auth)
-                                token = data.get("token", token)
-                                oauth_url = data.get("oauth_url", oauth_url)
-                            # Attempt to connect
-                            await self.agent.connect_MCP(server_url, auth, token if token not in [None, ""] else None,
-                                                         oauth_url if oauth_url not in [None, ""] else None)
-                            # If successful, update status and open tools
-                            server_info = self.agent.mcp.get(server_url, {})
-                            server_info["connected"] = True
-                            # Refresh list display to show updated status
-                            refresh_server_list()
-                            # Open tool dialog for this server
-                            open_tool_dialog(server_url)
-                        except Exception as e:
-                            messagebox.showerror("Error", f"Failed to connect to {server_url}:\n{e}")
-                        finally:
-                            # Re-enable the listbox
-                            server_listbox.config(state='normal')
-                    asyncio.ensure_future(reconnect_and_open())
+                            cred_json = self.get_cached_password( f"MCP_{server_url}")
+                        except Exception as kr_err:
+                            print(f"Keyring lookup failed for {server_url}: {kr_err}")
+                    # Use credentials from stored data or agent.mcp (set during auto_connect_saved if any)
+                    url = server_info.get("url", server_url)
+                    auth = server_info.get("auth")
+                    token = server_info.get("token")
+                    oauth_url = server_info.get("oauth_url")
+                    transport = server_info.get("transport")
+                    if cred_json:
+                        data = cred_json
+                        url = data.get("url", url)
+                        auth = data.get("auth", auth)
+                        token = data.get("token", token)
+                        oauth_url = data.get("oauth_url", oauth_url)
+                        transport = data.get("transport", transport or "sse")
+
+                    def on_reconnected(result):
+                        # If successful, connect_MCP marked the server connected, open its tools
+                        server_listbox.config(state='normal')
+                        # Refresh list display to show updated status
+                        refresh_server_list()
+                        # Open tool dialog for this server
+                        open_tool_dialog(server_url)
+
+                    def on_reconnect_error(e):
+                        server_listbox.config(state='normal')
+                        messagebox.showerror("Error", f"Failed to connect to {server_url}:\n{e}")
+
+                    # Attempt to connect
+                    self.host.submit(
+                        self.agent.connect_MCP(url, auth, token if token not in [None, ""] else None,
+                                               oauth_url if oauth_url not in [None, ""] else None, transport),
+                        on_result=on_reconnected, on_error=on_reconnect_error)
         server_listbox.bind('<Double-Button-1>', on_server_double_click)
 
-        async def do_add():
+        def set_add_controls(state):
+            add_btn.config(state=state)
+            url_entry.config(state=state)
+            transport_menu.config(state=state)
+            auth_menu.config(state=state)
+            token_entry.config(state=state)
+            oauth_entry.config(state=state)
+            save_cb.config(state=state)
+
+        def do_add():
             # Disable add controls while connecting
-            add_btn.config(state='disabled')
-            url_entry.config(state='disabled')
-            auth_menu.config(state='disabled')
-            token_entry.config(state='disabled')
-            oauth_entry.config(state='disabled')
-            save_cb.config(state='disabled')
+            set_add_controls('disabled')
+            url = url_entry.get()
+            auth_method = auth_var.get()
+            transport = MCP_TRANSPORTS[transport_var.get()]
+            token_val = token_entry.get() if token_entry.winfo_ismapped() and token_entry.get() != "" else None
+            oauth_val = oauth_entry.get() if oauth_entry.winfo_ismapped() and oauth_entry.get() != "" else None
+            # Attempt to connect to the new MCP server
+            self.host.submit(
+                self.agent.connect_MCP(url, auth_method, token_val, oauth_val, transport),
+                on_result=lambda server: on_added(server, url, auth_method, token_val, oauth_val, transport),
+                on_error=on_add_error)
+
+        def on_added(server, url, auth_method, token_val, oauth_val, transport):
             try:
-                url = url_entry.get()
-                auth_method = auth_var.get()
-                token_val = token_entry.get() if token_entry.winfo_ismapped() and token_entry.get() != "" else None
-                oauth_val = oauth_entry.get() if oauth_entry.winfo_ismapped() and oauth_entry.get() != "" else None
-                # Attempt to connect to the new MCP server
-                server = await self.agent.connect_MCP(url, auth_method, token_val, oauth_val)
-                # On success, `server` is the server data (dict) and self.agent.mcp should be updated
-                server_data = self.agent.mcp.get(url, server)  # ensure we have the server dict
-                server_data["connected"] = True
+                # On success connect_MCP has marked the server connected in self.agent.mcp
                 # Save credentials if checked
-                if keyring and save_var.get():
+                if load_keyring() and save_var.get():
                     # Update MCP list in keyring
                     try:
                         current_list = []
@@ -610,41 +788,47 @@ class AsyncTk(tk.Tk):
                         "auth": auth_method,
                         "token": token_val if token_val is not None else "",
                         "oauth_url": oauth_val if oauth_val is not None else "",
-                        "active_tools": [tool["name"] for tool in server_data.get("tools", []) if tool.get("active")]
-
+                        "transport": transport,
                     }
                     try:
                         key_name = f"MCP_{url_to_name(url)}"
                         self.set_cached_password(key_name,cred_info)
                     except Exception as e:
                         print(f"Failed to save MCP credentials for {url}: {e}")
+                    self.save_active_tools_for_server(url_to_name(url))
                 # Update the server list UI
                 refresh_server_list()
-            except Exception as e:
-                messagebox.showerror("Error", str(e))
             finally:
                 # Re-enable controls for adding servers
-                add_btn.config(state='normal')
-                url_entry.config(state='normal')
-                auth_menu.config(state='normal')
-                token_entry.config(state='normal')
-                oauth_entry.config(state='normal')
-                save_cb.config(state='normal')
+                set_add_controls('normal')
+
+        def on_add_error(e):
+            messagebox.showerror("Error", str(e))
+            set_add_controls('normal')
 
         # Set the Add Server button command after defining do_add
-        add_btn.config(command=lambda: asyncio.ensure_future(do_add()))
+        add_btn.config(command=do_add)
 
         # Note: The list will include any servers (saved or added this session) 
         # with their connected status. Double-click allows opening tools for connected 
         # servers or retrying connection for disconnected ones.
     def on_close(self):
-        self.loop.stop()
+        try:
+            self.host.submit(self.store.flush()).result(timeout=5)
+        except Exception as e:
+            print(f"Could not save pending settings: {e}")
+        try:
+            self.host.submit(self.conversations.close()).result(timeout=5)
+        except Exception as e:
+            print(f"Could not save the conversation: {e}")
+        self.host.stop()
+        self.agent.tool_results.clear()  # The loop has stopped, no tool call is using them
         self.destroy()
 
 
-def main():
+def main(started: float = None):
     agent = Agent()
-    app = AsyncTk(agent)
+    app = AsyncTk(agent, started)
     app.mainloop()
     
 
@@ -0,0 +1,240 @@
+import tkinter as tk
+from tkinter import font
+from tkhtmlview import html_parser
+from tkhtmlview.html_parser import WTag, WCfg, Fnt, Bind, HLinkSlot
+
+# Messages kept rendered in the chat widget, older ones are dropped and reloaded on scroll
+CHAT_WINDOW_SIZE = 100
+# Older messages loaded at once when scrolling to the top of the live window
+CHAT_PAGE_SIZE = 25
+
+
+class MessageParser(html_parser.HTMLTextParser):
+    """
+    HTMLTextParser that appends to the end of the widget instead of replacing its content,
+    namespacing its tags so several messages can live in the same widget.
+    """
+    def append_html(self, w, html, tag_prefix):
+        self.tag_prefix = tag_prefix
+        self.tag_names = []
+        w.mark_set(tk.INSERT, "end-1c")
+        self.w_set_html(w, html, strip=True)
+        return self.tag_names, self.images
+
+    def _w_tags_apply_all(self):
+        # Same as HTMLTextParser._w_tags_apply_all, with tags named f"{tag_prefix}{index}"
+        if self.strip:
+            self._text_rstrip()
+        end_index = tk.END
+        for key, tag in reversed(tuple(self._w_tags.items())):
+            tag[WTag.START_INDEX] = key
+            tag[WTag.END_INDEX] = end_index
+            end_index = key
+
+        self.hlink_slots = []
+        for key, tag in self._w_tags.items():
+            if "config" in tag:
+                if tag["config"].get("justify") == "justify":
+                    tag["config"]["justify"] = "left"
+            name = f"{self.tag_prefix}{key}"
+            self.tag_names.append(name)
+            self._w.tag_add(name, tag[WTag.START_INDEX], tag[WTag.END_INDEX])
+            self._w.tag_config(name, font=font.Font(**tag[Fnt.KEY]), **tag[WCfg.KEY])
+            if tag[Bind.KEY][Bind.LINK]:
+                self.hlink_slots.append(HLinkSlot(self._w, name, tag[Bind.KEY][Bind.LINK]))
+                self._w.tag_bind(name, "<Button-1>", self.hlink_slots[-1].call)
+                self._w.tag_bind(name, "<Leave>", self.hlink_slots[-1].leave)
+                self._w.tag_bind(name, "<Enter>", self.hlink_slots[-1].enter)
+
+
+class ChatRenderer:
+    """
+    Renders chat messages incrementally into an HTMLScrolledText.
+    Each message is converted to HTML once and cached; only the last CHAT_WINDOW_SIZE
+    messages are kept in the widget, older pages are rendered again when scrolling to the top.
+    With a load_page callback, messages that scroll out of the window are also dropped from memory,
+    and load_page(before, count) is asked for older pages, which it hands back through prepend().
+    Message indices are positions in the whole conversation, whether or not the message is in memory.
+    """
+    def __init__(self, display, window_size: int = CHAT_WINDOW_SIZE, page_size: int = CHAT_PAGE_SIZE, load_page=None):
+        self.display = display
+        self.window_size = window_size
+        self.page_size = page_size
+        self.load_page = load_page
+        self.parser = MessageParser()
+        self.messages = []  # {"sender", "text", "html", "tags", "images"} per message in memory
+        self.offset = 0  # Index of self.messages[0]
+        self.first_live = 0  # Index of the first message rendered in the widget
+        self._serial = 0
+        self._loading = False
+        display.config(yscrollcommand=self.on_yscroll)
+
+    def __len__(self):
+        return self.offset + len(self.messages)
+
+    def append(self, sender: str, text: str) -> int:
+        """Renders a new message at the end of the chat and returns its index."""
+        self.messages.append({"sender": sender, "text": text, "html": None, "tags": [], "images": []})
+        index = len(self) - 1
+        self._edit(lambda: self._render(index))
+        self.trim()
+        self.display.yview(tk.END)
+        return index
+
+    def update(self, index: int, text: str):
+        """Replaces the text of a message and re-renders only that message."""
+        if index < self.offset:
+            return  # Dropped from memory
+        message = self.messages[index - self.offset]
+        if message["text"] == text:
+            return
+        message["text"] = text
+        message["html"] = None
+        if index < self.first_live:
+            return  # Not live, will be rendered from cache when scrolled back in
+        at_bottom = self.display.yview()[1] >= 1.0
+
+        def rerender():
+            # Everything after this message has to be redrawn after it, usually there is nothing
+            for later in range(index, len(self)):
+                self._unrender(later)
+            for later in range(index, len(self)):
+                self._render(later)
+        self._edit(rerender)
+        if at_bottom:
+            self.display.yview(tk.END)
+
+    def clear(self):
+        self._edit(lambda: self.display.delete("1.0", tk.END))
+        for message in self.messages:
+            self._drop_tags(message)
+        self.messages = []
+        self.offset = 0
+        self.first_live = 0
+
+    def restore(self, first: int, messages: list[tuple]):
+        """Replaces the chat with (sender, text) messages starting at index first, e.g. the last page of a stored chat."""
+        self.clear()
+        self.offset = self.first_live = first
+        for sender, text in messages:
+            self.append(sender, text)
+
+    def trim(self):
+        """Drops the oldest live messages from the widget until at most window_size are rendered."""
+        excess = len(self) - self.first_live - self.window_size
+        if excess <= 0:
+            return
+        new_first = self.first_live + excess
+
+        def drop():
+            self.display.delete("1.0", self._mark(new_first))
+            for index in range(self.first_live, new_first):
+                self._drop_tags(self._message(index))
+                self.display.mark_unset(self._mark(index))
+        self._edit(drop)
+        self.first_live = new_first
+        if self.load_page is not None:
+            # Older messages are loaded again from the store when needed
+            del self.messages[:new_first - self.offset]
+            self.offset = new_first
+
+    def load_older(self):
+        """Renders the previous page of messages above the live window, keeping the view in place."""
+        if self.first_live == 0 or self._loading:
+            return
+        if self.first_live == self.offset and self.load_page is not None:
+            self._loading = True
+            self.load_page(self.offset, self.page_size)  # Calls prepend() once the page is read
+            return
+        self._loading = True
+        try:
+            self._render_older(max(self.offset, self.first_live - self.page_size))
+        finally:
+            self._loading = False
+
+    def prepend(self, messages: list[tuple]):
+        """Adds an older page of (sender, text) messages asked for by load_page and renders it."""
+        try:
+            messages = messages[-self.offset:] if self.offset else []
+            if not messages:
+                return
+            self.messages[:0] = [{"sender": sender, "text": text, "html": None, "tags": [], "images": []}
+                                 for sender, text in messages]
+            self.offset -= len(messages)
+            self._render_older(self.offset)
+        finally:
+            self._loading = False
+
+    def _render_older(self, new_first: int):
+        anchor = self._mark(self.first_live)
+
+        def rerender():
+            # The HTML parser can only append, so redraw the (bounded) live window below the new page
+            for index in range(self.first_live, len(self)):
+                self._unrender(index)
+            for index in range(new_first, len(self)):
+                self._render(index)
+        self._edit(rerender)
+        self.first_live = new_first
+        self.display.yview(anchor)
+
+    def on_yscroll(self, first, last):
+        self.display.vbar.set(first, last)
+        if float(first) <= 0.0 and self.first_live > 0 and not self._loading:
+            self.display.after_idle(self.load_older)
+
+    def _message(self, index: int) -> dict:
+        return self.messages[index - self.offset]
+
+    def _mark(self, index: int) -> str:
+        return f"chat_message_{index}"
+
+    def _edit(self, action):
+        prev_state = self.display.cget("state")
+        self.display.config(state=tk.NORMAL)
+        try:
+            action()
+        finally:
+            self.display.config(state=prev_state)
+
+    def _render(self, index: int):
+        message = self._message(index)
+        if message["html"] is None:
+            message["html"] = message_html(message["sender"], message["text"])
+        self.display.mark_set(self._mark(index), "end-1c")
+        self.display.mark_gravity(self._mark(index), tk.LEFT)
+        self._serial += 1
+        message["tags"], message["images"] = self.parser.append_html(self.display, message["html"], f"m{self._serial}_")
+
+    def _unrender(self, index: int):
+        mark = self._mark(index)
+        if mark in self.display.mark_names():
+            self.display.delete(mark, tk.END)
+            self.display.mark_unset(mark)
+        self._drop_tags(self._message(index))
+
+    def _drop_tags(self, message: dict):
+        if message["tags"]:
+            self.display.tag_delete(*message["tags"])
+        message["tags"] = []
+        message["images"] = []
+
+
+def message_html(sender: str, msg: str) -> str:
+    """
+    Converts a chat message to the HTML shown in the chat display.
+    User messages are escaped, everything else is rendered as markdown.
+    """
+    # Inline style applied to each message wrapper
+    style = 'style="color:#dddddd; font-family:Arial, sans-serif;"'
+    label_style = 'style="color:#ffffff;"'
+
+    if sender == "User":
+        safe_text = msg.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+        return f'<p {style}><b {label_style}>{sender}:</b> {safe_text}</p>'
+    from markdown import markdown  # Imported with the first rendered reply rather than at startup
+    html_content = markdown(msg)
+    # Inject style into all <p> tags in the markdown result
+    html_content = html_content.replace("<p>", f"<p {style}>")
+    html_content = html_content.replace("<li>", f"<li {style}>")
+    return f'<p {style}><b {label_style}>{sender}:</b></p>{html_content}'
@@ -0,0 +1,152 @@
+import asyncio
+import json
+import os
+import threading
+
+KEYRING_SERVICE = "ApaChat"
+# Changes made within this many seconds of each other are written together
+CREDENTIAL_WRITE_DELAY = 0.5
+SETTINGS_PATH = os.path.join(os.path.expanduser("~"), ".config", "ApaChat", "settings.json")
+
+_keyring = None
+
+
+def load_keyring():
+    """Imports keyring on first use, as its backends are slow to load. Returns None if it is not installed."""
+    global _keyring
+    if _keyring is None:
+        try:
+            import keyring
+            _keyring = keyring
+        except ImportError:
+            _keyring = False
+            print("Keyring module not available, credentials saving disabled")
+    return _keyring or None
+
+
+class CredentialStore:
+    """
+    Secrets in the system keyring, stored as one JSON blob per user, and non-secret settings
+    such as active tool lists in a local JSON file.
+    Both are read once by load() and then served from memory. Changes are written behind in a worker
+    thread of the given event loop, coalescing everything changed within write_delay seconds into one write.
+    get/set and get_setting/set_setting may be called from any thread.
+    """
+    def __init__(self, user: str, loop, service: str = KEYRING_SERVICE, settings_path: str = SETTINGS_PATH,
+                 write_delay: float = CREDENTIAL_WRITE_DELAY):
+        self.user = user
+        self.loop = loop
+        self.service = service
+        self.settings_path = settings_path
+        self.write_delay = write_delay
+        self.credentials = {}
+        self.settings = {}
+        self.loaded = False
+        self.stats = {"keyring_writes": 0, "settings_writes": 0, "coalesced": 0}
+        self._lock = threading.Lock()
+        self._timers = {}  # "credentials" / "settings" -> TimerHandle of the pending write
+        self._writes = {}  # Running writes, awaited by flush()
+
+    async def load(self):
+        """Reads the keyring blob and the settings file in a worker thread."""
+        credentials, settings = await asyncio.to_thread(self._read)
+        with self._lock:
+            # Values set before loading finished win over stored ones
+            self.credentials = dict(credentials, **self.credentials)
+            self.settings = dict(settings, **self.settings)
+            self.loaded = True
+
+    def _read(self):
+        credentials, settings = {}, {}
+        keyring = load_keyring()
+        if keyring:
+            try:
+                data = keyring.get_password(self.service, self.user)
+                credentials = json.loads(data) if data else {}
+            except Exception as e:
+                print(f"Keyring error while loading credentials: {e}")
+        if self.settings_path:
+            try:
+                with open(self.settings_path, "r", encoding="utf-8") as f:
+                    settings = json.load(f)
+            except (OSError, ValueError):
+                pass
+        return credentials, settings
+
+    def get(self, key):
+        with self._lock:
+            return self.credentials.get(key)
+
+    def set(self, key, value):
+        if not load_keyring():
+            return
+        with self._lock:
+            self.credentials[key] = value
+        self._schedule("credentials")
+
+    def get_setting(self, key, default=None):
+        with self._lock:
+            return self.settings.get(key, default)
+
+    def set_setting(self, key, value):
+        with self._lock:
+            self.settings[key] = value
+        self._schedule("settings")
+
+    def _schedule(self, kind: str):
+        if self.loop.is_closed():
+            return
+        try:
+            self.loop.call_soon_threadsafe(self._restart_timer, kind)
+        except RuntimeError:
+            pass  # Loop is shutting down
+
+    def _restart_timer(self, kind: str):
+        # Runs on the loop thread. Every change pushes the write back, so a burst of changes is written once
+        timer = self._timers.pop(kind, None)
+        if timer is not None:
+            timer.cancel()
+            self.stats["coalesced"] += 1
+        self._timers[kind] = self.loop.call_later(self.write_delay, self._start_write, kind)
+
+    def _start_write(self, kind: str):
+        self._timers.pop(kind, None)
+        previous = self._writes.get(kind)
+        self._writes[kind] = self.loop.create_task(self._write(kind, previous))
+
+    async def _write(self, kind: str, previous=None):
+        if previous is not None:
+            await asyncio.gather(previous, return_exceptions=True)  # Keep writes of the same kind in order
+        with self._lock:
+            text = json.dumps(self.credentials if kind == "credentials" else self.settings)
+        if kind == "credentials":
+            await asyncio.to_thread(self._write_keyring, text)
+            self.stats["keyring_writes"] += 1
+        else:
+            await asyncio.to_thread(self._write_settings, text)
+            self.stats["settings_writes"] += 1
+
+    def _write_keyring(self, text: str):
+        try:
+            load_keyring().set_password(self.service, self.user, text)
+        except Exception as e:
+            print(f"Failed to save credentials to keyring: {e}")
+
+    def _write_settings(self, text: str):
+        if not self.settings_path:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.settings_path) or ".", exist_ok=True)
+            temp = f"{self.settings_path}.{os.getpid()}.tmp"
+            with open(temp, "w", encoding="utf-8") as f:
+                f.write(text)
+            os.replace(temp, self.settings_path)
+        except OSError as e:
+            print(f"Failed to save settings: {e}")
+
+    async def flush(self):
+        """Writes pending changes now, e.g. before the app exits. Must run on the store's loop."""
+        for kind in list(self._timers):
+            self._timers.pop(kind).cancel()
+            self._start_write(kind)
+        await asyncio.gather(*self._writes.values(), return_exceptions=True)
@@ -0,0 +1,117 @@
+import asyncio
+import queue
+import threading
+
+# Milliseconds between checks of the UI queue on the Tk thread
+UI_POLL_MS = 15
+
+
+class LoopHost:
+    """
+    Runs an asyncio event loop continuously on its own thread.
+    Coroutines are submitted from Tk with submit(), UI work is handed back to Tk with call_ui()
+    through a thread-safe queue that Tk polls. The loop thread never calls into Tk, so it cannot
+    block on a Tk thread that is itself waiting for the loop.
+    """
+    def __init__(self, root):
+        self.root = root
+        self.loop = asyncio.new_event_loop()
+        self._ui_queue = queue.SimpleQueue()
+        self._closed = False
+        self._poll = root.after(UI_POLL_MS, self._drain_ui_queue)
+        self.thread = threading.Thread(target=self._run_loop, name="ApaChat-asyncio", daemon=True)
+        self.thread.start()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro, on_result=None, on_error=None):
+        """
+        Schedules a coroutine on the loop thread and returns its concurrent.futures.Future.
+        on_result / on_error are called on the Tk thread once it finishes.
+        """
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+        def done(f):
+            if f.cancelled():
+                return
+            error = f.exception()
+            if error is not None:
+                if on_error:
+                    self.call_ui(on_error, error)
+                else:
+                    print(f"Background task failed: {error}")
+            elif on_result:
+                self.call_ui(on_result, f.result())
+        future.add_done_callback(done)
+        return future
+
+    def call_loop(self, func, *args, on_result=None, on_error=None):
+        """
+        Runs func(*args) on the loop thread, for reading or changing state the loop's coroutines use.
+        on_result / on_error are called on the Tk thread, as with submit().
+        """
+        async def run():
+            return func(*args)
+        return self.submit(run(), on_result, on_error)
+
+    def call_ui(self, func, *args):
+        """Runs func(*args) on the Tk thread. Safe to call from any thread."""
+        if self._closed:
+            return
+        self._ui_queue.put((func, args))
+
+    async def ui(self, func, *args):
+        """Awaitable version of call_ui for coroutines running on the loop thread, returns func's result."""
+        future = self.loop.create_future()
+
+        def run():
+            try:
+                result = func(*args)
+            except Exception as e:
+                self.loop.call_soon_threadsafe(_set_future, future, None, e)
+            else:
+                self.loop.call_soon_threadsafe(_set_future, future, result, None)
+        self.call_ui(run)
+        return await future
+
+    def _drain_ui_queue(self):
+        while True:
+            try:
+                func, args = self._ui_queue.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                func(*args)
+            except Exception as e:
+                print(f"UI callback {func} failed: {e}")
+        if not self._closed:
+            self._poll = self.root.after(UI_POLL_MS, self._drain_ui_queue)
+
+    def stop(self):
+        """Cancels pending tasks, stops the loop and waits for its thread to exit."""
+        self._closed = True
+        self.root.after_cancel(self._poll)
+
+        async def shutdown():
+            tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        if self.loop.is_running():
+            try:
+                asyncio.run_coroutine_threadsafe(shutdown(), self.loop).result(timeout=2)
+            except Exception as e:
+                print(f"Error while shutting down background tasks: {e}")
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout=2)
+
+
+def _set_future(future, result, error):
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
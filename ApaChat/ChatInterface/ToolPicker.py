@@ -0,0 +1,165 @@
+import bisect
+import difflib
+import tkinter as tk
+from tkinter import font
+
+from ..Agent.ToolIndex import tokenize
+
+# Query terms without any prefix match are matched against index terms at least this similar
+FUZZY_CUTOFF = 0.75
+FUZZY_MATCHES = 5
+
+
+class ToolSearch:
+    """
+    Prefix index over the names and descriptions of a server's tools, built once per tool list.
+    Every query term must match the start of a term of the tool; terms without any prefix match
+    fall back to the most similar index terms. Name matches rank before description matches.
+    """
+    def __init__(self, tools: list[dict]):
+        self.tools = tools
+        self.key = tool_key(tools)
+        postings = {}  # term -> {tool position: 2 if in the name, 1 if only in the description}
+        for position, tool in enumerate(tools):
+            for term in tokenize(tool.get("description") or ""):
+                postings.setdefault(term, {})[position] = 1
+            for term in tokenize(tool.get("name", ""), stopwords=()):
+                postings.setdefault(term, {})[position] = 2
+        self.terms = sorted(postings)
+        self.postings = [postings[term] for term in self.terms]
+
+    def _matches(self, term: str) -> dict:
+        """Tools with a term starting with term (or similar to it), with their best match weight."""
+        start = bisect.bisect_left(self.terms, term)
+        end = bisect.bisect_left(self.terms, term + "\uffff", start)
+        indices = range(start, end)
+        if not indices:
+            similar = difflib.get_close_matches(term, self.terms, n=FUZZY_MATCHES, cutoff=FUZZY_CUTOFF)
+            indices = [bisect.bisect_left(self.terms, match) for match in similar]
+        matches = {}
+        for index in indices:
+            for position, weight in self.postings[index].items():
+                if weight > matches.get(position, 0):
+                    matches[position] = weight
+        return matches
+
+    def query(self, text: str) -> list[int]:
+        """Positions of the tools matching every term of text, best first. All tools for an empty query."""
+        terms = tokenize(text, stopwords=())
+        if not terms:
+            return list(range(len(self.tools)))
+        scores = None
+        for term in terms:
+            matches = self._matches(term)
+            if not matches and len(terms) > 1:
+                continue  # A stray word should not hide everything else
+            if scores is None:
+                scores = matches
+            else:
+                scores = {position: scores[position] + weight for position, weight in matches.items() if position in scores}
+        if not scores:
+            return []
+        return sorted(scores, key=lambda position: (-scores[position], position))
+
+
+def tool_key(tools: list[dict]) -> list[tuple]:
+    """What a ToolSearch indexes of tools, to tell whether an index built for other copies still fits."""
+    return [(tool.get("name"), tool.get("description")) for tool in tools]
+
+
+class ToolPicker(tk.Frame):
+    """
+    Checkbox list over a server's tools that only creates widgets for the rows in view.
+    Scrolling rebinds the same row widgets to other tools, so opening and filtering cost the same for any number of tools.
+    on_change() is called once per user action, including bulk selection.
+    """
+    def __init__(self, master, tools: list[dict], on_change=None, search: ToolSearch = None, **kwargs):
+        super().__init__(master, **kwargs)
+        self.tools = tools
+        self.on_change = on_change
+        # The dialog gets a new snapshot of the tools every time, the index is reused while they are unchanged
+        self.search = search if search is not None and search.key == tool_key(tools) else ToolSearch(tools)
+        self.visible = list(range(len(tools)))  # Positions of the tools matching the filter
+        self.first = 0
+        self.rows = []
+        self.row_height = font.nametofont("TkDefaultFont").metrics("linespace") + 8
+
+        self.scrollbar = tk.Scrollbar(self, orient="vertical", command=self._on_scrollbar)
+        self.scrollbar.pack(side="right", fill="y")
+        self.body = tk.Frame(self)
+        self.body.pack(side="left", fill="both", expand=True)
+        self.body.bind("<Configure>", self._on_resize)
+        for widget in (self, self.body):
+            widget.bind("<MouseWheel>", self._on_wheel)
+            widget.bind("<Button-4>", lambda e: self.scroll(-3))
+            widget.bind("<Button-5>", lambda e: self.scroll(3))
+
+    def filter(self, query: str):
+        self.visible = self.search.query(query)
+        self.first = 0
+        self.render()
+
+    def set_all(self, active: bool):
+        """Activates or deactivates every tool matching the current filter."""
+        for position in self.visible:
+            self.tools[position]["active"] = active
+        self.render()
+        if self.on_change:
+            self.on_change()
+
+    def scroll(self, rows: int):
+        last = max(len(self.visible) - len(self.rows), 0)
+        self.first = min(max(self.first + rows, 0), last)
+        self.render()
+
+    def render(self):
+        for offset, row in enumerate(self.rows):
+            index = self.first + offset
+            if index < len(self.visible):
+                tool = self.tools[self.visible[index]]
+                row.position = self.visible[index]
+                row.var.set(bool(tool.get("active")))
+                row.config(text=tool.get("name", "Unknown"))
+                row.place(x=0, y=offset * self.row_height, relwidth=1, height=self.row_height)
+            else:
+                row.position = None
+                row.place_forget()
+        total = len(self.visible)
+        if total:
+            self.scrollbar.set(self.first / total, min(self.first + len(self.rows), total) / total)
+        else:
+            self.scrollbar.set(0, 1)
+
+    def _on_resize(self, event):
+        count = max(event.height // self.row_height, 1)
+        while len(self.rows) < count:
+            var = tk.BooleanVar()
+            row = tk.Checkbutton(self.body, variable=var, anchor="w")
+            row.var = var
+            row.position = None
+            row.config(command=lambda r=row: self._on_toggle(r))
+            row.bind("<MouseWheel>", self._on_wheel)
+            row.bind("<Button-4>", lambda e: self.scroll(-3))
+            row.bind("<Button-5>", lambda e: self.scroll(3))
+            self.rows.append(row)
+        while len(self.rows) > count:
+            self.rows.pop().destroy()
+        self.scroll(0)
+
+    def _on_toggle(self, row):
+        if row.position is None:
+            return
+        self.tools[row.position]["active"] = row.var.get()
+        if self.on_change:
+            self.on_change()
+
+    def _on_scrollbar(self, action, amount, unit=None):
+        if action == "moveto":
+            self.first = int(float(amount) * len(self.visible))
+            self.scroll(0)
+        elif action == "scroll":
+            step = len(self.rows) if unit == "pages" else 1
+            self.scroll(int(amount) * step)
+
+    def _on_wheel(self, event):
+        self.scroll(-3 if event.delta > 0 else 3)
@@ -1,63 +1,322 @@
-from openai import OpenAI
-class LLM:
-    def __init__(self, base_url:str=None, model_name:str=None, api_key:str=None):
-        self.client = OpenAI(base_url=base_url, api_key=api_key)
+import asyncio
+import json
+import weakref
+
+from .RateLimiter import (LLM_MAX_RETRIES, LLM_MAX_RETRY_AFTER, backoff_delay, estimate_request_tokens,
+                          is_retryable, retry_after, scheduler_for)
+
+# openai is imported on first use, so the app starts without paying for it
+
+# One pooled HTTP client per event loop, shared by every AsyncLLM on that loop
+_http_clients = weakref.WeakKeyDictionary()
+
+
+def shared_http_client():
+    """
+    Returns the pooled HTTP client for the running event loop, creating it on first use.
+    """
+    from openai import DefaultAsyncHttpxClient
+    loop = asyncio.get_running_loop()
+    client = _http_clients.get(loop)
+    if client is None or client.is_closed:
+        client = DefaultAsyncHttpxClient()
+        _http_clients[loop] = client
+    return client
+
+
+class AsyncLLM:
+    def __init__(self, base_url:str=None, model_name:str=None, api_key:str=None, cache=None):
+        self.base_url = base_url
+        self.api_key = api_key
         self.model = model_name
         self.tools = []
+        self.cache = cache  # Optional ResponseCache for deterministic requests
+        self.limits = provider_limits(base_url)
+        self.stream_usage = True  # Ask for token usage at the end of streams, turn off for providers that reject it
+        self._client = None
 
-    def chat_completion(self, messages:list[str], temperature:int=0, n:int=1, max_tokens:int=2000):
-        if self.model:
+    @property
+    def client(self):
+        # Created lazily so the pooled HTTP client binds to the loop that uses it
+        if self._client is None:
+            from openai import AsyncOpenAI
+            # Retries are done by _send, which knows about the provider's rate limits
+            self._client = AsyncOpenAI(base_url=self.base_url, api_key=self.api_key, http_client=shared_http_client(),
+                                       max_retries=0)
+        return self._client
+
+    @property
+    def scheduler(self):
+        return scheduler_for(self.base_url, self.limits.get("requests_per_minute"), self.limits.get("tokens_per_minute"))
+
+    async def _send(self, kwargs: dict, session=None, first_chunk: bool = False, retries: int = None, reserved: int = None):
+        """
+        Sends a request once the provider's rate limits allow it, retrying rate limits, server errors and
+        connection failures up to retries (default LLM_MAX_RETRIES) times with jittered backoff, or after the
+        Retry-After the provider asked for. Completion requests have no side effects, so retrying them is safe.
+        With first_chunk the request is a stream and counts as sent once its first chunk arrived;
+        returns (stream, first chunk) then, and the caller corrects the reserved tokens once the stream ended.
+        """
+        scheduler = self.scheduler
+        reserved = estimate_request_tokens(kwargs) if reserved is None else reserved
+        retries = LLM_MAX_RETRIES if retries is None else retries
+        for attempt in range(retries + 1):
+            await scheduler.acquire(session, reserved)
             try:
-                kwargs = dict(
-                    model=self.model,
-                    messages=messages,
-                    temperature=temperature,
-                    n=n,
-                    max_tokens=max_tokens
-                )
-                if self.tools:  # Only add tools if not empty
-                    kwargs["tools"] = self.tools
-                response = self.client.chat.completions.create(**kwargs)
-                return response
+                if not first_chunk:
+                    response = await self.client.chat.completions.create(**kwargs)
+                    usage = getattr(response, "usage", None)
+                    scheduler.record_usage(reserved, getattr(usage, "total_tokens", None))
+                    return response
+                options = {"stream_options": {"include_usage": True}} if self.stream_usage else {}
+                stream = await self.client.chat.completions.create(stream=True, **options, **kwargs)
+                try:
+                    return stream, await stream.__anext__()
+                except StopAsyncIteration:
+                    return stream, None
+                except BaseException:
+                    await stream.close()  # Give the connection back before retrying
+                    raise
+            except asyncio.CancelledError:
+                scheduler.record_usage(reserved, 0)  # A hedge that lost, its tokens were never used
+                raise
             except Exception as e:
-                raise RuntimeError(f"An error occurred during chat completion: {str(e)}")
-        else:
+                # The attempt failed, give back its tokens before retrying or raising
+                scheduler.record_usage(reserved, 0)
+                if not is_retryable(e):
+                    scheduler.stats["failures"] += 1
+                    raise
+                delay = retry_after(e)
+                if getattr(e, "status_code", None) == 429:
+                    scheduler.stats["throttled"] += 1
+                if delay is not None and delay <= LLM_MAX_RETRY_AFTER:
+                    scheduler.pause(delay)  # Every session waits for the provider, not only this one
+                if attempt == retries or (delay is not None and delay > LLM_MAX_RETRY_AFTER):
+                    scheduler.stats["failures"] += 1
+                    raise
+                if delay is None:
+                    delay = backoff_delay(attempt)
+                scheduler.stats["retries"] += 1
+                await asyncio.sleep(delay)
+
+    def _completion_kwargs(self, messages, temperature, n, max_tokens, tools=None, model=None):
+        model = model or self.model
+        if not model:
             raise ValueError("Model name is not set. Please provide a valid model name.")
+        kwargs = dict(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            n=n,
+            max_tokens=max_tokens
+        )
+        tools = self.tools if tools is None else tools
+        if tools:  # Only add tools if not empty
+            kwargs["tools"] = tools
+        return kwargs
 
-    def list_models(self):
+    async def chat_completion(self, messages:list[str], temperature:int=0, n:int=1, max_tokens:int=2000, tools:list=None,
+                              session=None, model:str=None, retries:int=None):
+        """
+        Requests a chat completion. tools overrides self.tools for this request, pass [] to send none.
+        session identifies the caller for fair queuing when the provider's rate limits are reached.
+        model overrides self.model for this request. retries overrides LLM_MAX_RETRIES, a router passes 0
+        so it can fail over to another provider instead of waiting for this one.
+        """
+        kwargs = self._completion_kwargs(messages, temperature, n, max_tokens, tools, model)
+        if self.cache is not None:
+            request = dict(kwargs, base_url=self.base_url)
+            cached = await self.cache.get(request)
+            if cached is not None:
+                from openai.types.chat import ChatCompletion
+                return ChatCompletion.model_validate_json(cached)
+        try:
+            response = await self._send(kwargs, session, retries=retries)
+        except Exception as e:
+            raise RuntimeError(f"An error occurred during chat completion: {str(e)}") from e
+        if self.cache is not None:
+            await self.cache.put(request, response.model_dump_json())
+        return response
+
+    async def stream_chat_completion(self, messages:list[str], temperature:int=0, max_tokens:int=2000, tools:list=None,
+                                     session=None, model:str=None, retries:int=None, on_usage=None):
+        """
+        Streams a chat completion, yielding the delta of the first choice for every chunk.
+        Failures before the first chunk are retried, later ones are raised as the reply is already partly shown.
+        on_usage is called with the token usage the provider reports in the last chunk.
+        With a cache, a completely streamed round is stored assembled and replayed as a single delta next time.
+        """
+        kwargs = self._completion_kwargs(messages, temperature, 1, max_tokens, tools, model)
+        request = dict(kwargs, base_url=self.base_url, stream=True)
+        if self.cache is not None:
+            cached = await self.cache.get(request)
+            if cached is not None:
+                from openai.types.chat.chat_completion_chunk import ChoiceDelta
+                yield ChoiceDelta.model_validate_json(cached)
+                return
+        reserved = estimate_request_tokens(kwargs)
+        stream = usage = None
+        produced = 0  # Characters received, to estimate the usage of providers that do not report it
+        content, tool_calls = [], {}  # The round as assembled for the cache
+        try:
+            stream, first = await self._send(kwargs, session, first_chunk=True, retries=retries, reserved=reserved)
+            chunks = stream if first is None else chain_chunk(first, stream)
+            async for chunk in chunks:
+                if chunk.choices:
+                    delta = chunk.choices[0].delta
+                    produced += len(delta.content or "") + sum(
+                        len(call.function.arguments or "") for call in delta.tool_calls or [] if call.function)
+                    if self.cache is not None:
+                        assemble_delta(content, tool_calls, delta)
+                    yield delta
+                if getattr(chunk, "usage", None) is not None:
+                    usage = chunk.usage
+                    if on_usage is not None:
+                        on_usage(usage)
+            if self.cache is not None:
+                # Only reached when the stream was read to the end, rounds cut short are not cached
+                await self.cache.put(request, json.dumps({
+                    "role": "assistant",
+                    "content": "".join(content) or None,
+                    "tool_calls": [dict(call, index=index) for index, call in sorted(tool_calls.items())] or None,
+                }))
+        except Exception as e:
+            raise RuntimeError(f"An error occurred during chat completion: {str(e)}") from e
+        finally:
+            if stream is not None:
+                # Give back the part of max_tokens the reply did not use, also when the stream was cut short
+                used = getattr(usage, "total_tokens", None)
+                if used is None:
+                    used = reserved - (kwargs.get("max_tokens") or 0) + produced // 4
+                self.scheduler.record_usage(reserved, used)
+
+    async def list_models(self):
         """
         Lists available models from the OpenAI API.
         """
         try:
-            response = self.client.models.list()
+            response = await self.client.models.list()
             return response.data
         except Exception as e:
             raise RuntimeError(f"An error occurred while listing models: {str(e)}")
 
+
+def assemble_delta(content: list, tool_calls: dict, delta):
+    """Adds a streamed delta to the content parts and the tool calls (by index) of the round."""
+    if delta.content:
+        content.append(delta.content)
+    for call in delta.tool_calls or []:
+        assembled = tool_calls.setdefault(call.index, {"id": None, "type": "function",
+                                                       "function": {"name": "", "arguments": ""}})
+        if call.id:
+            assembled["id"] = call.id
+        if call.function:
+            assembled["function"]["name"] += call.function.name or ""
+            assembled["function"]["arguments"] += call.function.arguments or ""
+
+
+async def chain_chunk(first, stream):
+    yield first
+    async for chunk in stream:
+        yield chunk
+
+
+class LLM:
+    """
+    Blocking wrapper around AsyncLLM for scripts. Must not be used from inside a running event loop.
+    """
+    def __init__(self, base_url:str=None, model_name:str=None, api_key:str=None, cache=None):
+        self.backend = AsyncLLM(base_url=base_url, model_name=model_name, api_key=api_key, cache=cache)
+        self._loop = asyncio.new_event_loop()
+
+    @property
+    def model(self):
+        return self.backend.model
+
+    @model.setter
+    def model(self, value):
+        self.backend.model = value
+
+    @property
+    def tools(self):
+        return self.backend.tools
+
+    @tools.setter
+    def tools(self, value):
+        self.backend.tools = value
+
+    def chat_completion(self, messages:list[str], temperature:int=0, n:int=1, max_tokens:int=2000, tools:list=None):
+        return self._loop.run_until_complete(
+            self.backend.chat_completion(messages, temperature=temperature, n=n, max_tokens=max_tokens, tools=tools)
+        )
+
+    def stream_chat_completion(self, messages:list[str], temperature:int=0, max_tokens:int=2000, tools:list=None):
+        stream = self.backend.stream_chat_completion(messages, temperature=temperature, max_tokens=max_tokens, tools=tools)
+        try:
+            while True:
+                try:
+                    yield self._loop.run_until_complete(stream.__anext__())
+                except StopAsyncIteration:
+                    return
+        finally:
+            self._loop.run_until_complete(stream.aclose())
+
+    def list_models(self):
+        """
+        Lists available models from the OpenAI API.
+        """
+        return self._loop.run_until_complete(self.backend.list_models())
+
+    def close(self):
+        client = _http_clients.pop(self._loop, None)
+        if client is not None:
+            self._loop.run_until_complete(client.aclose())
+        self._loop.close()
+
 def available_LLM_providers():
     """
     Returns a list of available LLM providers.
+    Rate limits are the providers' entry-tier defaults, None where the provider sets none; raise them to match your account.
     """
     return {
     "openai": {
         "name": "OpenAI",
-        "base_url": "https://api.openai.com/v1"
+        "base_url": "https://api.openai.com/v1",
+        "requests_per_minute": 500,
+        "tokens_per_minute": 200000
     },
     "deepseek": {
         "name": "DeepSeek",
-        "base_url": "https://api.deepseek.com/v1"
+        "base_url": "https://api.deepseek.com/v1",
+        "requests_per_minute": None,
+        "tokens_per_minute": None
     },
     "groq": {
         "name": "Groq",
-        "base_url": "https://api.groq.com/openai/v1"
+        "base_url": "https://api.groq.com/openai/v1",
+        "requests_per_minute": 30,
+        "tokens_per_minute": 6000
     },
     "fireworks": {
         "name": "Fireworks.ai",
-        "base_url": "https://api.fireworks.ai/inference/v1"
+        "base_url": "https://api.fireworks.ai/inference/v1",
+        "requests_per_minute": 600,
+        "tokens_per_minute": None
     },
     "openrouter": {
         "name": "OpenRouter",
-        "base_url": "https://openrouter.ai/api/v1"
+        "base_url": "https://openrouter.ai/api/v1",
+        "requests_per_minute": 20,
+        "tokens_per_minute": None
     }
 }
 
+
+def provider_limits(base_url: str) -> dict:
+    """Rate limits of the known provider with this base URL, no limits for other providers."""
+    base_url = (base_url or "").rstrip("/")
+    for provider in available_LLM_providers().values():
+        if provider["base_url"] == base_url:
+            return {"requests_per_minute": provider.get("requests_per_minute"),
+                    "tokens_per_minute": provider.get("tokens_per_minute")}
+    return {}
@@ -0,0 +1,184 @@
+import asyncio
+import email.utils
+import json
+import random
+import time
+import weakref
+from collections import OrderedDict, deque
+
+# Attempts per request on 429s, 5xx errors and connection failures
+LLM_MAX_RETRIES = 4
+LLM_BACKOFF_BASE = 1.0
+LLM_BACKOFF_MAX = 60
+# Retry-After values above this are treated as a quota that will not come back soon
+LLM_MAX_RETRY_AFTER = 120
+
+# Schedulers per event loop and provider base URL, shared by every AsyncLLM on that loop
+_schedulers = weakref.WeakKeyDictionary()
+
+
+class TokenBucket:
+    """Bucket holding up to a minute's worth of capacity, refilled continuously at per_minute / 60 per second."""
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until amount can be taken; requests larger than the bucket wait for a full bucket."""
+        self._refill()
+        missing = min(amount, self.capacity) - self.level
+        return missing / self.rate if missing > 0 else 0.0
+
+    def take(self, amount: float):
+        self._refill()
+        self.level -= amount  # May go negative, later requests then wait for the debt to refill
+
+    def give(self, amount: float):
+        self._refill()
+        self.level = min(self.capacity, self.level + amount)
+
+
+class ProviderScheduler:
+    """
+    Client-side limiter for one provider with request and token buckets.
+    Waiting requests are served round-robin across sessions, so one busy session cannot starve the others,
+    and a Retry-After from the provider pauses everyone until it has passed.
+    """
+    def __init__(self, requests_per_minute: float = None, tokens_per_minute: float = None):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.queues = OrderedDict()  # session -> deque of (future, tokens)
+        self.paused_until = 0.0
+        self._pump = None
+        self.stats = {"requests": 0, "waits": 0, "wait_seconds": 0.0, "throttled": 0, "retries": 0, "failures": 0}
+
+    async def acquire(self, session, tokens: int):
+        """Waits for this session's turn and for room in the buckets, then takes one request and tokens."""
+        future = asyncio.get_running_loop().create_future()
+        self.queues.setdefault(session, deque()).append((future, tokens))
+        if self._pump is None or self._pump.done():
+            self._pump = asyncio.get_running_loop().create_task(self._run())
+        started = time.monotonic()
+        await future
+        waited = time.monotonic() - started
+        if waited > 0.01:
+            self.stats["waits"] += 1
+            self.stats["wait_seconds"] += waited
+        self.stats["requests"] += 1
+
+    async def _run(self):
+        while self.queues:
+            session, queue = next(iter(self.queues.items()))
+            future, tokens = queue[0]
+            if future.done():  # Cancelled while waiting
+                self._pop(session, queue)
+                continue
+            wait = self.paused_until - time.monotonic()
+            if self.requests is not None:
+                wait = max(wait, self.requests.wait_time(1))
+            if self.tokens is not None:
+                wait = max(wait, self.tokens.wait_time(tokens))
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            if self.requests is not None:
+                self.requests.take(1)
+            if self.tokens is not None:
+                self.tokens.take(tokens)
+            self._pop(session, queue)
+            self.queues.pop(session, None)
+            if queue:
+                self.queues[session] = queue  # Back of the line, other sessions go first
+            future.set_result(None)
+
+    def _pop(self, session, queue):
+        queue.popleft()
+        if not queue:
+            self.queues.pop(session, None)
+
+    def record_usage(self, reserved: int, used: int):
+        """Corrects the token bucket once the actual usage of a request is known."""
+        if self.tokens is None or used is None:
+            return
+        if used < reserved:
+            self.tokens.give(reserved - used)
+        elif used > reserved:
+            self.tokens.take(used - reserved)
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def metrics(self) -> dict:
+        return dict(
+            self.stats,
+            queued=sum(len(queue) for queue in self.queues.values()),
+            sessions_waiting=len(self.queues),
+            wait_seconds=round(self.stats["wait_seconds"], 3),
+        )
+
+
+def scheduler_for(base_url: str, requests_per_minute: float = None, tokens_per_minute: float = None) -> ProviderScheduler:
+    """Returns the scheduler of a provider for the running event loop, creating it on first use."""
+    schedulers = _schedulers.setdefault(asyncio.get_running_loop(), {})
+    scheduler = schedulers.get(base_url or "")
+    if scheduler is None:
+        scheduler = ProviderScheduler(requests_per_minute, tokens_per_minute)
+        schedulers[base_url or ""] = scheduler
+    return scheduler
+
+
+def scheduler_metrics() -> dict:
+    """Metrics of every provider scheduler on the running event loop, by base URL."""
+    schedulers = _schedulers.get(asyncio.get_running_loop(), {})
+    return {base_url: scheduler.metrics() for base_url, scheduler in schedulers.items()}
+
+
+def estimate_request_tokens(kwargs: dict) -> int:
+    """
+    Tokens a request counts against the quota: ~4 characters per token of the messages and tools,
+    plus max_tokens, which providers reserve up front.
+    """
+    text = json.dumps(kwargs.get("messages"), default=str) + json.dumps(kwargs.get("tools") or [], default=str)
+    return len(text) // 4 + (kwargs.get("max_tokens") or 0)
+
+
+def is_retryable(error: Exception) -> bool:
+    """Rate limits, server errors, timeouts and connection failures are retried; other errors are not."""
+    status = getattr(error, "status_code", None)
+    if status is not None:
+        return status == 429 or status == 408 or status >= 500
+    if type(error).__name__ in ("APIConnectionError", "APITimeoutError"):
+        return True
+    return isinstance(error, (ConnectionError, asyncio.TimeoutError))
+
+
+def retry_after(error: Exception):
+    """Seconds the provider asked to wait, from Retry-After / retry-after-ms headers, or None."""
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            date = email.utils.parsedate_to_datetime(value)
+            return max(date.timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt: int) -> float:
+    """Exponential backoff with jitter, so clients that failed together do not retry together."""
+    return min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.5)
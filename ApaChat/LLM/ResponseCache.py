@@ -0,0 +1,144 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Responses kept in memory
+RESPONSE_CACHE_MEMORY_ENTRIES = 256
+# Size limit of the on-disk tier
+RESPONSE_CACHE_DISK_MAX_BYTES = 256 * 1024 * 1024
+RESPONSE_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "ApaChat", "responses.sqlite")
+
+
+def cache_key(request: dict) -> str:
+    """Content address of a chat completion request: sha256 of its canonical JSON."""
+    canonical = json.dumps(request, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=_jsonable)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def _jsonable(value):
+    if hasattr(value, "model_dump"):
+        return value.model_dump(exclude_none=True)
+    return str(value)
+
+
+def is_cacheable(request: dict) -> bool:
+    """Only deterministic requests are cached: temperature 0 and a single choice."""
+    return (request.get("temperature") or 0) <= 0 and (request.get("n") or 1) <= 1
+
+
+class ResponseCache:
+    """
+    Exact-match cache for deterministic chat completions with an in-memory LRU tier
+    and an optional SQLite tier on disk, trimmed to max_disk_bytes by least recent use.
+    """
+    def __init__(self, path: str = RESPONSE_CACHE_PATH, memory_entries: int = RESPONSE_CACHE_MEMORY_ENTRIES,
+                 max_disk_bytes: int = RESPONSE_CACHE_DISK_MAX_BYTES):
+        self.memory = OrderedDict()  # key -> serialized response
+        self.memory_entries = memory_entries
+        self.path = path
+        self.max_disk_bytes = max_disk_bytes
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0, "bypassed": 0}
+        self._db = None
+        self._lock = threading.Lock()
+
+    async def get(self, request: dict):
+        """Returns the cached response JSON for the request, or None."""
+        if not is_cacheable(request):
+            self.stats["bypassed"] += 1
+            return None
+        key = cache_key(request)
+        data = self.memory.get(key)
+        if data is not None:
+            self.memory.move_to_end(key)
+            self.stats["hits"] += 1
+            return data
+        if self.path:
+            data = await asyncio.to_thread(self._disk_get, key)
+            if data is not None:
+                self._remember(key, data)
+                self.stats["disk_hits"] += 1
+                return data
+        self.stats["misses"] += 1
+        return None
+
+    async def put(self, request: dict, data: str):
+        """Stores the response JSON for the request in both tiers."""
+        if not is_cacheable(request):
+            return
+        key = cache_key(request)
+        self._remember(key, data)
+        if self.path:
+            await asyncio.to_thread(self._disk_put, key, data)
+
+    def _remember(self, key: str, data: str):
+        self.memory[key] = data
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    def _connect(self):
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, data TEXT NOT NULL, size INTEGER NOT NULL, used REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS responses_used ON responses (used)")
+        return self._db
+
+    def _disk_get(self, key: str):
+        with self._lock:
+            try:
+                db = self._connect()
+                row = db.execute("SELECT data FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    return None
+                db.execute("UPDATE responses SET used = ? WHERE key = ?", (time.time(), key))
+                db.commit()
+                return row[0]
+            except sqlite3.Error as e:
+                print(f"Response cache read failed: {e}")
+                return None
+
+    def _disk_put(self, key: str, data: str):
+        with self._lock:
+            try:
+                db = self._connect()
+                db.execute(
+                    "INSERT OR REPLACE INTO responses (key, data, size, used) VALUES (?, ?, ?, ?)",
+                    (key, data, len(data), time.time())
+                )
+                total = db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+                if total > self.max_disk_bytes:
+                    # Drop least recently used entries until the tier fits again
+                    excess = total - self.max_disk_bytes
+                    for old_key, size in db.execute("SELECT key, size FROM responses ORDER BY used").fetchall():
+                        if excess <= 0:
+                            break
+                        db.execute("DELETE FROM responses WHERE key = ?", (old_key,))
+                        excess -= size
+                db.commit()
+            except sqlite3.Error as e:
+                print(f"Response cache write failed: {e}")
+
+    def clear(self):
+        self.memory.clear()
+        if self.path:
+            with self._lock:
+                try:
+                    self._connect().execute("DELETE FROM responses")
+                    self._db.commit()
+                except sqlite3.Error as e:
+                    print(f"Response cache clear failed: {e}")
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
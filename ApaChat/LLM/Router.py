@@ -0,0 +1,248 @@
+import asyncio
+import random
+import time
+
+from .RateLimiter import is_retryable, retry_after
+
+# Weight of the newest sample in a backend's moving average latency
+ROUTER_LATENCY_ALPHA = 0.3
+# Share of requests sent to a random healthy backend first, so the latency of the others stays known
+ROUTER_EXPLORE = 0.05
+# Consecutive failures after which a backend is skipped, for a cooldown that doubles with every further failure.
+# Rate limits, server errors and timeouts start the cooldown right away
+ROUTER_FAILURE_THRESHOLD = 2
+ROUTER_COOLDOWN = 15
+ROUTER_COOLDOWN_MAX = 300
+ROUTING_STRATEGIES = ("latency", "weighted")
+
+
+class Backend:
+    """One AsyncLLM behind a router, with its weight, latency averages and health."""
+    def __init__(self, llm, weight: float = 1.0):
+        self.llm = llm
+        self.weight = weight
+        self.latency = {}  # "completion" / "stream" -> moving average seconds to a reply or first chunk
+        self.failures = 0
+        self.down_until = 0.0
+        self.stats = {"requests": 0, "failures": 0, "hedges_won": 0}
+
+    @property
+    def name(self) -> str:
+        return f"{self.llm.base_url} {self.llm.model}"
+
+    @property
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.down_until
+
+    def record_latency(self, kind: str, seconds: float):
+        previous = self.latency.get(kind)
+        self.latency[kind] = seconds if previous is None else previous + ROUTER_LATENCY_ALPHA * (seconds - previous)
+
+    def record_success(self, kind: str, seconds: float):
+        self.record_latency(kind, seconds)
+        self.failures = 0
+        self.down_until = 0.0
+
+    def record_failure(self, error: Exception = None):
+        self.failures += 1
+        self.stats["failures"] += 1
+        cause = getattr(error, "__cause__", None) or error  # AsyncLLM wraps the provider's error
+        transient = cause is not None and is_retryable(cause)
+        if transient or self.failures >= ROUTER_FAILURE_THRESHOLD:
+            cooldown = min(ROUTER_COOLDOWN * 2 ** max(self.failures - ROUTER_FAILURE_THRESHOLD, 0), ROUTER_COOLDOWN_MAX)
+            if transient:
+                cooldown = max(cooldown, min(retry_after(cause) or 0, ROUTER_COOLDOWN_MAX))
+            self.down_until = time.monotonic() + cooldown
+
+    def metrics(self) -> dict:
+        return dict(
+            self.stats,
+            weight=self.weight,
+            healthy=self.healthy,
+            latency_ms={kind: round(seconds * 1000, 1) for kind, seconds in self.latency.items()},
+        )
+
+
+class LLMRouter:
+    """
+    Routes requests over several AsyncLLM backends and has the same interface, so an Agent can use it as its LLM.
+    Each request goes to the backend with the lowest average latency ("latency") or to one picked by weight ("weighted").
+    A failing backend is failed over to the next one, and skipped for a while after repeated failures.
+    Backends do not retry on their own, except the last one tried, so failover does not wait for their backoff.
+    With hedge_after set, a request without a reply (or first chunk) after that many seconds is also sent
+    to the next backend, and the first answer wins.
+    model, tools, base_url and list_models() are those of the first backend, the one connected in the app.
+    A model passed with a request is used on every backend, so it must be available on all of them.
+    """
+    def __init__(self, backends: list, strategy: str = "latency", hedge_after: float = None):
+        if strategy not in ROUTING_STRATEGIES:
+            raise ValueError(f"Unknown routing strategy '{strategy}', expected one of {', '.join(ROUTING_STRATEGIES)}")
+        self.backends = [backend if isinstance(backend, Backend) else Backend(backend) for backend in backends]
+        self.strategy = strategy
+        self.hedge_after = hedge_after
+        self.stats = {"requests": 0, "failovers": 0, "hedges": 0, "failures": 0}
+
+    @property
+    def primary(self):
+        return self.backends[0].llm
+
+    @property
+    def model(self):
+        return self.primary.model
+
+    @model.setter
+    def model(self, value):
+        self.primary.model = value
+
+    @property
+    def tools(self):
+        return self.primary.tools
+
+    @tools.setter
+    def tools(self, value):
+        for backend in self.backends:
+            backend.llm.tools = value
+
+    @property
+    def base_url(self):
+        return self.primary.base_url
+
+    @property
+    def cache(self):
+        return self.primary.cache
+
+    def add(self, llm, weight: float = 1.0):
+        self.backends.append(Backend(llm, weight))
+
+    def order(self, kind: str) -> list[Backend]:
+        """Backends in the order they are tried. Backends in cooldown come last, as a last resort."""
+        healthy = [backend for backend in self.backends if backend.healthy]
+        down = sorted((backend for backend in self.backends if not backend.healthy), key=lambda b: b.down_until)
+        if self.strategy == "weighted":
+            # Weighted shuffle: each backend is first with a probability proportional to its weight
+            healthy.sort(key=lambda b: random.random() ** (1 / b.weight) if b.weight > 0 else 0, reverse=True)
+        else:
+            # Backends without a measurement yet go first once, so every backend gets measured
+            healthy.sort(key=lambda b: b.latency.get(kind, 0.0))
+            if len(healthy) > 1 and random.random() < ROUTER_EXPLORE:
+                healthy.insert(0, healthy.pop(random.randrange(1, len(healthy))))
+        return healthy + down
+
+    async def _timed(self, backend: Backend, kind: str, start, retries):
+        backend.stats["requests"] += 1
+        started = time.monotonic()
+        try:
+            result = await start(backend.llm, retries)
+        except asyncio.CancelledError:
+            raise  # Lost a hedge, not a failure
+        except Exception as e:
+            backend.record_failure(e)
+            raise
+        backend.record_success(kind, time.monotonic() - started)
+        return result
+
+    async def _route(self, kind: str, start, discard=None):
+        """
+        Runs start(llm, retries) on backends in order until one succeeds, hedging to the next one after hedge_after.
+        retries is 0 for all but the last backend, which retries as usual since there is nothing left to fail over to.
+        discard(result) releases a result that arrived after another backend already won.
+        """
+        self.stats["requests"] += 1
+        candidates = self.order(kind)
+        pending = {}  # task -> backend
+        started = {}  # backend -> start of its request
+        errors = []
+        launched = 0
+        hedged = False
+
+        def launch():
+            nonlocal launched
+            backend = candidates[launched]
+            launched += 1
+            started[backend] = time.monotonic()
+            retries = None if launched == len(candidates) else 0
+            pending[asyncio.ensure_future(self._timed(backend, kind, start, retries))] = backend
+
+        def release(task):
+            if discard is not None and not task.cancelled() and task.exception() is None:
+                discard(task.result())
+
+        launch()
+        try:
+            while pending:
+                can_hedge = not hedged and self.hedge_after is not None and launched < len(candidates)
+                done, _ = await asyncio.wait(pending, timeout=self.hedge_after if can_hedge else None,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedged = True
+                    self.stats["hedges"] += 1
+                    launch()
+                    continue
+                winner = None
+                failed = 0
+                for task in done:
+                    backend = pending.pop(task)
+                    if task.exception() is not None:
+                        errors.append(f"{backend.name}: {task.exception()}")
+                        failed += 1
+                    elif winner is None:
+                        winner = task
+                        if hedged and backend is not candidates[0]:
+                            backend.stats["hedges_won"] += 1
+                    else:
+                        release(task)
+                if winner is not None:
+                    return winner.result()
+                # Every failed request is replaced by one to the next backend, hedges included
+                for _ in range(min(failed, len(candidates) - launched)):
+                    self.stats["failovers"] += 1
+                    launch()
+            self.stats["failures"] += 1
+            raise RuntimeError("All LLM providers failed: " + "; ".join(errors))
+        finally:
+            for task, backend in pending.items():
+                # Losing a hedge is no failure, but the loser took at least this long
+                backend.record_latency(kind, time.monotonic() - started[backend])
+                task.cancel()
+                task.add_done_callback(release)
+
+    async def chat_completion(self, messages:list[str], temperature:int=0, n:int=1, max_tokens:int=2000, tools:list=None,
+                              session=None, model:str=None):
+        return await self._route("completion", lambda llm, retries: llm.chat_completion(
+            messages, temperature=temperature, n=n, max_tokens=max_tokens, tools=tools, session=session, model=model,
+            retries=retries))
+
+    async def stream_chat_completion(self, messages:list[str], temperature:int=0, max_tokens:int=2000, tools:list=None,
+                                     session=None, model:str=None, on_usage=None):
+        """Streams from the first backend to deliver a chunk. Failures after that are raised, as with AsyncLLM."""
+        async def first_chunk(llm, retries):
+            stream = llm.stream_chat_completion(messages, temperature=temperature, max_tokens=max_tokens, tools=tools,
+                                                session=session, model=model, retries=retries, on_usage=on_usage)
+            try:
+                return stream, [await stream.__anext__()]
+            except StopAsyncIteration:
+                return stream, []
+            except BaseException:
+                await stream.aclose()
+                raise
+
+        stream, first = await self._route("stream", first_chunk,
+                                          discard=lambda result: asyncio.ensure_future(result[0].aclose()))
+        try:
+            for delta in first:
+                yield delta
+            async for delta in stream:
+                yield delta
+        finally:
+            await stream.aclose()
+
+    async def list_models(self):
+        return await self.primary.list_models()
+
+    def metrics(self) -> dict:
+        return dict(
+            self.stats,
+            strategy=self.strategy,
+            hedge_after=self.hedge_after,
+            backends={backend.name: backend.metrics() for backend in self.backends},
+        )
@@ -0,0 +1,240 @@
+import asyncio
+import hashlib
+import logging
+import time
+
+from .MCPClient import MCPClient, is_idempotent
+
+logger = logging.getLogger(__name__)
+
+# MCP sessions opened at most per server
+MCP_POOL_SIZE = 3
+# Concurrent tool calls on one session before another session is opened
+MCP_CALLS_PER_SESSION = 4
+
+
+def connection_key(server_url: str, auth_method: str = "none", token: str = None, oauth_server_url: str = None,
+                   transport: str = "sse"):
+    """Pools are shared by connections to the same URL over the same transport with the same credentials."""
+    secret = hashlib.sha256((token or "").encode("utf-8")).hexdigest()
+    return (server_url, transport, (auth_method or "none").lower(), secret, oauth_server_url or "")
+
+
+class MCPPool:
+    """
+    Reference-counted pool of MCPClient sessions to one MCP server.
+    Tool calls go to the least busy session; more sessions are opened when all are at
+    calls_per_session, up to size, after which callers wait for a free slot.
+    """
+    def __init__(self, server_url: str, auth_method: str = "none", token: str = None, oauth_server_url: str = None,
+                 size: int = MCP_POOL_SIZE, calls_per_session: int = MCP_CALLS_PER_SESSION, transport: str = "sse"):
+        self.server_url = server_url
+        self.transport = transport
+        self.auth_method = auth_method
+        self.token = token
+        self.oauth_server_url = oauth_server_url
+        self.size = size
+        self.calls_per_session = calls_per_session
+        self.clients = []
+        self.in_flight = {}  # client -> running calls
+        self.tools = []
+        self.listeners = []  # Called with the new tool list after the server reported tools/list_changed
+        self.refs = 0
+        self.waiting = 0
+        self._opening = 0
+        self._capacity = asyncio.Event()
+        self._refresh = None
+        self._refresh_again = False
+        self.stats = {"calls": 0, "waits": 0, "peak_in_flight": 0, "sessions_opened": 0}
+        self.connect_seconds = 0.0  # Summed over opened sessions
+        self.call_seconds = 0.0  # Summed over finished calls
+
+    @property
+    def status(self):
+        return "Connected" if self.clients else "Not connected"
+
+    async def connect(self):
+        """Opens the first session and loads the server's tools."""
+        client = await self._open_client()
+        self.tools = client.tools
+        return self.tools
+
+    async def _open_client(self) -> MCPClient:
+        client = MCPClient()
+        client.on_tools_changed = self.tools_changed
+        self._opening += 1
+        try:
+            client.tools = await client.connect(self.server_url, self.auth_method, self.token, self.oauth_server_url, self.transport)
+        finally:
+            self._opening -= 1
+        self.clients.append(client)
+        self.in_flight[client] = 0
+        self.stats["sessions_opened"] += 1
+        self.connect_seconds += client.connect_seconds or 0.0
+        self._capacity.set()
+        return client
+
+    def tools_changed(self):
+        """Lists the tools again after a tools/list_changed notification; notifications from several sessions share one listing."""
+        if self._refresh is not None and not self._refresh.done():
+            self._refresh_again = True
+            return
+        self._refresh = asyncio.get_running_loop().create_task(self._refresh_tools())
+
+    async def _refresh_tools(self):
+        while True:
+            self._refresh_again = False
+            client = self._least_busy()
+            if client is None:
+                return
+            try:
+                self.tools = await client.list_tools()
+            except Exception as e:
+                logger.warning(f"Could not list the changed tools of {self.server_url}: {e}")
+                return
+            for other in self.clients:
+                other.tools = self.tools
+                other.idempotent_tools = {tool.name for tool in self.tools if is_idempotent(tool)}
+            for listener in list(self.listeners):
+                try:
+                    result = listener(self.tools)
+                    if asyncio.iscoroutine(result):
+                        await result
+                except Exception as e:
+                    logger.warning(f"Tool list listener failed for {self.server_url}: {e}")
+            if not self._refresh_again:
+                return
+
+    def _least_busy(self):
+        if not self.clients:
+            return None
+        return min(self.clients, key=lambda client: self.in_flight[client])
+
+    async def _checkout(self) -> MCPClient:
+        self.waiting += 1
+        waited = False
+        try:
+            while True:
+                client = self._least_busy()
+                if client is not None and self.in_flight[client] < self.calls_per_session:
+                    break
+                if len(self.clients) + self._opening < self.size:
+                    try:
+                        client = await self._open_client()
+                        break
+                    except Exception as e:
+                        if not self.clients:
+                            raise
+                        logger.warning(f"Could not open another session to {self.server_url}: {e}")
+                waited = True
+                self._capacity.clear()
+                await self._capacity.wait()
+        finally:
+            self.waiting -= 1
+        if waited:
+            self.stats["waits"] += 1
+        self.in_flight[client] += 1
+        self.stats["calls"] += 1
+        self.stats["peak_in_flight"] = max(self.stats["peak_in_flight"], self.busy())
+        return client
+
+    def _checkin(self, client: MCPClient):
+        if client in self.in_flight:
+            self.in_flight[client] -= 1
+        self._capacity.set()
+
+    async def call_tool(self, tool_name: str, tool_args: dict):
+        """Calls a tool on the least busy session and returns the raw CallToolResult."""
+        client = await self._checkout()
+        started = time.perf_counter()
+        try:
+            return await client.call(tool_name, tool_args)
+        finally:
+            self.call_seconds += time.perf_counter() - started
+            self._checkin(client)
+
+    def busy(self) -> int:
+        return sum(self.in_flight.values())
+
+    def metrics(self) -> dict:
+        capacity = self.size * self.calls_per_session
+        opened, calls = self.stats["sessions_opened"], self.stats["calls"]
+        return dict(
+            self.stats,
+            url=self.server_url,
+            transport=self.transport,
+            avg_connect_ms=round(1000 * self.connect_seconds / opened, 1) if opened else None,
+            avg_call_ms=round(1000 * self.call_seconds / calls, 1) if calls else None,
+            refs=self.refs,
+            sessions=len(self.clients),
+            max_sessions=self.size,
+            in_flight=self.busy(),
+            waiting=self.waiting,
+            capacity=capacity,
+            saturation=round(self.busy() / capacity, 3) if capacity else 0.0,
+        )
+
+    async def close(self):
+        if self._refresh is not None:
+            self._refresh.cancel()
+        clients, self.clients, self.in_flight = self.clients, [], {}
+        for client in clients:
+            try:
+                await client.cleanup()
+            except Exception as e:
+                logger.warning(f"Error closing MCP session to {self.server_url}: {e}")
+        self._capacity.set()
+
+
+class MCPConnectionManager:
+    """
+    Process-wide registry of MCP connection pools keyed by server URL and credentials,
+    so agents and sessions talking to the same server share connections and tool listings.
+    """
+    def __init__(self, size: int = MCP_POOL_SIZE, calls_per_session: int = MCP_CALLS_PER_SESSION):
+        self.size = size
+        self.calls_per_session = calls_per_session
+        self.pools = {}
+        self._connecting = {}
+
+    async def acquire(self, server_url: str, auth_method: str = "none", token: str = None, oauth_server_url: str = None,
+                      transport: str = "sse") -> MCPPool:
+        """Returns the pool for this server, transport and credentials, connecting it if needed, and adds a reference."""
+        key = connection_key(server_url, auth_method, token, oauth_server_url, transport)
+        pool = self.pools.get(key)
+        if pool is None:
+            # Concurrent acquires of a new server share one connect
+            task = self._connecting.get(key)
+            if task is None:
+                task = asyncio.ensure_future(self._connect(key, server_url, auth_method, token, oauth_server_url, transport))
+                self._connecting[key] = task
+            pool = await asyncio.shield(task)
+        pool.refs += 1
+        return pool
+
+    async def _connect(self, key, server_url, auth_method, token, oauth_server_url, transport) -> MCPPool:
+        pool = MCPPool(server_url, auth_method, token, oauth_server_url, self.size, self.calls_per_session, transport)
+        try:
+            await pool.connect()
+            self.pools[key] = pool
+            return pool
+        finally:
+            self._connecting.pop(key, None)
+
+    async def release(self, pool: MCPPool):
+        """Drops a reference, closing the pool when nobody uses it any more."""
+        pool.refs -= 1
+        if pool.refs > 0:
+            return
+        for key, candidate in list(self.pools.items()):
+            if candidate is pool:
+                del self.pools[key]
+        await pool.close()
+
+    def metrics(self) -> list[dict]:
+        """Saturation metrics of every pool."""
+        return [pool.metrics() for pool in self.pools.values()]
+
+
+# Shared by every Agent in the process
+connection_manager = MCPConnectionManager()
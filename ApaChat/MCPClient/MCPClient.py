@@ -1,58 +1,94 @@
+import asyncio
 import base64
-from typing import Optional
+import random
+import shlex
+import time
+from contextlib import asynccontextmanager
+from typing import Optional, TYPE_CHECKING
 import logging
-from mcp import ClientSession
-from contextlib import AsyncExitStack
-from mcp.client.sse import sse_client
-import requests
+import anyio
+from .TokenProvider import token_provider
 import traceback
+from urllib.parse import urlparse
+
+# mcp is imported when a connection is opened, so the app starts without paying for it
+if TYPE_CHECKING:
+    from mcp import ClientSession
 
 
 
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
+# Seconds between keepalive pings on an open session
+MCP_HEARTBEAT_INTERVAL = 30
+MCP_HEARTBEAT_TIMEOUT = 10
+# Sessions unused for this many seconds are closed and reopened on the next call
+MCP_IDLE_TIMEOUT = 600
+# Reconnect attempts after a connection drops, with jittered exponential backoff
+MCP_RECONNECT_ATTEMPTS = 5
+MCP_BACKOFF_BASE = 0.5
+MCP_BACKOFF_MAX = 30
+MCP_CONNECT_TIMEOUT = 30
+
+TRANSPORTS = ("sse", "streamable-http", "stdio")
+
+# Errors that mean the connection is gone rather than that the tool failed
+TRANSPORT_ERRORS = (ConnectionError, OSError, asyncio.TimeoutError, anyio.ClosedResourceError, anyio.BrokenResourceError, anyio.EndOfStream)
+# JSON-RPC error code the mcp session raises for requests whose connection closed (mcp.types.CONNECTION_CLOSED)
+MCP_CONNECTION_CLOSED = -32000
+
+
 class MCPClient:
     def __init__(self):
         # Initialize session and client objects
-        self.session: Optional[ClientSession] = None
-        self.exit_stack = AsyncExitStack()
+        self.session: Optional["ClientSession"] = None
         self.status = "Not connected"
-        self._streams_context = None
-        self._session_context = None
-
-    async def connect_to_sse_server(self, server_url: str, auth_method: str = "none", token: str = None,oauth_server_url: str = None):
-        """Connect to an MCP server running with SSE transport using specified auth type (oauth, bearer and none are supported)"""
-        # Store the context managers so they stay alive
+        self.tools = []
+        self.idempotent_tools = set()  # Tools that are safe to retry after a dropped connection
+        self.heartbeat_interval = MCP_HEARTBEAT_INTERVAL
+        self.idle_timeout = MCP_IDLE_TIMEOUT
+        self.last_used = time.monotonic()
+        self.in_flight = 0
+        self.transport = "sse"
+        self.connect_seconds = None
+        self._server = None  # Connect parameters, kept for reconnects
+        self._http_client = None
+        self._unsubscribe_token = None
+        self.on_tools_changed = None  # Called without arguments when the server reports tools/list_changed
+        self._supervisor = None
+        self._connected = asyncio.Event()
+        self._interrupt = asyncio.Event()
+        self._stopping = False
+        self._start_lock = asyncio.Lock()
 
+    async def connect(self, server_url: str, auth_method: str = "none", token: str = None, oauth_server_url: str = None,
+                      transport: str = "sse"):
+        """
+        Connect to an MCP server over the given transport (sse, streamable-http or stdio) using specified auth type
+        (oauth, bearer and none are supported). For stdio, server_url is the command line that starts the server.
+        """
         await self.cleanup()  # Ensure any previous connections are cleaned up
-        headers = {}
-        if auth_method.lower() == "bearer" and token:
-            headers={"Authorization": f"Bearer {token}"}
-        elif auth_method.lower() == "oauth" and token:
-            headers={"Authorization": get_token(oauth_server_url=oauth_server_url, creds=token)}
-        # No headers for "none"
+        if transport not in TRANSPORTS:
+            raise ValueError(f"Unknown MCP transport '{transport}', expected one of {', '.join(TRANSPORTS)}")
+        self.transport = transport
+        self._server = (server_url, auth_method, token, oauth_server_url)
         try:
-            self._streams_context = sse_client(
-                url=server_url,
-                headers=headers
-            )
-            streams = await self._streams_context.__aenter__()
-
-            self._session_context = ClientSession(*streams)
-            self.session: ClientSession = await self._session_context.__aenter__()
-
-            # Initialize
-            await self.session.initialize()
+            started = time.perf_counter()
+            await self._start()
 
             # List available tools to verify connection
-            logger.info("Initialized SSE client with Bearer authentication...")
+            logger.info(f"Initialized {transport} client with {auth_method} authentication...")
             response = await self.session.list_tools()
-            logger.info(f"Recieved {len(response.tools)} tools from the server.")
-            self.status = "Connected"
+            self.connect_seconds = time.perf_counter() - started
+            logger.info(f"Recieved {len(response.tools)} tools from the server in {self.connect_seconds:.2f}s.")
+            self.tools = response.tools
+            self.idempotent_tools = {tool.name for tool in response.tools if is_idempotent(tool)}
+            if auth_method.lower() == "oauth" and token:
+                self._unsubscribe_token = token_provider.subscribe(oauth_server_url, token, self.rotate_token)
             return response.tools
         except Exception as e:
-            logger.error(f"Failed to connect to SSE server: {e}")
+            logger.error(f"Failed to connect to {transport} server: {e}")
             traceback.print_exc()
     # If it's a TaskGroup error, print sub-exceptions
             if hasattr(e, 'exceptions'):
@@ -61,20 +97,183 @@ class MCPClient:
                     traceback.print_exception(type(sub), sub, sub.__traceback__)
     
             self.status = "Connection failed"
-            raise RuntimeError(f"Failed to connect to SSE server: {e}")
+            await self.cleanup()
+            self.status = "Connection failed"
+            raise RuntimeError(f"Failed to connect to {transport} server: {e}")
+
+    async def connect_to_sse_server(self, server_url: str, auth_method: str = "none", token: str = None,oauth_server_url: str = None):
+        """Connect to an MCP server running with SSE transport using specified auth type (oauth, bearer and none are supported)"""
+        return await self.connect(server_url, auth_method, token, oauth_server_url, "sse")
+
+    async def _start(self):
+        """Starts the supervisor task and waits for its first connection, raising if that fails."""
+        self._stopping = False
+        self._interrupt.clear()
+        first = asyncio.get_running_loop().create_future()
+        self._supervisor = asyncio.get_running_loop().create_task(self._supervise(first))
+        await first
+
+    async def _supervise(self, first):
+        # Owns the transport and session contexts, so they are entered and exited in the same task.
+        # Reconnects with backoff when the connection drops, exits when idle, stopped or out of attempts.
+        attempt = 0
+        while not self._stopping:
+            reason = "dropped"
+            try:
+                reason = await self._serve(first)
+                attempt = 0
+            except Exception as e:
+                if not first.done():
+                    first.set_exception(e)
+                    return
+                logger.warning(f"MCP connection to {self._server[0]} lost: {e}")
+            if cancel_requested():
+                # The transports' task groups can swallow the cancellation, it must not look like a drop
+                self.status = "Not Connected"
+                if not first.done():
+                    first.cancel()
+                raise asyncio.CancelledError()
+            if reason in ("stopped", "idle") or self._stopping:
+                self.status = "Idle" if reason == "idle" else "Not Connected"
+                break
+            if attempt >= MCP_RECONNECT_ATTEMPTS:
+                self.status = "Connection failed"
+                logger.error(f"Giving up reconnecting to {self._server[0]} after {attempt} attempts")
+                break
+            delay = min(MCP_BACKOFF_MAX, MCP_BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.5)
+            attempt += 1
+            self.status = "Reconnecting"
+            logger.info(f"Reconnecting to {self._server[0]} in {delay:.1f}s (attempt {attempt})")
+            self._interrupt.clear()
+            try:
+                await asyncio.wait_for(self._interrupt.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+        if not first.done():
+            first.set_exception(RuntimeError("Connection closed"))
+
+    async def _serve(self, first):
+        from mcp import ClientSession
+        server_url, auth_method, token, oauth_server_url = self._server
+        headers = {}
+        if auth_method.lower() == "bearer" and token:
+            headers={"Authorization": f"Bearer {token}"}
+        elif auth_method.lower() == "oauth" and token:
+            headers={"Authorization": await token_provider.get(oauth_server_url, token)}
+        # No headers for "none"
+        async with open_transport(self.transport, server_url, headers, self._http_client_factory) as streams:
+            # Streamable HTTP may also yield a session id getter, the session only needs the streams.
+            # The read stream ends when the server goes away, which wakes the heartbeat to reconnect right away.
+            read_stream = WatchedStream(streams[0], self._interrupt.set)
+            async with ClientSession(read_stream, streams[1], message_handler=self._handle_message) as session:
+                await session.initialize()
+                self.session = session
+                self.status = "Connected"
+                self._connected.set()
+                if not first.done():
+                    first.set_result(None)
+                try:
+                    return await self._heartbeat(session)
+                finally:
+                    self._connected.clear()
+                    self.session = None
+                    self._http_client = None
+
+    async def _handle_message(self, message):
+        notification = getattr(message, "root", message)
+        if getattr(notification, "method", None) == "notifications/tools/list_changed" and self.on_tools_changed:
+            self.on_tools_changed()
+
+    def _http_client_factory(self, headers=None, timeout=None, auth=None):
+        # Keeps the transport's HTTP client, so refreshed OAuth tokens can be swapped into its headers
+        from mcp.shared._httpx_utils import create_mcp_http_client
+        self._http_client = create_mcp_http_client(headers=headers, timeout=timeout, auth=auth)
+        return self._http_client
+
+    def rotate_token(self, authorization: str):
+        """Sends later requests of the live session with a refreshed OAuth token, without reconnecting."""
+        if self._http_client is not None:
+            self._http_client.headers["Authorization"] = authorization
+
+    async def _heartbeat(self, session):
+        """Pings the server while the session is up. Returns why the session should end."""
+        while True:
+            try:
+                await asyncio.wait_for(self._interrupt.wait(), self.heartbeat_interval)
+            except asyncio.TimeoutError:
+                pass
+            if self._stopping:
+                return "stopped"
+            if self._interrupt.is_set():
+                return "dropped"
+            if self.idle_timeout and not self.in_flight and time.monotonic() - self.last_used > self.idle_timeout:
+                logger.info(f"Closing idle MCP connection to {self._server[0]}")
+                return "idle"
+            try:
+                await asyncio.wait_for(session.send_ping(), MCP_HEARTBEAT_TIMEOUT)
+            except Exception as e:
+                logger.warning(f"Heartbeat to {self._server[0]} failed: {e}")
+                return "dropped"
+
+    async def ensure_connected(self) -> "ClientSession":
+        """Returns a live session, reopening the connection if it was closed as idle or gave up reconnecting."""
+        if self.session is not None and self._connected.is_set():
+            return self.session
+        if self._server is None:
+            raise RuntimeError("MCP client is not connected")
+        async with self._start_lock:
+            if self._supervisor is None or self._supervisor.done():
+                await self._start()
+        await asyncio.wait_for(self._connected.wait(), MCP_CONNECT_TIMEOUT)
+        return self.session
+
+    async def call(self, tool_name: str, tool_args: dict):
+        """
+        Calls a tool and returns the raw CallToolResult. If the connection drops during the call
+        it is reconnected, and idempotent tools are retried once.
+        """
+        self.in_flight += 1
+        self.last_used = time.monotonic()
+        try:
+            for attempt in range(2):
+                session = await self.ensure_connected()
+                try:
+                    return await session.call_tool(tool_name, tool_args)
+                except Exception as e:
+                    if not is_transport_error(e):
+                        raise
+                    if self.session is session:
+                        # Let the supervisor reconnect, the retry waits for the new session
+                        self._connected.clear()
+                        self._interrupt.set()
+                    if attempt or tool_name not in self.idempotent_tools:
+                        raise
+                    logger.info(f"Retrying idempotent tool '{tool_name}' after connection error: {e}")
+        finally:
+            self.in_flight -= 1
+            self.last_used = time.monotonic()
 
     async def cleanup(self):
         """Properly clean up the session and streams"""
-        if self._session_context:
-            await self._session_context.__aexit__(None, None, None)
-        if self._streams_context:
-            await self._streams_context.__aexit__(None, None, None)
+        if self._unsubscribe_token is not None:
+            self._unsubscribe_token()
+            self._unsubscribe_token = None
+        self._stopping = True
+        self._interrupt.set()
+        if self._supervisor is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(self._supervisor), MCP_HEARTBEAT_TIMEOUT)
+            except Exception as e:
+                logger.warning(f"Error while closing MCP connection: {e}")
+                self._supervisor.cancel()
+            self._supervisor = None
+        self.session = None
         self.status = "Not Connected"
         return None
 
     async def call_tool(self, tool_name: str, tool_args: dict):
         try:
-            result = await self.session.call_tool(tool_name, tool_args)
+            result = await self.call(tool_name, tool_args)
             # Handle the result (if needed)
             if result:
                 return (f"Tool '{tool_name}' executed successfully with result: {result}")
@@ -87,7 +286,8 @@ class MCPClient:
     async def list_tools(self):
         """List available tools from the MCP server"""
         try:
-            response = await self.session.list_tools()
+            session = await self.ensure_connected()
+            response = await session.list_tools()
             tools = response.tools
             return tools
         except Exception as e:
@@ -96,7 +296,108 @@ class MCPClient:
             raise RuntimeError(f"Failed to list tools: {e}")
 
 
+def guess_transport(server_url: str) -> str:
+    """Transport for a server given without one: stdio for commands, SSE for /sse endpoints, otherwise streamable HTTP."""
+    parsed = urlparse(server_url)
+    if parsed.scheme not in ("http", "https"):
+        return "stdio"
+    return "sse" if parsed.path.rstrip("/").endswith("/sse") else "streamable-http"
+
+
+@asynccontextmanager
+async def open_transport(transport: str, server_url: str, headers: dict = None, http_client_factory=None):
+    """
+    Opens the read and write streams of an MCP transport. The stdio and HTTP clients are only imported when used.
+    HTTP transports create their HTTP client with http_client_factory, if given.
+    """
+    if transport == "stdio":
+        from mcp import StdioServerParameters
+        from mcp.client.stdio import stdio_client
+        command, *args = shlex.split(server_url)
+        async with stdio_client(StdioServerParameters(command=command, args=args)) as streams:
+            yield streams
+    elif transport == "streamable-http":
+        from mcp.client.streamable_http import create_mcp_http_client, streamable_http_client
+        # One HTTP client per session, so every request of the session reuses its keep-alive connections
+        async with (http_client_factory or create_mcp_http_client)(headers=headers or None) as http_client:
+            async with streamable_http_client(server_url, http_client=http_client) as streams:
+                yield streams
+    else:
+        from mcp.client.sse import sse_client
+        factory = {"httpx_client_factory": http_client_factory} if http_client_factory else {}
+        async with sse_client(url=server_url, headers=headers, **factory) as streams:
+            yield streams
+
+
+class WatchedStream:
+    """Wraps the read stream of a transport and calls on_close once it ends, e.g. when a stdio server exits."""
+    def __init__(self, stream, on_close):
+        self._stream = stream
+        self._on_close = on_close
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+    async def __aenter__(self):
+        await self._stream.__aenter__()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        try:
+            return await self._stream.__aexit__(*exc_info)
+        finally:
+            self._on_close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self._stream.__anext__()
+        except (StopAsyncIteration, anyio.EndOfStream, anyio.ClosedResourceError, anyio.BrokenResourceError):
+            self._on_close()
+            raise
+
+    async def receive(self):
+        try:
+            return await self._stream.receive()
+        except (anyio.EndOfStream, anyio.ClosedResourceError, anyio.BrokenResourceError):
+            self._on_close()
+            raise
+
+    async def aclose(self):
+        try:
+            await self._stream.aclose()
+        finally:
+            self._on_close()
+
+
+def cancel_requested() -> bool:
+    """Whether the running task has been asked to cancel, also after the CancelledError was swallowed."""
+    cancelling = getattr(asyncio.current_task(), "cancelling", None)  # Python 3.11+
+    return bool(cancelling and cancelling())
+
+
+def is_transport_error(error: Exception) -> bool:
+    """Whether an error means the connection is gone rather than that the tool failed."""
+    if isinstance(error, TRANSPORT_ERRORS):
+        return True
+    # mcp raises McpError (MCPError in newer versions) with CONNECTION_CLOSED for requests cut off by a closed connection
+    code = getattr(getattr(error, "error", None), "code", None)
+    return type(error).__name__ in ("McpError", "MCPError") and code == MCP_CONNECTION_CLOSED
+
+
+def is_idempotent(tool) -> bool:
+    """Whether a tool's annotations say it can safely be called again with the same arguments."""
+    annotations = getattr(tool, "annotations", None)
+    # mcp 1.x keeps the protocol's camelCase field names, 2.x uses snake_case
+    hints = ("readOnlyHint", "idempotentHint", "read_only_hint", "idempotent_hint")
+    return annotations is not None and any(getattr(annotations, hint, None) is True for hint in hints)
+
+
 def get_token(oauth_server_url:str=None,creds=None):
+    """Blocking token request, kept for synchronous callers. MCPClient uses the cached async token_provider."""
+    import requests
     try:
         creds=creds.encode("ascii")
         creds=base64.b64encode(creds)
@@ -0,0 +1,128 @@
+import asyncio
+import base64
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# Lifetime assumed when the token response has no expires_in
+OAUTH_DEFAULT_EXPIRES_IN = 300
+# Tokens are refreshed this many seconds, or this fraction of their lifetime, before they expire
+OAUTH_REFRESH_MARGIN = 60
+OAUTH_REFRESH_FRACTION = 0.1
+OAUTH_REQUEST_TIMEOUT = 30
+
+
+def client_id(creds: str) -> str:
+    """The client id part of 'client_id:client_secret' credentials."""
+    return (creds or "").split(":", 1)[0]
+
+
+class TokenProvider:
+    """
+    Async cache of OAuth client-credentials tokens keyed by (oauth_server_url, client id).
+    Concurrent requests for the same token share one token request. While sessions are subscribed,
+    tokens are refreshed in the background before they expire and handed to the subscribers.
+    """
+    def __init__(self):
+        self.tokens = {}  # key -> (authorization header, expires_at, lifetime)
+        self.subscribers = {}  # key -> {subscriber id: callback}
+        self._inflight = {}
+        self._refreshers = {}
+        self.stats = {"hits": 0, "requests": 0, "refreshes": 0, "failures": 0}
+
+    async def get(self, oauth_server_url: str, creds: str) -> str:
+        """Returns a valid 'Bearer ...' authorization header, requesting a token only if none is cached."""
+        key = (oauth_server_url, client_id(creds))
+        cached = self.tokens.get(key)
+        if cached is not None and cached[1] - time.monotonic() > self._margin(cached[2]):
+            self.stats["hits"] += 1
+            return cached[0]
+        return await self._fetch(key, oauth_server_url, creds)
+
+    def subscribe(self, oauth_server_url: str, creds: str, callback):
+        """
+        Calls callback(authorization) whenever the token is refreshed, and keeps refreshing it
+        in the background until the returned unsubscribe function is called.
+        """
+        key = (oauth_server_url, client_id(creds))
+        subscriber = object()
+        self.subscribers.setdefault(key, {})[subscriber] = callback
+        refresher = self._refreshers.get(key)
+        if refresher is None or refresher.done():
+            self._refreshers[key] = asyncio.get_running_loop().create_task(self._refresh_forever(key, oauth_server_url, creds))
+
+        def unsubscribe():
+            callbacks = self.subscribers.get(key, {})
+            callbacks.pop(subscriber, None)
+            if not callbacks:
+                self.subscribers.pop(key, None)
+                task = self._refreshers.pop(key, None)
+                if task is not None:
+                    task.cancel()
+        return unsubscribe
+
+    async def _fetch(self, key, oauth_server_url: str, creds: str) -> str:
+        # Concurrent callers share one in-flight token request
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._request(key, oauth_server_url, creds))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _request(self, key, oauth_server_url: str, creds: str) -> str:
+        self.stats["requests"] += 1
+        try:
+            response = await asyncio.to_thread(request_token, oauth_server_url, creds)
+        except Exception as e:
+            self.stats["failures"] += 1
+            logger.error(f"Error trying to get OAuth token: {e}")
+            raise RuntimeError(f"Failed to get OAuth token: {e}")
+        lifetime = float(response.get("expires_in") or OAUTH_DEFAULT_EXPIRES_IN)
+        authorization = f'Bearer {response["access_token"]}'
+        self.tokens[key] = (authorization, time.monotonic() + lifetime, lifetime)
+        return authorization
+
+    def _margin(self, lifetime: float) -> float:
+        return min(OAUTH_REFRESH_MARGIN, lifetime * OAUTH_REFRESH_FRACTION)
+
+    async def _refresh_forever(self, key, oauth_server_url: str, creds: str):
+        while key in self.subscribers:
+            cached = self.tokens.get(key)
+            if cached is not None:
+                await asyncio.sleep(max(cached[1] - time.monotonic() - self._margin(cached[2]), 0))
+            try:
+                authorization = await self._fetch(key, oauth_server_url, creds)
+            except Exception as e:
+                # Keep the current token and try again halfway to its expiry
+                cached = self.tokens.get(key)
+                remaining = cached[1] - time.monotonic() if cached else 0
+                logger.warning(f"Refreshing OAuth token from {oauth_server_url} failed: {e}")
+                await asyncio.sleep(max(remaining / 2, 5))
+                continue
+            self.stats["refreshes"] += 1
+            for callback in list(self.subscribers.get(key, {}).values()):
+                try:
+                    callback(authorization)
+                except Exception as e:
+                    logger.warning(f"Could not rotate OAuth token into a session: {e}")
+
+    def invalidate(self, oauth_server_url: str, creds: str):
+        """Forgets a cached token, e.g. after the server rejected it."""
+        self.tokens.pop((oauth_server_url, client_id(creds)), None)
+
+
+def request_token(oauth_server_url: str, creds: str) -> dict:
+    """Blocking client-credentials token request, run in a worker thread."""
+    import requests
+    encoded = base64.b64encode(creds.encode("ascii")).decode("ascii")
+    headers = {"Authorization": f"Basic {encoded}", "Content-Type": "application/x-www-form-urlencoded"}
+    response = requests.post(oauth_server_url, data={"grant_type": "client_credentials"}, headers=headers,
+                             timeout=OAUTH_REQUEST_TIMEOUT)
+    response.raise_for_status()
+    return response.json()
+
+
+# Shared by every MCPClient in the process
+token_provider = TokenProvider()
@@ -0,0 +1,146 @@
+import asyncio
+import json
+import time
+from collections import OrderedDict
+
+from .MCPClient import is_idempotent
+
+# Seconds a cached tool result stays valid unless the tool has its own TTL
+DEFAULT_TOOL_TTL = 300
+# Approximate memory the cached results may take up
+TOOL_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+
+def canonical_args(tool_args) -> str:
+    """Arguments as a canonical JSON string, so equal arguments in any key order share a cache entry."""
+    return json.dumps(tool_args or {}, sort_keys=True, separators=(",", ":"), default=str)
+
+
+def result_size(result) -> int:
+    """Approximate size in bytes of a CallToolResult, from its content parts rather than its repr."""
+    size = 64
+    for part in getattr(result, "content", None) or []:
+        for field in ("text", "data"):
+            value = getattr(part, field, None)
+            if isinstance(value, (str, bytes)):
+                size += len(value)
+        resource = getattr(part, "resource", None)
+        for field in ("text", "blob"):
+            value = getattr(resource, field, None)
+            if isinstance(value, (str, bytes)):
+                size += len(value)
+    structured = getattr(result, "structuredContent", None) or getattr(result, "structured_content", None)
+    if structured is not None:
+        size += len(json.dumps(structured, default=str))
+    return size
+
+
+class ToolCache:
+    """
+    Opt-in TTL/LRU cache for results of idempotent MCP tool calls, keyed by server, tool and canonical arguments.
+    Tools are cacheable if their readOnlyHint or idempotentHint annotation says so, or if marked with set_cacheable.
+    """
+    def __init__(self, enabled: bool = False, default_ttl: float = DEFAULT_TOOL_TTL, max_bytes: int = TOOL_CACHE_MAX_BYTES):
+        self.enabled = enabled
+        self.default_ttl = default_ttl
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (expires_at, size, result)
+        self.size = 0
+        self.policies = {}  # (server, tool) -> TTL in seconds, None if not cacheable
+        self.overrides = {}  # (server, tool) -> TTL set with set_cacheable, None if disabled
+        self._inflight = {}
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+
+    def register_tools(self, server: str, tools):
+        """Derives the cache policy of a server's tools from their MCP annotations."""
+        for key in [key for key in self.policies if key[0] == server]:
+            del self.policies[key]
+        for tool in tools:
+            self.policies[(server, tool.name)] = self.default_ttl if is_idempotent(tool) else None
+        self.invalidate(server)
+
+    def update_tools(self, server: str, tools, removed=()):
+        """Updates the policy of changed tools and drops removed ones, invalidating only their results."""
+        for tool in tools:
+            self.policies[(server, tool.name)] = self.default_ttl if is_idempotent(tool) else None
+            self.invalidate(server, tool.name)
+        for name in removed:
+            self.policies.pop((server, name), None)
+            self.invalidate(server, name)
+
+    def set_cacheable(self, server: str, tool: str, cacheable: bool = True, ttl: float = None):
+        """Marks a tool as cacheable with an optional TTL (or not cacheable), overriding its annotations."""
+        self.overrides[(server, tool)] = (ttl or self.default_ttl) if cacheable else None
+        if not cacheable:
+            self.invalidate(server, tool)
+
+    def ttl(self, server: str, tool: str):
+        if (server, tool) in self.overrides:
+            return self.overrides[(server, tool)]
+        return self.policies.get((server, tool))
+
+    async def call(self, server: str, tool: str, tool_args, call):
+        """
+        Returns the result of call() for this tool and arguments, from the cache when possible.
+        Identical calls in flight at the same time share one request.
+        """
+        ttl = self.ttl(server, tool) if self.enabled else None
+        if ttl is None:
+            return await call()
+        key = (server, tool, canonical_args(tool_args))
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry[2]
+            self._remove(key)
+            self.stats["expirations"] += 1
+        if key in self._inflight:
+            self.stats["hits"] += 1
+            return await asyncio.shield(self._inflight[key])
+        self.stats["misses"] += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            result = await call()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # Mark as retrieved when nobody else was waiting
+            raise
+        finally:
+            self._inflight.pop(key, None)
+        future.set_result(result)
+        if not (getattr(result, "isError", False) or getattr(result, "is_error", False)):  # mcp 2 uses snake_case
+            self._store(key, result, ttl)
+        return result
+
+    def _store(self, key, result, ttl: float):
+        size = result_size(result)
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = (time.monotonic() + ttl, size, result)
+        self.size += size
+        while self.size > self.max_bytes:
+            oldest = next(iter(self.entries))
+            self._remove(oldest)
+            self.stats["evictions"] += 1
+
+    def _remove(self, key):
+        _, size, _ = self.entries.pop(key)
+        self.size -= size
+
+    def invalidate(self, server: str = None, tool: str = None):
+        """Drops cached results, of one tool, one server or everything."""
+        for key in list(self.entries):
+            if (server is None or key[0] == server) and (tool is None or key[1] == tool):
+                self._remove(key)
+
+    def info(self) -> dict:
+        """Cache statistics: hits, misses, evictions, expirations, entries and bytes."""
+        return dict(self.stats, entries=len(self.entries), bytes=self.size)
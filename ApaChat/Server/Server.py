@@ -0,0 +1,454 @@
+import argparse
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import secrets
+import struct
+import time
+import uuid
+from urllib.parse import parse_qs, urlparse
+
+from ..Agent.Agent import Agent
+from ..Agent.ConversationStore import ConversationStore
+from ..MCPClient.ToolCache import DEFAULT_TOOL_TTL
+from ..LLM.RateLimiter import scheduler_metrics
+from ..LLM.ResponseCache import ResponseCache
+from ..LLM.Router import LLMRouter, ROUTING_STRATEGIES
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Sessions without activity for this many seconds are evicted
+SESSION_IDLE_TIMEOUT = 30 * 60
+MAX_SESSIONS = 1000
+MAX_BODY_BYTES = 1024 * 1024
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+class PayloadTooLarge(Exception):
+    """Request body above MAX_BODY_BYTES, answered with 413 instead of being cut off."""
+
+
+class Session:
+    def __init__(self, agent: Agent, session_id: str = None):
+        self.id = session_id or uuid.uuid4().hex
+        self.agent = agent
+        self.lock = asyncio.Lock()  # One turn at a time per session
+        self.last_used = time.monotonic()
+
+    def touch(self):
+        self.last_used = time.monotonic()
+
+
+class SessionManager:
+    """
+    Hosts many chat sessions on one event loop. Every session has its own history,
+    the LLM client, MCP connections, tool index and caches of the base agent are shared.
+    If the base agent has a conversation store, sessions are stored under their id and
+    sessions that were evicted, or hosted before a restart, are resumed on their next request.
+    """
+    def __init__(self, base_agent: Agent, idle_timeout: float = SESSION_IDLE_TIMEOUT, max_sessions: int = MAX_SESSIONS):
+        self.base_agent = base_agent
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self.sessions = {}
+        self._reaper = None
+
+    def create(self) -> Session:
+        if len(self.sessions) >= self.max_sessions:
+            self.evict_idle(force_oldest=True)
+        session = Session(self.base_agent.new_session())
+        if self.base_agent.store is not None:
+            session.agent.start_conversation(session.id)
+        self.sessions[session.id] = session
+        return session
+
+    def get(self, session_id: str) -> Session:
+        session = self.sessions.get(session_id)
+        if session is not None:
+            session.touch()
+        return session
+
+    async def resume(self, session_id: str) -> Session:
+        """Returns the session, reopening it from the conversation store if it is not in memory."""
+        session = self.get(session_id)
+        if session is not None or self.base_agent.store is None:
+            return session
+        agent = self.base_agent.new_session()
+        if not await agent.open_conversation(session_id):
+            return None
+        session = self.sessions.get(session_id)  # Resumed by a concurrent request meanwhile
+        if session is None:
+            if len(self.sessions) >= self.max_sessions:
+                self.evict_idle(force_oldest=True)
+            session = Session(agent, session_id)
+            self.sessions[session_id] = session
+        session.touch()
+        return session
+
+    def close(self, session_id: str) -> bool:
+        session = self.sessions.pop(session_id, None)
+        if session is not None:
+            session.agent.context.reset()
+            session.agent.tool_results.clear()
+        return session is not None
+
+    def evict_idle(self, force_oldest: bool = False):
+        """
+        Drops idle sessions, or the least recently used one if force_oldest is set and none are idle.
+        Sessions in the middle of a turn are never dropped.
+        """
+        now = time.monotonic()
+        idle = [sid for sid, s in self.sessions.items() if now - s.last_used > self.idle_timeout and not s.lock.locked()]
+        free = [s for s in self.sessions.values() if not s.lock.locked()]
+        if not idle and force_oldest and free:
+            idle = [min(free, key=lambda s: s.last_used).id]
+        for sid in idle:
+            self.close(sid)
+        if idle:
+            logger.info(f"Evicted {len(idle)} idle sessions, {len(self.sessions)} remaining")
+
+    async def reap_forever(self, interval: float = 60):
+        while True:
+            await asyncio.sleep(interval)
+            self.evict_idle()
+
+    def start(self):
+        self._reaper = asyncio.get_running_loop().create_task(self.reap_forever(min(60, self.idle_timeout)))
+
+    def stop(self):
+        if self._reaper:
+            self._reaper.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "sessions": len(self.sessions),
+            "busy": sum(1 for s in self.sessions.values() if s.lock.locked()),
+            "llm_connected": self.base_agent.connected_status,
+            "mcp_servers": {name: entry.get("connected", False) for name, entry in self.base_agent.mcp.items()},
+            "mcp_pools": self.base_agent.connections.metrics(),
+            "llm_rate_limits": scheduler_metrics(),
+            "llm_router": self.base_agent.LLM.metrics() if isinstance(self.base_agent.LLM, LLMRouter) else None,
+            "model_cascade": dict(self.base_agent.cascade_stats, tool_model=self.base_agent.tool_model),
+            "conversation_store": dict(self.base_agent.store.stats) if self.base_agent.store is not None else None,
+            "response_cache": dict(self.base_agent.response_cache.stats) if self.base_agent.response_cache is not None else None,
+            "tool_cache": self.base_agent.tool_cache.info() if self.base_agent.tool_cache.enabled else None,
+        }
+
+
+class AgentServer:
+    """
+    Minimal HTTP/WebSocket front end for a SessionManager, built on asyncio streams.
+    Every request needs the server's token, as "Authorization: Bearer <token>" or, for browser WebSockets
+    that cannot set headers, as ?token=<token>. Requests sent by web pages are refused unless their
+    Origin is in allowed_origins, so a page open in the browser cannot drive the agent and its tools.
+
+    POST   /sessions                  -> {"session_id"}
+    POST   /sessions/<id>/messages    {"content"} -> {"reply"}
+    DELETE /sessions/<id>
+    GET    /sessions/<id>/ws          WebSocket: send {"content"}, receive {"type": "chunk"|"done"|"error"}
+    GET    /search?q=<text>[&limit=<n>][&session=<id>] -> stored messages matching text, best first
+    GET    /health                    -> session and connection stats
+    """
+    def __init__(self, manager: SessionManager, host: str = "127.0.0.1", port: int = 8765, token: str = None,
+                 allowed_origins: list = ()):
+        self.manager = manager
+        self.host = host
+        self.port = port
+        self.token = token or secrets.token_urlsafe(32)  # New for every launch unless given
+        self.allowed_origins = {origin.rstrip("/") for origin in allowed_origins}
+        self.server = None
+
+    async def start(self):
+        self.manager.start()
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        logger.info(f"ApaChat server listening on http://{self.host}:{self.port}")
+        logger.info(f"Authenticate with the header 'Authorization: Bearer {self.token}'")
+        return self.server
+
+    async def serve_forever(self):
+        await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def handle_connection(self, reader, writer):
+        try:
+            request = await read_request(reader)
+            if request is None:
+                return
+            method, path, headers, body = request
+            url = urlparse(path)
+            parts = [p for p in url.path.split("/") if p]
+            query = parse_qs(url.query)
+            origin = headers.get("origin")
+            if origin is not None and origin.rstrip("/") not in self.allowed_origins:
+                await write_json(writer, 403, {"error": "Origin not allowed"})
+                return
+            if not self.authorized(headers, query):
+                await write_json(writer, 401, {"error": "Missing or wrong token"})
+                return
+            if headers.get("upgrade", "").lower() == "websocket" and len(parts) == 3 and parts[0] == "sessions" and parts[2] == "ws":
+                await self.handle_websocket(parts[1], headers, reader, writer)
+                return
+            status, payload = await self.route(method, parts, body, query)
+            await write_json(writer, status, payload)
+        except PayloadTooLarge:
+            await write_json(writer, 413, {"error": f"Body larger than {MAX_BODY_BYTES} bytes"})
+        except Exception as e:
+            logger.error(f"Error handling request: {e}")
+            try:
+                await write_json(writer, 500, {"error": str(e)})
+            except Exception:
+                pass
+        finally:
+            writer.close()
+
+    def authorized(self, headers: dict, query: dict) -> bool:
+        scheme, _, credentials = headers.get("authorization", "").partition(" ")
+        token = credentials.strip() if scheme.lower() == "bearer" else query.get("token", [""])[0]
+        return hmac.compare_digest(token.encode(), self.token.encode())
+
+    async def route(self, method: str, parts: list, body: bytes, query: dict = None):
+        query = query or {}
+        if parts == ["health"] and method == "GET":
+            return 200, self.manager.stats()
+        if parts == ["search"] and method == "GET":
+            store = self.manager.base_agent.store
+            if store is None:
+                return 404, {"error": "No conversation store, start the server with --conversations"}
+            text = query.get("q", [""])[0]
+            if not text.strip():
+                return 400, {"error": "Missing 'q'"}
+            try:
+                limit = min(max(int(query.get("limit", ["20"])[0]), 1), 100)
+            except ValueError:
+                return 400, {"error": "'limit' must be a number"}
+            return 200, {"results": await store.search(text, limit, query.get("session", [None])[0])}
+        if parts == ["sessions"] and method == "POST":
+            return 201, {"session_id": self.manager.create().id}
+        if len(parts) >= 2 and parts[0] == "sessions":
+            session = await self.manager.resume(parts[1])
+            if session is None:
+                return 404, {"error": "Unknown session"}
+            if len(parts) == 2 and method == "DELETE":
+                self.manager.close(session.id)
+                return 200, {"closed": session.id}
+            if len(parts) == 3 and parts[2] == "messages" and method == "POST":
+                try:
+                    content = json.loads(body or b"{}").get("content")
+                except ValueError:
+                    return 400, {"error": "Body must be JSON"}
+                if not content:
+                    return 400, {"error": "Missing 'content'"}
+                async with session.lock:
+                    reply = await session.agent.get_response(content)
+                session.touch()
+                return 200, {"reply": reply}
+        return 404, {"error": "Not found"}
+
+    async def handle_websocket(self, session_id: str, headers: dict, reader, writer):
+        session = await self.manager.resume(session_id)
+        if session is None:
+            await write_json(writer, 404, {"error": "Unknown session"})
+            return
+        key = headers.get("sec-websocket-key", "")
+        accept = base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode()).digest()).decode()
+        writer.write(
+            "HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+            f"Sec-WebSocket-Accept: {accept}\r\n\r\n".encode()
+        )
+        await writer.drain()
+        while True:
+            message = await read_ws_message(reader, writer)
+            if message is None:
+                break
+            try:
+                content = json.loads(message).get("content")
+            except (ValueError, AttributeError):
+                content = message
+            async with session.lock:
+                try:
+                    async for chunk in session.agent.stream_response(content):
+                        await write_ws_text(writer, json.dumps({"type": "chunk", "content": chunk}))
+                    await write_ws_text(writer, json.dumps({"type": "done"}))
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    raise
+                except Exception as e:
+                    await write_ws_text(writer, json.dumps({"type": "error", "error": str(e)}))
+            session.touch()
+
+
+async def read_request(reader):
+    """Reads one HTTP/1.1 request. Returns (method, path, headers, body) or None on EOF."""
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+        return None
+    lines = head.decode("latin-1").split("\r\n")
+    method, path, _ = lines[0].split(" ", 2)
+    headers = {}
+    for line in lines[1:]:
+        if ":" in line:
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length", 0) or 0)
+    if length > MAX_BODY_BYTES:
+        raise PayloadTooLarge()
+    body = await reader.readexactly(length) if length else b""
+    return method.upper(), path, headers, body
+
+
+async def write_json(writer, status: int, payload):
+    body = json.dumps(payload).encode("utf-8")
+    reason = {200: "OK", 201: "Created", 400: "Bad Request", 401: "Unauthorized", 403: "Forbidden", 404: "Not Found",
+              413: "Payload Too Large", 500: "Internal Server Error"}.get(status, "")
+    writer.write(
+        f"HTTP/1.1 {status} {reason}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+        f"Connection: close\r\n\r\n".encode() + body
+    )
+    await writer.drain()
+
+
+async def read_ws_message(reader, writer):
+    """Reads one (possibly fragmented) WebSocket text message, answering pings. Returns None when closed."""
+    fragments = []
+    try:
+        while True:
+            first, second = await reader.readexactly(2)
+            fin, opcode = first & 0x80, first & 0x0F
+            length = second & 0x7F
+            if length == 126:
+                length = struct.unpack("!H", await reader.readexactly(2))[0]
+            elif length == 127:
+                length = struct.unpack("!Q", await reader.readexactly(8))[0]
+            if length > MAX_BODY_BYTES:
+                return None
+            mask = await reader.readexactly(4) if second & 0x80 else None
+            payload = await reader.readexactly(length)
+            if mask:
+                payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+            if opcode == 0x8:  # Close
+                writer.write(bytes([0x88, 0]))
+                await writer.drain()
+                return None
+            if opcode == 0x9:  # Ping
+                await write_ws_frame(writer, 0xA, payload)
+                continue
+            if opcode == 0xA:  # Pong
+                continue
+            fragments.append(payload)
+            if fin:
+                return b"".join(fragments).decode("utf-8")
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+
+
+async def write_ws_frame(writer, opcode: int, payload: bytes):
+    header = bytes([0x80 | opcode])
+    if len(payload) < 126:
+        header += bytes([len(payload)])
+    elif len(payload) < 1 << 16:
+        header += bytes([126]) + struct.pack("!H", len(payload))
+    else:
+        header += bytes([127]) + struct.pack("!Q", len(payload))
+    writer.write(header + payload)
+    await writer.drain()
+
+
+async def write_ws_text(writer, text: str):
+    await write_ws_frame(writer, 0x1, text.encode("utf-8"))
+
+
+async def run_server(args):
+    agent = Agent()
+    if args.conversations:
+        agent.store = ConversationStore(args.conversations)
+        agent.store.start()  # Indexes conversations stored before search existed in the background
+    if args.response_cache:
+        agent.response_cache = ResponseCache(args.response_cache)  # Before connecting, every LLM gets it
+    if args.tool_cache:
+        # Before connecting, the TTL of each server's tools is set when they are registered
+        agent.configure_tool_cache(default_ttl=args.tool_cache_ttl, ttls=args.tool_ttl)
+    if args.base_url or args.api_key:
+        models = await agent.connect_LLM(base_url=args.base_url, api_key=args.api_key)
+        agent.LLM.model = args.model or (models[0] if models else None)
+        logger.info(f"Connected to LLM, using model {agent.LLM.model}")
+        for base_url, model, api_key in args.fallback_llm:
+            try:
+                await agent.add_LLM_backend(base_url=base_url, model_name=model, api_key=api_key)
+                logger.info(f"Added fallback LLM {base_url} with model {model}")
+            except Exception as e:
+                logger.error(f"Adding fallback LLM {base_url} failed: {e}")
+        agent.tool_model = args.tool_model
+        if isinstance(agent.LLM, LLMRouter):
+            agent.LLM.strategy = args.routing
+            agent.LLM.hedge_after = args.hedge_after
+    servers = [(url, "none", None) for url in args.mcp] + [(url, "bearer", token) for url, token in args.mcp_bearer]
+    results = await asyncio.gather(*(agent.connect_MCP(url, auth, token) for url, auth, token in servers), return_exceptions=True)
+    for (url, _, _), result in zip(servers, results):
+        if isinstance(result, Exception):
+            logger.error(f"Connecting to MCP {url} failed: {result}")
+            continue
+        # No tool picker in headless mode, every tool is active and ranked per request
+        for tool in result["tools"]:
+            tool["active"] = True
+    manager = SessionManager(agent, idle_timeout=args.idle_timeout, max_sessions=args.max_sessions)
+    try:
+        await AgentServer(manager, args.host, args.port, args.token, args.allow_origin).serve_forever()
+    finally:
+        for session_id in list(manager.sessions):
+            manager.close(session_id)  # Deletes their spilled tool results
+        if agent.store is not None:
+            await agent.store.close()
+        if agent.response_cache is not None:
+            agent.response_cache.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run ApaChat as a headless multi-session server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--base-url", default=os.environ.get("OPENAI_BASE_URL"))
+    parser.add_argument("--api-key", default=os.environ.get("OPENAI_API_KEY"))
+    parser.add_argument("--model", default=None)
+    parser.add_argument("--tool-model", default=None,
+                        help="Smaller model that drafts tool calls, --model then only writes the replies")
+    parser.add_argument("--fallback-llm", action="append", default=[], nargs=3, metavar=("BASE_URL", "MODEL", "API_KEY"),
+                        help="Further LLM provider to route to and fail over to, may be given several times")
+    parser.add_argument("--routing", choices=ROUTING_STRATEGIES, default="latency",
+                        help="How requests are spread over the LLM providers")
+    parser.add_argument("--hedge-after", type=float, default=None, metavar="SECONDS",
+                        help="Also send a request to the next provider if the first has not answered after this long")
+    parser.add_argument("--mcp", action="append", default=[], metavar="URL",
+                        help="MCP server without authentication: an SSE or streamable HTTP URL, or a command for stdio")
+    parser.add_argument("--mcp-bearer", action="append", default=[], nargs=2, metavar=("URL", "TOKEN"),
+                        help="MCP server with bearer token authentication")
+    parser.add_argument("--conversations", default=None, metavar="PATH",
+                        help="SQLite file sessions are stored in, so they can be resumed after eviction or a restart")
+    parser.add_argument("--token", default=os.environ.get("APACHAT_SERVER_TOKEN"),
+                        help="Bearer token clients must send, a random one is generated and logged at every launch otherwise")
+    parser.add_argument("--allow-origin", action="append", default=[], metavar="ORIGIN",
+                        help="Web page origin allowed to call the server, e.g. http://localhost:3000")
+    parser.add_argument("--response-cache", default=None, metavar="PATH",
+                        help="SQLite file replies to identical temperature 0 requests are cached in, off by default")
+    parser.add_argument("--tool-cache", action="store_true",
+                        help="Reuse results of read-only and idempotent MCP tools called again with the same arguments")
+    parser.add_argument("--tool-cache-ttl", type=float, default=DEFAULT_TOOL_TTL, metavar="SECONDS",
+                        help="Seconds a cached tool result stays valid")
+    parser.add_argument("--tool-ttl", action="append", default=[], nargs=2, metavar=("TOOL", "SECONDS"),
+                        help="TTL of one tool named server_toolname, also for tools without annotations; 0 never caches it")
+    parser.add_argument("--idle-timeout", type=float, default=SESSION_IDLE_TIMEOUT)
+    parser.add_argument("--max-sessions", type=int, default=MAX_SESSIONS)
+    args = parser.parse_args(argv)
+    try:
+        args.tool_ttl = {name: float(seconds) for name, seconds in args.tool_ttl}
+    except ValueError:
+        parser.error("--tool-ttl expects a tool name and a number of seconds")
+    try:
+        asyncio.run(run_server(args))
+    except KeyboardInterrupt:
+        pass
@@ -1,4 +1,14 @@
-from ApaChat.ChatInterface.ChatInterface import main
+import sys
+import time
+
+# Launch time, for the time-to-interactive reported by the app
+STARTED = time.perf_counter()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if "--headless" in sys.argv[1:]:
+        # Headless servers may not have Tk, so the GUI is only imported when needed
+        from ApaChat.Server.Server import main as server_main
+        server_main([arg for arg in sys.argv[1:] if arg != "--headless"])
+    else:
+        from ApaChat.ChatInterface.ChatInterface import main
+        main(started=STARTED)